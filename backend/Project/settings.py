@@ -88,6 +88,40 @@ MEDIA_ROOT = BASE_DIR / "media"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Двухуровневый кеш: LRU в памяти процесса перед общим для всех воркеров файлом SQLite.
+# В L1 держим только мелкие горячие записи - поколения тегов и справочники каталога.
+CACHES = {
+    "default": {
+        "BACKEND": "api.cache_backends.TwoTierCache",
+        "LOCATION": "fashionstore",
+        "OPTIONS": {
+            "L2": "shared",
+            "L1_MAX_ENTRIES": 1000,
+            "L1_TIMEOUT": 30,
+            "L1_KEY_PREFIXES": ["fs:gen:", "fs:changed:", "fs:category_tree:", "fs:categories_with_counts:"],
+            "POLL_INTERVAL": 1.0,
+        },
+    },
+    "shared": {
+        "BACKEND": "api.cache_backends.SQLiteCache",
+        "LOCATION": BASE_DIR / "cache.sqlite3",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# Резерв остатка при добавлении в корзину, секунд; 0 - без резервирования
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Товарный фид YML для маркетплейсов (см. api/feeds.py)
+PRODUCT_FEED = {
+    "PATH": BASE_DIR / "feeds" / "products.yml",
+    "SHOP_NAME": "FashionStore",
+    "COMPANY": "FashionStore",
+    "SITE_URL": "http://localhost:8000",
+    "PRODUCT_URL": "http://localhost:8000/api/products/{slug}/",
+}
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         # "rest_framework_simplejwt.authentication.JWTAuthentication",
@@ -99,6 +133,16 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.AllowAny",
         # "rest_framework.permissions.IsAuthenticated",  # Измените на IsAuthenticated по умолчанию
     ],
+    # Рендерер и парсер на orjson; без orjson работают как стандартные JSONRenderer/JSONParser
+    "DEFAULT_RENDERER_CLASSES": [
+        "api.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "api.renderers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend",
         "rest_framework.filters.SearchFilter",
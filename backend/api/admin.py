@@ -1,12 +1,11 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 from django.utils.html import format_html
-from django.db.models import Avg, Count
+from django.db.models import Count
 from django.urls import reverse
 from django.utils.http import urlencode
 from .utils import generate_order_pdf
-from .cache_utils import clear_product_cache
 
 from .models import (
     Product,
@@ -22,8 +21,10 @@ from .models import (
     WishlistItem,
     Cart,
     CartItem,
+    StockReservation,
     Order,
     OrderItem,
+    OrderStatusHistory,
 )
 
 
@@ -71,6 +72,17 @@ class ReviewInline(admin.TabularInline):
     can_delete = False
 
 
+class OrderStatusHistoryInline(admin.TabularInline):
+    model = OrderStatusHistory
+    extra = 0
+    fields = ["from_status", "to_status", "changed_by", "created_at"]
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
@@ -181,25 +193,12 @@ class ProductAdmin(admin.ModelAdmin):
     # filter_horizontal = ["tags"]
     date_hierarchy = "created_at"
 
-    @admin.display(description="Рейтинг")
+    @admin.display(description="Рейтинг", ordering="average_rating")
     def average_rating_display(self, obj):
         avg = obj.average_rating
         stars = "⭐️" * int(avg) + "☆" * (5 - int(avg))
         return format_html(f"{stars} ({avg:.1f})")
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(avg_rating=Avg("reviews__rating"))
-
-    def save_model(self, request, obj, form, change):
-        """Очищаем кеш при сохранении товара в админке"""
-        super().save_model(request, obj, form, change)
-        clear_product_cache()
-
-    def delete_model(self, request, obj):
-        """Очищаем кеш при удалении товара в админке"""
-        super().delete_model(request, obj)
-        clear_product_cache()
-
 
 @admin.register(ProductImage)
 class ProductImageAdmin(admin.ModelAdmin):
@@ -376,9 +375,13 @@ class CartAdmin(admin.ModelAdmin):
     inlines = [CartItemInline]
     search_fields = ["user__username", "user__email"]
 
+    def get_queryset(self, request):
+        # Сумма и количество считаются по загруженным заранее позициям
+        return super().get_queryset(request).select_related("user").prefetch_related("items__product")
+
     @admin.display(description="Товаров в корзине")
     def items_count(self, obj):
-        return obj.items.count()
+        return obj.items_count
 
     @admin.display(description="Общая стоимость")
     def total_price_display(self, obj):
@@ -397,6 +400,14 @@ class CartItemAdmin(admin.ModelAdmin):
         return f"{obj.total_price} ₽"
 
 
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ["product", "cart_item", "quantity", "expires_at"]
+    list_filter = ["expires_at"]
+    raw_id_fields = ["product", "cart_item"]
+    search_fields = ["product__name", "cart_item__cart__user__username"]
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     actions = ["mark_as_processing", "mark_as_shipped", "mark_as_delivered", "generate_pdf"]
@@ -407,7 +418,7 @@ class OrderAdmin(admin.ModelAdmin):
     raw_id_fields = ["user"]
     search_fields = ["order_number", "user__email", "user__username"]
     readonly_fields = ["order_number", "created_at", "updated_at", "total_amount_display", "user_info"]
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, OrderStatusHistoryInline]
     fieldsets = (
         ("Основная информация", {"fields": ("order_number", "user_info", "status", "total_amount_display")}),
         ("Детали доставки", {"fields": ("shipping_address", "phone_number", "customer_notes")}),
@@ -428,17 +439,39 @@ class OrderAdmin(admin.ModelAdmin):
         url = reverse("admin:auth_user_change", args=[obj.user.id])
         return format_html(f'<a href="{url}">{obj.user.username}</a> - {obj.user.email}')
 
+    def save_model(self, request, obj, form, change):
+        # Статус меняется только через машину состояний, остальные поля - как обычно
+        if change and "status" in form.changed_data:
+            new_status, obj.status = obj.status, form.initial["status"]
+            super().save_model(request, obj, form, change)
+            if not Order.objects.set_status(obj, new_status, changed_by=request.user):
+                self.message_user(
+                    request,
+                    f"Заказ {obj.order_number}: переход {obj.status} -> {new_status} недопустим",
+                    level=messages.ERROR,
+                )
+            return
+        super().save_model(request, obj, form, change)
+
+    def transition(self, request, queryset, status):
+        result = Order.objects.transition(queryset, status, changed_by=request.user)
+        self.message_user(request, f"Переведено заказов: {len(result['changed'])}")
+        if result["rejected"]:
+            self.message_user(
+                request, f"Недопустимый переход для {len(result['rejected'])} заказов", level=messages.WARNING
+            )
+
     @admin.action(description="Перевести в статус 'В обработке'")
     def mark_as_processing(self, request, queryset):
-        queryset.update(status="processing")
+        self.transition(request, queryset, "processing")
 
     @admin.action(description="Перевести в статус 'Отправлен'")
     def mark_as_shipped(self, request, queryset):
-        queryset.update(status="shipped")
+        self.transition(request, queryset, "shipped")
 
     @admin.action(description="Перевести в статус 'Доставлен'")
     def mark_as_delivered(self, request, queryset):
-        queryset.update(status="delivered")
+        self.transition(request, queryset, "delivered")
 
     # PDF Task
     change_form_template = "admin/order_change_form.html"
@@ -0,0 +1,183 @@
+"""Битовые индексы каталога в памяти процесса.
+
+Множество продуктов хранится как int, где бит N выставлен для продукта с id=N. Пересечение
+и объединение тегов, категорий, брендов и признака доступности сводятся к & и | над целыми,
+а количество - к int.bit_count(). Индекс строится двумя запросами и далее поддерживается
+сигналами Product и ProductTagRelationship. Изменения, сделанные другими процессами, видны по
+поколениям тегов кеша product и tag: индекс запоминает их при построении и перестраивается,
+как только они изменились (так же, как индекс подсказок в suggest.py).
+"""
+
+import json
+import threading
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# Теги кеша, поколения которых поднимаются при изменении данных индекса
+INDEX_TAGS = ("product", "tag")
+# Начиная с такого размера список id передается в SQL одним параметром
+INLINE_IDS_LIMIT = 500
+
+
+def from_ids(ids):
+    """Битовая карта из итерируемого id"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        buffer[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def to_ids(bitmap):
+    """Отсортированный список id, выставленных в битовой карте"""
+    bits = bin(bitmap)[:1:-1]
+    ids = []
+    position = bits.find("1")
+    while position != -1:
+        ids.append(position)
+        position = bits.find("1", position + 1)
+    return ids
+
+
+def id_filter(ids, field="pk"):
+    """Q(pk__in=ids), не упирающийся в лимит параметров SQL на больших списках"""
+    ids = list(ids)
+    if len(ids) <= INLINE_IDS_LIMIT:
+        return Q(**{f"{field}__in": ids})
+    if connection.vendor == "sqlite":
+        return Q(**{f"{field}__in": RawSQL("SELECT value FROM json_each(%s)", [json.dumps(ids)])})
+    if connection.vendor == "postgresql":
+        return Q(**{f"{field}__in": RawSQL("SELECT unnest(%s::bigint[])", [ids])})
+    return Q(**{f"{field}__in": ids})
+
+
+class CatalogBitmaps:
+    def __init__(self):
+        self.tags = {}
+        self.categories = {}
+        self.brands = {}
+        self.available = 0
+        self.products = {}  # id -> (category_id, brand_id, is_available)
+        self.generations = None
+
+    def build(self, generations=None):
+        from .models import Product, ProductTagRelationship
+
+        tags = {}
+        for tag_id, product_id in ProductTagRelationship.objects.values_list("tag_id", "product_id").iterator():
+            tags.setdefault(tag_id, []).append(product_id)
+
+        categories = {}
+        brands = {}
+        available = []
+        products = {}
+        rows = Product.objects.values_list("id", "category_id", "brand_id", "is_available")
+        for product_id, category_id, brand_id, is_available in rows.iterator(chunk_size=5000):
+            products[product_id] = (category_id, brand_id, is_available)
+            categories.setdefault(category_id, []).append(product_id)
+            brands.setdefault(brand_id, []).append(product_id)
+            if is_available:
+                available.append(product_id)
+
+        self.tags = {key: from_ids(ids) for key, ids in tags.items()}
+        self.categories = {key: from_ids(ids) for key, ids in categories.items()}
+        self.brands = {key: from_ids(ids) for key, ids in brands.items()}
+        self.available = from_ids(available)
+        self.products = products
+        self.generations = generations
+        return self
+
+    # Выборки
+
+    def tags_any(self, tag_ids):
+        bitmap = 0
+        for tag_id in tag_ids:
+            bitmap |= self.tags.get(tag_id, 0)
+        return bitmap
+
+    def tags_all(self, tag_ids):
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return 0
+        bitmap = self.tags.get(tag_ids[0], 0)
+        for tag_id in tag_ids[1:]:
+            bitmap &= self.tags.get(tag_id, 0)
+        return bitmap
+
+    def union(self, mapping, keys):
+        bitmap = 0
+        for key in keys:
+            bitmap |= mapping.get(key, 0)
+        return bitmap
+
+    # Инкрементальные изменения
+
+    @staticmethod
+    def _set(mapping, key, product_id, value):
+        bit = 1 << product_id
+        if value:
+            mapping[key] = mapping.get(key, 0) | bit
+        elif key in mapping:
+            mapping[key] &= ~bit
+
+    def add_tag(self, tag_id, product_id):
+        self._set(self.tags, tag_id, product_id, True)
+
+    def remove_tag(self, tag_id, product_id):
+        self._set(self.tags, tag_id, product_id, False)
+
+    def update_product(self, product_id, category_id, brand_id, is_available):
+        previous = self.products.get(product_id)
+        if previous is not None:
+            self._set(self.categories, previous[0], product_id, False)
+            self._set(self.brands, previous[1], product_id, False)
+        self._set(self.categories, category_id, product_id, True)
+        self._set(self.brands, brand_id, product_id, True)
+        bit = 1 << product_id
+        self.available = self.available | bit if is_available else self.available & ~bit
+        self.products[product_id] = (category_id, brand_id, is_available)
+
+    def remove_product(self, product_id):
+        previous = self.products.pop(product_id, None)
+        if previous is not None:
+            self._set(self.categories, previous[0], product_id, False)
+            self._set(self.brands, previous[1], product_id, False)
+        mask = ~(1 << product_id)
+        self.available &= mask
+        for tag_id in list(self.tags):
+            self.tags[tag_id] &= mask
+
+
+_bitmaps = None
+_lock = threading.Lock()
+
+
+def get_bitmaps():
+    from .cache_utils import get_generations
+
+    global _bitmaps
+    # Поколения читаются до построения: правка во время построения вызовет еще одно
+    generations = get_generations(INDEX_TAGS)
+    current = _bitmaps
+    if current is None or current.generations != generations:
+        with _lock:
+            if _bitmaps is current:
+                _bitmaps = CatalogBitmaps().build(generations)
+    return _bitmaps
+
+
+def update(callback):
+    """Применяет изменение к уже построенному индексу; если индекса нет, он построится при чтении"""
+    with _lock:
+        if _bitmaps is not None:
+            callback(_bitmaps)
+
+
+def reset():
+    global _bitmaps
+    with _lock:
+        _bitmaps = None
@@ -0,0 +1,367 @@
+"""Бэкенды кеша: общий для всех воркеров SQLite-файл и двухуровневый кеш поверх него.
+
+SQLiteCache хранит записи в отдельном файле SQLite, поэтому его видят все процессы на машине,
+а add и incr атомарны между ними. Кроме записей файл содержит журнал инвалидаций.
+
+TwoTierCache держит перед общим кешем (L2) маленький LRU в памяти процесса (L1) для горячих
+мелких объектов. Каждое изменение ключа записывается в журнал L2, а L1 не чаще раза
+в POLL_INTERVAL секунд дочитывает журнал и вытесняет измененные другими воркерами ключи.
+В худшем случае (гонка чтения с чужой записью) устаревшее значение живет в L1 не дольше L1_TIMEOUT.
+"""
+
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+ALIVE = "(expires IS NULL OR expires > ?)"
+
+
+class SQLiteCache(BaseCache):
+    """Кеш в файле SQLite. LOCATION - путь к файлу"""
+
+    # Сколько хранить записи журнала инвалидаций
+    LOG_RETENTION = 10 * 60
+    # Доля операций записи, после которых чистится просроченное
+    CULL_PROBABILITY = 0.01
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.location = str(location)
+        self._connection = None
+        self._schema_ready = False
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.location, timeout=10, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                self._connection.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS cache_entries (
+                        key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL
+                    );
+                    CREATE INDEX IF NOT EXISTS cache_entries_expires ON cache_entries (expires);
+                    CREATE TABLE IF NOT EXISTS cache_invalidations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, created REAL NOT NULL
+                    );
+                    """
+                )
+                self._schema_ready = True
+        return self._connection
+
+    def close(self, **kwargs):
+        """Django вызывает close() по request_finished; соединение откроется заново при следующем обращении"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _write(self, callback):
+        """Выполняет callback в транзакции с блокировкой на запись"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = callback(db)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+
+        def insert(db):
+            db.execute(f"DELETE FROM cache_entries WHERE key = ? AND NOT {ALIVE}", (key, time.time()))
+            return db.execute(
+                "INSERT OR IGNORE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)", (key, data, expires)
+            ).rowcount
+
+        return bool(self._write(insert))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._db()
+            .execute(f"SELECT value FROM cache_entries WHERE key = ? AND {ALIVE}", (key, time.time()))
+            .fetchone()
+        )
+        return default if row is None else pickle.loads(row[0])
+
+    def get_many(self, keys, version=None):
+        key_map = {self.make_and_validate_key(key, version=version): key for key in keys}
+        if not key_map:
+            return {}
+        placeholders = ", ".join("?" * len(key_map))
+        rows = self._db().execute(
+            f"SELECT key, value FROM cache_entries WHERE key IN ({placeholders}) AND {ALIVE}",
+            [*key_map, time.time()],
+        )
+        return {key_map[key]: pickle.loads(value) for key, value in rows}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+        self._write(
+            lambda db: db.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires) VALUES (?, ?, ?)", (key, data, expires)
+            )
+        )
+        self._maybe_cull()
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        return bool(
+            self._write(
+                lambda db: db.execute(
+                    f"UPDATE cache_entries SET expires = ? WHERE key = ? AND {ALIVE}", (expires, key, time.time())
+                ).rowcount
+            )
+        )
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return bool(self._write(lambda db: db.execute("DELETE FROM cache_entries WHERE key = ?", (key,)).rowcount))
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._db()
+            .execute(f"SELECT 1 FROM cache_entries WHERE key = ? AND {ALIVE}", (key, time.time()))
+            .fetchone()
+        )
+        return row is not None
+
+    def incr(self, key, delta=1, version=None):
+        """Атомарно между процессами: чтение и запись в одной транзакции BEGIN IMMEDIATE"""
+        key = self.make_and_validate_key(key, version=version)
+
+        def increment(db):
+            row = db.execute(f"SELECT value FROM cache_entries WHERE key = ? AND {ALIVE}", (key, time.time())).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            db.execute(
+                "UPDATE cache_entries SET value = ? WHERE key = ?", (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), key)
+            )
+            return value
+
+        return self._write(increment)
+
+    def clear(self):
+        self._write(lambda db: db.execute("DELETE FROM cache_entries"))
+
+    def _maybe_cull(self):
+        """Изредка удаляет просроченное, старый журнал и записи сверх max_entries"""
+        if random.random() >= self.CULL_PROBABILITY:
+            return
+        now = time.time()
+
+        def cull(db):
+            db.execute(f"DELETE FROM cache_entries WHERE NOT {ALIVE}", (now,))
+            db.execute("DELETE FROM cache_invalidations WHERE created < ?", (now - self.LOG_RETENTION,))
+            (count,) = db.execute("SELECT COUNT(*) FROM cache_entries").fetchone()
+            if count > self._max_entries:
+                db.execute(
+                    "DELETE FROM cache_entries WHERE key IN "
+                    "(SELECT key FROM cache_entries ORDER BY expires IS NULL, expires LIMIT ?)",
+                    (count - self._max_entries,),
+                )
+
+        self._write(cull)
+
+    # Журнал инвалидаций
+
+    def publish_invalidations(self, keys):
+        now = time.time()
+        self._write(
+            lambda db: db.executemany(
+                "INSERT INTO cache_invalidations (key, created) VALUES (?, ?)", [(key, now) for key in keys]
+            )
+        )
+
+    def invalidations_since(self, last_id):
+        """(новый last_id, ключи, полнота) - полнота ложна, если нужные записи журнала уже удалены"""
+        db = self._db()
+        if last_id is None:
+            (max_id,) = db.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()
+            return max_id, [], True
+        rows = db.execute("SELECT id, key FROM cache_invalidations WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        if not rows:
+            return last_id, [], True
+        complete = rows[0][0] == last_id + 1
+        return rows[-1][0], [key for _, key in rows], complete
+
+
+class _LocalStore:
+    """LRU с TTL в памяти процесса, общий для всех потоков"""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (pickled value, expires)
+        self.lock = threading.Lock()
+        self.last_id = None
+        self.polled_at = 0.0
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    """Двухуровневый кеш. LOCATION - имя L1 в процессе.
+
+    OPTIONS:
+        L2 - алиас общего кеша из CACHES;
+        L1_MAX_ENTRIES - размер L1;
+        L1_TIMEOUT - сколько секунд запись живет в L1;
+        L1_KEY_PREFIXES - какие ключи держать в L1 (по умолчанию - никакие);
+        POLL_INTERVAL - как часто дочитывать журнал инвалидаций.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.l2_alias = options.get("L2", "shared")
+        self.l1_max_entries = options.get("L1_MAX_ENTRIES", 1000)
+        self.l1_timeout = options.get("L1_TIMEOUT", 30)
+        self.l1_key_prefixes = tuple(options.get("L1_KEY_PREFIXES", ()))
+        self.poll_interval = options.get("POLL_INTERVAL", 1.0)
+        with _stores_lock:
+            self._store = _stores.setdefault(location, _LocalStore())
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def _local(self, key):
+        """Держать ли ключ (в том виде, в каком его передали в кеш) в L1"""
+        return key.startswith(self.l1_key_prefixes)
+
+    # L1
+
+    def _sync(self):
+        """Вытесняет из L1 ключи, измененные другими воркерами"""
+        store = self._store
+        now = time.monotonic()
+        if now - store.polled_at < self.poll_interval or not hasattr(self.l2, "invalidations_since"):
+            return
+        store.polled_at = now
+        last_id, keys, complete = self.l2.invalidations_since(store.last_id)
+        with store.lock:
+            if not complete:
+                store.entries.clear()
+            for key in keys:
+                store.entries.pop(key, None)
+            store.last_id = last_id
+
+    def _l1_get(self, local_key):
+        store = self._store
+        with store.lock:
+            entry = store.entries.get(local_key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del store.entries[local_key]
+                return None
+            store.entries.move_to_end(local_key)
+            return pickle.loads(entry[0])
+
+    def _l1_set(self, local_key, value, timeout=DEFAULT_TIMEOUT):
+        ttl = self.l1_timeout if timeout in (DEFAULT_TIMEOUT, None) else min(self.l1_timeout, timeout)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        store = self._store
+        with store.lock:
+            store.entries[local_key] = (data, time.monotonic() + ttl)
+            store.entries.move_to_end(local_key)
+            while len(store.entries) > self.l1_max_entries:
+                store.entries.popitem(last=False)
+
+    def _changed(self, local_key):
+        """Локально вытесняет ключ и сообщает о его изменении остальным воркерам"""
+        with self._store.lock:
+            self._store.entries.pop(local_key, None)
+        if hasattr(self.l2, "publish_invalidations"):
+            self.l2.publish_invalidations([local_key])
+
+    # API кеша
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.l2.add(key, value, timeout, version)
+        if added and self._local(key):
+            self._l1_set(self.make_and_validate_key(key, version=version), value, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        if not self._local(key):
+            return self.l2.get(key, default, version)
+        local_key = self.make_and_validate_key(key, version=version)
+        self._sync()
+        value = self._l1_get(local_key)
+        if value is None:
+            value = self.l2.get(key, None, version)
+            if value is None:
+                return default
+            self._l1_set(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._sync()
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._l1_get(self.make_and_validate_key(key, version=version)) if self._local(key) else None
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            for key, value in self.l2.get_many(missing, version).items():
+                found[key] = value
+                if self._local(key):
+                    self._l1_set(self.make_and_validate_key(key, version=version), value)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout, version)
+        if self._local(key):
+            local_key = self.make_and_validate_key(key, version=version)
+            self._changed(local_key)
+            self._l1_set(local_key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        deleted = self.l2.delete(key, version)
+        if self._local(key):
+            self._changed(self.make_and_validate_key(key, version=version))
+        return deleted
+
+    def has_key(self, key, version=None):
+        if self._local(key):
+            self._sync()
+            if self._l1_get(self.make_and_validate_key(key, version=version)) is not None:
+                return True
+        return self.l2.has_key(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.l2.incr(key, delta, version)
+        if self._local(key):
+            self._changed(self.make_and_validate_key(key, version=version))
+        return value
+
+    def clear(self):
+        """Очищает L2 и свой L1; L1 других воркеров истечет по L1_TIMEOUT"""
+        self.l2.clear()
+        with self._store.lock:
+            self._store.entries.clear()
@@ -1,40 +1,263 @@
+"""Кеширование с инвалидацией по тегам зависимостей.
+
+Каждая запись кеша помечается тегами ("product", "category", "product:42", ...). У каждого тега
+есть счетчик поколения, и поколения всех тегов записи входят в ее ключ. Инвалидация тега - это
+один incr счетчика: старые ключи просто перестают запрашиваться и вытесняются по таймауту,
+поэтому списки удаляемых ключей вести не нужно. Сигналы моделей (signals.py) поднимают
+поколения автоматически после коммита транзакции.
+
+Горячие записи защищены от лавинного пересчета: см. get_or_set.
+"""
+
+import functools
+import hashlib
+import math
+import random
+import threading
+import time
+from collections import Counter
+
 from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+
 from .models import Product, Category
-from django.conf import settings
 
+CACHE_PREFIX = "fs"
+# Теги, которыми помечаются данные каталога
+CATALOG_TAGS = ("product", "category", "brand", "tag", "review")
+
+
+def _generation_key(tag):
+    return f"{CACHE_PREFIX}:gen:{tag}"
+
+
+def _changed_key(tag):
+    return f"{CACHE_PREFIX}:changed:{tag}"
+
+
+def _initial_generation():
+    # Начальное значение зависит от времени: если счетчик вытеснен из кеша,
+    # новое поколение не совпадет ни с одним из уже использованных
+    return int(time.time() * 1000)
+
+
+def get_generations(tags):
+    """Текущие поколения тегов за одно обращение к кешу"""
+    keys = {tag: _generation_key(tag) for tag in tags}
+    values = cache.get_many(list(keys.values()))
+    generations = {}
+    for tag, key in keys.items():
+        if key not in values:
+            cache.add(key, _initial_generation(), None)
+            values[key] = cache.get(key)
+        generations[tag] = values[key]
+    return generations
+
+
+def invalidate(*tags):
+    """Инвалидирует все записи, помеченные любым из тегов"""
+    now = time.time()
+    for tag in tags:
+        key = _generation_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_generation(), None)
+    cache.set_many({_changed_key(tag): now for tag in tags}, None)
+
+
+def last_changed(tags):
+    """Время последней инвалидации любого из тегов (timestamp) или None, если она не записана"""
+    values = cache.get_many([_changed_key(tag) for tag in tags])
+    return max(values.values(), default=None)
+
+
+def generation_stamp(tags):
+    generations = get_generations(tags)
+    return ",".join(f"{tag}={generations[tag]}" for tag in sorted(generations))
+
+
+def make_key(namespace, key, tags):
+    """Ключ записи с учетом текущих поколений ее тегов"""
+    digest = hashlib.md5(f"{key}|{generation_stamp(tags)}".encode()).hexdigest()
+    return f"{CACHE_PREFIX}:{namespace}:{digest}"
+
+
+class CacheStats:
+    """Счетчики обращений к кешу по пространствам имен (в пределах процесса)"""
+
+    EVENTS = ("hit", "stale", "miss", "recompute", "early", "wait")
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, namespace, event):
+        with self._lock:
+            self._counts[namespace, event] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        result = {}
+        for (namespace, event), count in counts.items():
+            result.setdefault(namespace, dict.fromkeys(self.EVENTS, 0))[event] = count
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
 
+# Сколько держать запись после истечения срока свежести, чтобы было что отдать во время пересчета
+STALE_TTL = 10 * 60
+# Сколько живет блокировка пересчета, если воркер упал, не сняв ее
+LOCK_TIMEOUT = 30
+# Сколько ждать чужого пересчета, когда в кеше нет даже устаревшего значения
+LOCK_WAIT = 5
+LOCK_POLL_INTERVAL = 0.05
+
+
+_served = threading.local()
+
+
+def served_outdated():
+    """Отдавал ли get_or_set в этом потоке значение, собранное до инвалидации его тегов.
+
+    Такой ответ нельзя класть в кеш ответов и помечать ETag: ETag уже считается по новым поколениям.
+    """
+    return getattr(_served, "outdated", False)
+
+
+def reset_served_outdated():
+    _served.outdated = False
+
+
+def _should_refresh_early(entry, now, beta):
+    """Вероятностное досрочное истечение (XFetch): чем дороже пересчет и ближе срок, тем вероятнее"""
+    if beta <= 0:
+        return False
+    return now - entry["delta"] * beta * math.log(1.0 - random.random()) >= entry["expires"]
+
+
+def _recompute(namespace, cache_key, stamp, compute, timeout, lock_key=None, close_connection=False):
+    stats.record(namespace, "recompute")
+    try:
+        started = time.time()
+        value = compute()
+        finished = time.time()
+        entry = {"value": value, "stamp": stamp, "expires": finished + timeout, "delta": finished - started}
+        cache.set(cache_key, entry, timeout + STALE_TTL)
+        return value
+    finally:
+        if lock_key is not None:
+            cache.delete(lock_key)
+        if close_connection:
+            connection.close()
+
+
+def get_or_set(namespace, key, tags, compute, timeout=5 * 60, beta=1.0, background=False):
+    """Возвращает значение из кеша или вычисляет и кеширует его.
+
+    Пересчитывает только один воркер (блокировка через cache.add), остальные тем временем
+    получают устаревшее значение. Запись считается устаревшей по истечении timeout, после
+    инвалидации любого из тегов или досрочно по XFetch. С background=True устаревшее значение
+    отдается и самому пересчитывающему, а пересчет идет в фоновом потоке.
+    """
+    cache_key = f"{CACHE_PREFIX}:{namespace}:{hashlib.md5(str(key).encode()).hexdigest()}"
+    lock_key = f"{cache_key}:lock"
+    stamp = generation_stamp(tags)
+    entry = cache.get(cache_key)
+    now = time.time()
+
+    if entry is not None and entry["stamp"] == stamp:
+        if now < entry["expires"] and not _should_refresh_early(entry, now, beta):
+            stats.record(namespace, "hit")
+            return entry["value"]
+        if now < entry["expires"]:
+            stats.record(namespace, "early")
+
+    if entry is None:
+        stats.record(namespace, "miss")
+
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        if entry is not None and background:
+            stats.record(namespace, "stale")
+            if entry["stamp"] != stamp:
+                _served.outdated = True
+            threading.Thread(
+                target=_recompute,
+                args=(namespace, cache_key, stamp, compute, timeout, lock_key, True),
+                daemon=True,
+            ).start()
+            return entry["value"]
+        return _recompute(namespace, cache_key, stamp, compute, timeout, lock_key)
+
+    if entry is not None:
+        stats.record(namespace, "stale")
+        if entry["stamp"] != stamp:
+            _served.outdated = True
+        return entry["value"]
+
+    # Устаревшего значения нет, а пересчет уже идет: ждем его, но не дольше LOCK_WAIT
+    stats.record(namespace, "wait")
+    deadline = now + LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(cache_key)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["value"]
+    return _recompute(namespace, cache_key, stamp, compute, timeout)
+
+
+def cached(namespace, tags, timeout=5 * 60, beta=1.0, background=False):
+    """Декоратор: кеширует результат функции, ключ строится из аргументов"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = repr((args, sorted(kwargs.items())))
+            return get_or_set(namespace, key, tags, lambda: func(*args, **kwargs), timeout, beta, background)
+
+        return wrapper
+
+    return decorator
+
+
+@cached("featured_products", tags=("product", "category", "brand"), timeout=5 * 60, background=True)
 def get_featured_products():
     """Получает избранные товары с кешированием"""
-    cache_key = "featured_products"
-    featured_products = cache.get(cache_key)
-
-    if featured_products is None:
-        # Кеш пустой, получаем данные из БД
-        featured_products = list(
-            Product.objects.filter(is_featured=True, is_available=True)
-            .select_related("category", "brand")
-            .values("id", "name", "price", "slug", "category__name", "brand__name")
-        )
-        cache.set(cache_key, featured_products, 5 * 60)
-
-    return featured_products
+    return list(
+        Product.objects.filter(is_featured=True, is_available=True)
+        .select_related("category", "brand")
+        .values("id", "name", "price", "slug", "category__name", "brand__name")
+    )
 
 
+@cached("categories_with_counts", tags=("category", "product"), timeout=10 * 60, background=True)
 def get_categories_with_counts():
     """Получает категории с количеством товаров с кешированием"""
-    cache_key = "categories_with_counts"
-    categories = cache.get(cache_key)
-
-    if categories is None:
-        categories = list(
-            Category.objects.annotate(products_count=Count("products")).values("id", "name", "slug", "products_count")
+    # Поле модели products_count занято денормализованным счетчиком, поэтому аннотация считается
+    # под другим именем и отдается под прежним ключом products_count
+    return [
+        {"id": pk, "name": name, "slug": slug, "products_count": total}
+        for pk, name, slug, total in Category.objects.annotate(products_total=Count("products")).values_list(
+            "id", "name", "slug", "products_total"
         )
-        cache.set(cache_key, categories, 10 * 60)
-
-    return categories
+    ]
 
 
-def clear_product_cache():
-    """Очищает кеш связанный с товарами"""
-    cache.delete("featured_products")
-    cache.delete("categories_with_counts")
+@cached("category_tree", tags=("category", "product"), timeout=10 * 60)
+def get_category_tree():
+    """Полное дерево категорий со счетчиками товаров, один запрос на построение"""
+    tree = []
+    nodes = {}
+    rows = Category.objects.order_by("path").values("id", "name", "slug", "parent_id", "depth", "products_count")
+    for row in rows:
+        node = nodes[row["id"]] = {**row, "children": []}
+        siblings = nodes[row["parent_id"]]["children"] if row["parent_id"] in nodes else tree
+        siblings.append(node)
+    return tree
@@ -0,0 +1,98 @@
+"""Условные GET-запросы (ETag / Last-Modified) для вьюсетов каталога.
+
+Валидаторы считаются до сериализации: ETag - из поколений тегов кеша (см. cache_utils),
+максимального updated_at и параметров запроса, Last-Modified - из того же updated_at и времени
+последней инвалидации тегов. Если клиент прислал совпадающий If-None-Match или If-Modified-Since,
+вьюсет отвечает 304, не выполняя ни выборки, ни сериализации.
+"""
+
+import hashlib
+from urllib.parse import urlencode
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from .cache_utils import generation_stamp, last_changed, reset_served_outdated, served_outdated
+
+
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+    default_detail = "Not modified."
+
+
+def normalized_query(request):
+    """Параметры запроса в каноническом порядке"""
+    return urlencode(sorted((key, value) for key, values in request.query_params.lists() for value in values))
+
+
+class ConditionalGetMixin:
+    """Отвечает 304 на условные GET и HEAD, если данные не изменились.
+
+    Вьюсет задает conditional_tags - теги кеша, от которых зависит ответ, - и при необходимости
+    переопределяет get_conditional_state(), например, чтобы добавить updated_at или сузить теги
+    до конкретного объекта. Если get_conditional_state() возвращает None, запрос обрабатывается
+    как обычный.
+    """
+
+    conditional_tags = ()
+
+    def get_conditional_state(self):
+        """(теги, время последнего изменения в БД или None)"""
+        return self.conditional_tags, None
+
+    def get_validators(self, request):
+        state = self.get_conditional_state()
+        if state is None:
+            return None
+        tags, updated_at = state
+        changed_at = last_changed(tags)
+        if updated_at is not None:
+            updated_at = updated_at.timestamp()
+        last_modified = max((value for value in (updated_at, changed_at) if value is not None), default=None)
+
+        source = "|".join(
+            [
+                request.path,
+                normalized_query(request),
+                request.accepted_media_type or "",
+                "staff" if request.user.is_staff else "public",
+                generation_stamp(tags),
+                repr(updated_at),
+            ]
+        )
+        etag = '"%s"' % hashlib.md5(source.encode()).hexdigest()
+        return etag, int(last_modified) if last_modified is not None else None
+
+    def initial(self, request, *args, **kwargs):
+        reset_served_outdated()
+        super().initial(request, *args, **kwargs)
+        self.conditional_validators = None
+        if request.method in ("GET", "HEAD"):
+            self.conditional_validators = self.get_validators(request)
+            if self.conditional_validators is not None:
+                etag, last_modified = self.conditional_validators
+                response = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+                if response is not None and response.status_code == status.HTTP_304_NOT_MODIFIED:
+                    raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        validators = getattr(self, "conditional_validators", None)
+        if served_outdated():
+            # Тело собрано из значения до инвалидации - новый ETag закрепил бы его у клиента
+            validators = self.conditional_validators = None
+        if validators is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            etag, last_modified = validators
+            response["ETag"] = etag
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified)
+            patch_vary_headers(response, ("Accept", "Authorization", "Cookie"))
+        return response
@@ -0,0 +1,56 @@
+"""Пересборка документов продуктов (ProductDocument).
+
+Сигналы вызывают schedule внутри транзакции, а документы пересобираются в том же процессе сразу
+после ее коммита (transaction.on_commit) - очереди в памяти, которую мог бы потерять перезапуск
+воркера, нет. После пересборки поднимается тег кеша document:<id>, поэтому ETag и кеш ответов
+страницы продукта не переживают устаревший документ. Если пересборка все же не состоялась (упала
+или продукт изменили в обход сигналов), retrieve видит, что документ собран раньше updated_at
+продукта, и сериализует продукт напрямую.
+"""
+
+import logging
+from functools import partial
+
+from django.db import transaction
+
+from .cache_utils import invalidate
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild(product_ids):
+    from .models import ProductDocument
+
+    product_ids = list(product_ids)
+    ProductDocument.objects.rebuild(product_ids)
+    invalidate(*(f"document:{product_id}" for product_id in product_ids))
+
+
+def schedule(product_ids):
+    """Пересобирает документы продуктов после коммита текущей транзакции (вне транзакции - сразу)"""
+    product_ids = set(product_ids)
+    if product_ids:
+        transaction.on_commit(partial(_rebuild_committed, product_ids))
+
+
+def _rebuild_committed(product_ids):
+    # Данные уже закоммичены: ошибка пересборки не должна превращать успешный запрос в 500
+    try:
+        rebuild(product_ids)
+    except Exception:
+        logger.exception("Не удалось пересобрать документы продуктов %s", sorted(product_ids))
+
+
+def render(payload, request):
+    """Документ в том виде, в каком его отдал бы сериализатор с request в контексте.
+
+    primary_image сериализатор собирает без контекста, поэтому его ссылка остается относительной.
+    """
+    absolute = request.build_absolute_uri
+    for image in payload.get("images", []):
+        if image.get("image"):
+            image["image"] = absolute(image["image"])
+    for product_file in payload.get("files", []):
+        if product_file.get("file"):
+            product_file["file"] = absolute(product_file["file"])
+    return payload
@@ -0,0 +1,116 @@
+"""Потоковая выгрузка каталога в NDJSON, CSV и JSON-массивом.
+
+Строки читаются из БД пачками через iterator(chunk_size=...) и сразу отдаются клиенту
+через StreamingHttpResponse, поэтому память воркера не зависит от размера каталога.
+"""
+
+import csv
+import datetime
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from rest_framework import serializers
+
+from .renderers import FastJSONRenderer
+
+# (колонка выгрузки, путь в values_list)
+EXPORT_FIELDS = (
+    ("id", "id"),
+    ("name", "name"),
+    ("slug", "slug"),
+    ("brand", "brand__name"),
+    ("category", "category__name"),
+    ("price", "price"),
+    ("stock", "stock"),
+    ("is_available", "is_available"),
+    ("average_rating", "average_rating"),
+    ("review_count", "review_count"),
+    ("updated_at", "updated_at"),
+)
+CHUNK_SIZE = 2000
+# Сколько строк склеивать в один кусок ответа
+LINES_PER_WRITE = 500
+
+_datetime_field = serializers.DateTimeField()
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _plain(value):
+    """Значение в том виде, в каком его отдает API: Decimal - строкой, datetime - в ISO 8601"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return _datetime_field.to_representation(value)
+    return value
+
+
+def _rows(queryset):
+    if not queryset.ordered:
+        queryset = queryset.order_by("pk")
+    paths = [path for _, path in EXPORT_FIELDS]
+    for row in queryset.values_list(*paths).iterator(chunk_size=CHUNK_SIZE):
+        yield [_plain(value) for value in row]
+
+
+def _batched(lines, separator):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= LINES_PER_WRITE:
+            yield separator.join(batch)
+            batch = []
+    if batch:
+        yield separator.join(batch)
+
+
+def ndjson_lines(queryset):
+    renderer = FastJSONRenderer()
+    names = [name for name, _ in EXPORT_FIELDS]
+    for row in _rows(queryset):
+        yield renderer.render(dict(zip(names, row))) + b"\n"
+
+
+class _Echo:
+    """Псевдо-файл для csv.writer: writerow возвращает готовую строку"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in EXPORT_FIELDS])
+    for row in _rows(queryset):
+        yield writer.writerow(row)
+
+
+def export_products(queryset, export_format):
+    if export_format == "ndjson":
+        chunks = _batched(ndjson_lines(queryset), b"")
+    else:
+        chunks = _batched(csv_lines(queryset), "")
+    response = StreamingHttpResponse(chunks, content_type=CONTENT_TYPES[export_format])
+    response["Content-Disposition"] = f'attachment; filename="products.{export_format}"'
+    return response
+
+
+def _json_array(items):
+    yield b"["
+    separator = b""
+    for chunk in _batched(items, b","):
+        yield separator + chunk
+        separator = b","
+    yield b"]"
+
+
+def stream_json_array(queryset):
+    """Результат values() или values_list(flat=True) тем же JSON-массивом, что и Response(list(...)), но потоком"""
+    if not queryset.ordered:
+        queryset = queryset.order_by("pk")
+    renderer = FastJSONRenderer()
+    items = (renderer.render(row) for row in queryset.iterator(chunk_size=CHUNK_SIZE))
+    return StreamingHttpResponse(_json_array(items), content_type="application/json")
@@ -0,0 +1,75 @@
+"""Фасеты для списка и поиска продуктов.
+
+Каждый фасет считается одним GROUP BY по выборке, к которой применены все активные фильтры,
+кроме фильтра самого фасета - так счетчики остаются верными при множественном выборе.
+Итого четыре запроса независимо от количества значений в фасетах.
+"""
+
+from django.db.models import Count, Q
+
+from .models import ProductTagRelationship
+
+# Границы ценовых диапазонов; последний диапазон открыт сверху
+PRICE_BUCKETS = (0, 1000, 5000, 10000, 25000, 50000)
+
+FACET_PARAMS = {
+    "category": ("category",),
+    "brand": ("brand",),
+    "tags": ("tags",),
+    "price": ("price_min", "price_max"),
+}
+
+
+def _narrowed(queryset, params, filterset_class, exclude):
+    data = params.copy()
+    for param in exclude:
+        data.pop(param, None)
+    return filterset_class(data=data, queryset=queryset).qs.order_by()
+
+
+def price_buckets():
+    bounds = list(PRICE_BUCKETS) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def compute_facets(queryset, params, filterset_class):
+    """queryset - выборка до применения фильтров (с учетом поиска), params - QueryDict запроса"""
+    facets = {}
+
+    by_category = _narrowed(queryset, params, filterset_class, FACET_PARAMS["category"])
+    facets["category"] = [
+        {"id": row["category"], "name": row["category__name"], "slug": row["category__slug"], "count": row["count"]}
+        for row in by_category.values("category", "category__name", "category__slug")
+        .annotate(count=Count("pk"))
+        .order_by("-count", "category__name")
+    ]
+
+    by_brand = _narrowed(queryset, params, filterset_class, FACET_PARAMS["brand"])
+    facets["brand"] = [
+        {"id": row["brand"], "name": row["brand__name"], "slug": row["brand__slug"], "count": row["count"]}
+        for row in by_brand.values("brand", "brand__name", "brand__slug")
+        .annotate(count=Count("pk"))
+        .order_by("-count", "brand__name")
+    ]
+
+    by_tags = _narrowed(queryset, params, filterset_class, FACET_PARAMS["tags"])
+    facets["tags"] = [
+        {"id": row["tag"], "name": row["tag__name"], "color": row["tag__color"], "count": row["count"]}
+        for row in ProductTagRelationship.objects.filter(product__in=by_tags.values("pk"))
+        .values("tag", "tag__name", "tag__color")
+        .annotate(count=Count("product"))
+        .order_by("-count", "tag__name")
+    ]
+
+    by_price = _narrowed(queryset, params, filterset_class, FACET_PARAMS["price"])
+    buckets = price_buckets()
+    counts = by_price.aggregate(
+        **{
+            f"bucket_{i}": Count("pk", filter=Q(price__gte=low) & (Q(price__lt=high) if high is not None else Q()))
+            for i, (low, high) in enumerate(buckets)
+        }
+    )
+    facets["price"] = [
+        {"min": low, "max": high, "count": counts[f"bucket_{i}"]} for i, (low, high) in enumerate(buckets)
+    ]
+    return facets
@@ -0,0 +1,246 @@
+"""Товарный фид для маркетплейсов в формате YML (Яндекс.Маркет).
+
+Фид хранится файлом на диске и обновляется инкрементально. Каждое предложение <offer> занимает
+ровно одну строку, предложения отсортированы по id, поэтому обновление - это слияние трех
+отсортированных потоков: строк старого файла, id всех текущих продуктов и продуктов, изменившихся
+с прошлого запуска. Изменившимся считается продукт, у которого updated_at или built_at его
+документа (ProductDocument пересобирается при смене изображений, бренда, категории и т.п.) позже
+прошлого запуска. Новый файл пишется потоком во временный и атомарно подменяет старый, память не
+зависит от размера каталога. Время прошлого запуска хранится рядом с фидом в файле .state.json.
+
+Фид обновляет только команда build_product_feed (по cron), вьюха отдает готовый файл и никогда
+не строит его внутри запроса.
+"""
+
+import datetime
+import json
+import os
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .cache_utils import CACHE_PREFIX
+from .models import Category, Product, ProductImage
+
+DEFAULTS = {
+    "PATH": settings.BASE_DIR / "feeds" / "products.yml",
+    "SHOP_NAME": "FashionStore",
+    "COMPANY": "FashionStore",
+    "SITE_URL": "http://localhost:8000",
+    "PRODUCT_URL": "http://localhost:8000/api/products/{slug}/",
+    "CURRENCY": "RUR",
+}
+# Меняется вместе с разметкой предложения - старый фид тогда пересобирается целиком
+FEED_VERSION = 1
+CHUNK_SIZE = 2000
+# Запас на транзакции, которые закоммитились уже после начала прошлого запуска
+OVERLAP = datetime.timedelta(seconds=60)
+DESCRIPTION_LENGTH = 3000
+LOCK_KEY = f"{CACHE_PREFIX}:feed:lock"
+LOCK_TIMEOUT = 30 * 60
+
+OFFER_FIELDS = (
+    "id",
+    "slug",
+    "name",
+    "description",
+    "price",
+    "stock",
+    "is_available",
+    "category_id",
+    "brand__name",
+    "picture",
+)
+_OFFER_PREFIX = '<offer id="'
+# Переводы строк экранируются, чтобы предложение оставалось одной строкой файла
+_ENTITIES = {"\n": "&#10;", "\r": "&#13;"}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "PRODUCT_FEED", {})}
+
+
+def _state_path(path):
+    return path.with_name(path.name + ".state.json")
+
+
+def _read_state(path):
+    if not path.exists():
+        return None
+    try:
+        state = json.loads(_state_path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if state.get("version") != FEED_VERSION:
+        return None
+    return state
+
+
+def _write_atomic(path, lines):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8", buffering=1 << 20) as output:
+        output.writelines(lines)
+    os.replace(tmp, path)
+
+
+def _offers_queryset():
+    picture = (
+        ProductImage.objects.filter(product=OuterRef("pk")).order_by("-is_primary", "order", "id").values("image")[:1]
+    )
+    return Product.objects.annotate(picture=Subquery(picture)).order_by("pk").values_list(*OFFER_FIELDS)
+
+
+class OfferRenderer:
+    """Собирает строку <offer> из кортежа OFFER_FIELDS"""
+
+    def __init__(self, config):
+        self.product_url = config["PRODUCT_URL"]
+        self.media_url = config["SITE_URL"].rstrip("/") + settings.MEDIA_URL
+        self.currency = escape(config["CURRENCY"])
+
+    def __call__(self, row):
+        pk, slug, name, description, price, stock, is_available, category_id, vendor, picture = row
+        available = "true" if is_available and stock > 0 else "false"
+        parts = [
+            f'{_OFFER_PREFIX}{pk}" available="{available}">',
+            f"<url>{escape(self.product_url.format(slug=slug))}</url>",
+            f"<price>{price}</price>",
+            f"<currencyId>{self.currency}</currencyId>",
+            f"<categoryId>{category_id}</categoryId>",
+        ]
+        if picture:
+            parts.append(f"<picture>{escape(self.media_url + picture)}</picture>")
+        parts.append(f"<vendor>{escape(vendor, _ENTITIES)}</vendor>")
+        parts.append(f"<name>{escape(name, _ENTITIES)}</name>")
+        if description:
+            parts.append(f"<description>{escape(description[:DESCRIPTION_LENGTH], _ENTITIES)}</description>")
+        parts.append(f"<count>{stock}</count></offer>\n")
+        return "".join(parts)
+
+
+def _header(config, generated_at):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<yml_catalog date="{timezone.localtime(generated_at).strftime("%Y-%m-%dT%H:%M%z")}">\n'
+    yield "<shop>\n"
+    yield f"<name>{escape(config['SHOP_NAME'])}</name>\n"
+    yield f"<company>{escape(config['COMPANY'])}</company>\n"
+    yield f"<url>{escape(config['SITE_URL'])}</url>\n"
+    yield f'<currencies><currency id={quoteattr(config["CURRENCY"])} rate="1"/></currencies>\n'
+    yield "<categories>\n"
+    for pk, name, parent_id in Category.objects.order_by("pk").values_list("pk", "name", "parent_id"):
+        parent = f' parentId="{parent_id}"' if parent_id else ""
+        yield f'<category id="{pk}"{parent}>{escape(name, _ENTITIES)}</category>\n'
+    yield "</categories>\n"
+    yield "<offers>\n"
+
+
+def _footer():
+    yield "</offers>\n"
+    yield "</shop>\n"
+    yield "</yml_catalog>\n"
+
+
+def _old_offers(path):
+    """(id, строка) предложений существующего фида в порядке файла"""
+    with open(path, encoding="utf-8") as feed:
+        for line in feed:
+            if line.startswith(_OFFER_PREFIX):
+                yield int(line[len(_OFFER_PREFIX) : line.index('"', len(_OFFER_PREFIX))]), line
+
+
+class FeedBuilder:
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.path = Path(self.config["PATH"])
+        self.render = OfferRenderer(self.config)
+        self.counts = {"offers": 0, "rendered": 0, "removed": 0}
+
+    def _rendered(self, queryset):
+        for row in queryset.iterator(chunk_size=CHUNK_SIZE):
+            self.counts["rendered"] += 1
+            yield row[0], self.render(row)
+
+    def _full(self):
+        for _, line in self._rendered(_offers_queryset()):
+            self.counts["offers"] += 1
+            yield line
+
+    def _merged(self, since):
+        """Слияние старого фида, id текущих продуктов и изменившихся продуктов"""
+        end = (None, None)
+        old = _old_offers(self.path)
+        changed = self._rendered(_offers_queryset().filter(Q(updated_at__gt=since) | Q(document__built_at__gt=since)))
+        old_id, old_line = next(old, end)
+        changed_id, changed_line = next(changed, end)
+        current_ids = Product.objects.order_by("pk").values_list("pk", flat=True).iterator(chunk_size=CHUNK_SIZE * 5)
+
+        for pk in current_ids:
+            while old_id is not None and old_id < pk:
+                self.counts["removed"] += 1
+                old_id, old_line = next(old, end)
+            while changed_id is not None and changed_id < pk:
+                changed_id, changed_line = next(changed, end)
+
+            if changed_id == pk:
+                line = changed_line
+            elif old_id == pk:
+                line = old_line
+            else:
+                # Продукт появился между выборками - рисуем его отдельно
+                row = _offers_queryset().filter(pk=pk).first()
+                if row is None:
+                    continue
+                self.counts["rendered"] += 1
+                line = self.render(row)
+            if changed_id == pk:
+                changed_id, changed_line = next(changed, end)
+            if old_id == pk:
+                old_id, old_line = next(old, end)
+            self.counts["offers"] += 1
+            yield line
+
+        for _ in old:
+            self.counts["removed"] += 1
+        self.counts["removed"] += old_id is not None
+
+    def build(self, full=False):
+        """Обновляет фид на диске и возвращает счетчики: offers, rendered, removed, full"""
+        started_at = timezone.now()
+        state = None if full else _read_state(self.path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        full = state is None
+        if full:
+            offers = self._full()
+        else:
+            offers = self._merged(datetime.datetime.fromisoformat(state["synced_at"]) - OVERLAP)
+
+        def lines():
+            yield from _header(self.config, started_at)
+            yield from offers
+            yield from _footer()
+
+        _write_atomic(self.path, lines())
+        state = {"version": FEED_VERSION, "synced_at": started_at.isoformat(), "offers": self.counts["offers"]}
+        _write_atomic(_state_path(self.path), [json.dumps(state)])
+        return {**self.counts, "full": full}
+
+
+def build_feed(full=False):
+    """Обновляет фид; None, если его сейчас обновляет другой процесс"""
+    if not cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+        return None
+    try:
+        return FeedBuilder().build(full=full)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def get_feed_path():
+    """Путь к готовому фиду; None, если фид еще ни разу не строился"""
+    path = Path(get_config()["PATH"])
+    return path if path.exists() else None
@@ -0,0 +1,55 @@
+import django_filters
+from rest_framework import filters
+
+from . import bitmaps, search
+from .models import Product
+
+
+class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
+    pass
+
+
+class ProductFilter(django_filters.FilterSet):
+    """Фильтры списка продуктов. category, brand и tags принимают несколько значений через запятую"""
+
+    category = NumberInFilter(field_name="category", lookup_expr="in")
+    brand = NumberInFilter(field_name="brand", lookup_expr="in")
+    tags = NumberInFilter(method="filter_tags")
+    tags_mode = django_filters.ChoiceFilter(
+        choices=(("any", "Любой из тегов"), ("all", "Все теги")), method="filter_tags_mode"
+    )
+    price_min = django_filters.NumberFilter(field_name="price", lookup_expr="gte")
+    price_max = django_filters.NumberFilter(field_name="price", lookup_expr="lte")
+
+    class Meta:
+        model = Product
+        fields = ["category", "brand", "tags", "tags_mode", "price_min", "price_max", "is_available", "is_featured"]
+
+    def filter_tags(self, queryset, name, value):
+        """Теги фильтруются по битовому индексу, сразу пересеченному с категорией, брендом и наличием"""
+        if not value:
+            return queryset
+        index = bitmaps.get_bitmaps()
+        data = self.form.cleaned_data
+        bitmap = index.tags_all(value) if data.get("tags_mode") == "all" else index.tags_any(value)
+        if data.get("category"):
+            bitmap &= index.union(index.categories, data["category"])
+        if data.get("brand"):
+            bitmap &= index.union(index.brands, data["brand"])
+        if data.get("is_available") is not None:
+            bitmap &= index.available if data["is_available"] else ~index.available
+        return queryset.filter(bitmaps.id_filter(bitmaps.to_ids(bitmap)))
+
+    def filter_tags_mode(self, queryset, name, value):
+        # Учитывается в filter_tags
+        return queryset
+
+
+class ProductSearchFilter(filters.SearchFilter):
+    """SearchFilter для продуктов через полнотекстовый индекс вместо OR из icontains"""
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "")
+        if not query.strip():
+            return queryset
+        return search.filter_queryset(queryset, query)
@@ -0,0 +1,138 @@
+"""Идемпотентные POST-запросы по заголовку Idempotency-Key.
+
+Клиент, повторяющий запрос после таймаута, присылает тот же Idempotency-Key. Первый запрос с ключом
+занимает запись в кеше (cache.add), выполняется как обычно, и его ответ сохраняется на
+IDEMPOTENCY_TTL. Повтор получает сохраненный ответ с заголовком Idempotent-Replayed, не доходя до
+обработчика и таблиц заказов. Пока первый запрос еще выполняется, повтор получает 409, а ключ,
+присланный с другим телом запроса, - 422. Ответы 5xx не сохраняются, такой запрос можно повторить.
+
+Ключи живут в пространстве пользователя, у анонимного клиента - в пространстве его сессии.
+Анонимный запрос без сессии ключ прислать не может: отличить его от другого анонима не по чему.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from .cache_utils import CACHE_PREFIX
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# Сколько держать отметку "выполняется", если обработчик упал, не дойдя до ответа
+IN_PROGRESS_TIMEOUT = 60
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Запрос с этим Idempotency-Key еще выполняется."
+    default_code = "idempotency_conflict"
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "Idempotency-Key уже использован для другого запроса."
+    default_code = "idempotency_key_reused"
+
+
+class ReplayedResponse(Exception):
+    """Прерывает обработку запроса, когда ответ на этот ключ уже сохранен"""
+
+    def __init__(self, entry):
+        super().__init__()
+        self.entry = entry
+
+    def build_response(self):
+        response = HttpResponse(self.entry["content"], status=self.entry["status"])
+        if self.entry["content_type"]:
+            response["Content-Type"] = self.entry["content_type"]
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+
+class IdempotencyMixin:
+    """Делает POST-действия из idempotent_actions идемпотентными по заголовку Idempotency-Key"""
+
+    idempotent_actions = ()
+    idempotency_ttl = IDEMPOTENCY_TTL
+
+    def get_idempotency_key(self, request):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or request.method != "POST" or self.action not in self.idempotent_actions:
+            return None
+        if len(key) > MAX_KEY_LENGTH:
+            raise ValidationError({IDEMPOTENCY_HEADER: f"Не длиннее {MAX_KEY_LENGTH} символов."})
+        # Ключи разных пользователей (сессий) и разных действий не пересекаются
+        if request.user.is_authenticated:
+            owner = f"user:{request.user.pk}"
+        else:
+            session_key = getattr(request, "session", None) and request.session.session_key
+            if not session_key:
+                raise ValidationError({IDEMPOTENCY_HEADER: "Для анонимного запроса ключ действует только в сессии."})
+            owner = f"session:{session_key}"
+        scope = f"{owner}|{request.path}|{key}"
+        return f"{CACHE_PREFIX}:idempotency:{hashlib.md5(scope.encode()).hexdigest()}"
+
+    def initial(self, request, *args, **kwargs):
+        self.idempotency_key = None
+        super().initial(request, *args, **kwargs)
+        key = self.get_idempotency_key(request)
+        if key is None:
+            return
+
+        fingerprint = hashlib.md5(request._request.body).hexdigest()
+        if cache.add(key, {"fingerprint": fingerprint}, IN_PROGRESS_TIMEOUT):
+            self.idempotency_key = key
+            self.idempotency_fingerprint = fingerprint
+            return
+
+        entry = cache.get(key)
+        if entry is None or "status" not in entry:
+            raise IdempotencyConflict()
+        if entry["fingerprint"] != fingerprint:
+            raise IdempotencyKeyReused()
+        raise ReplayedResponse(entry)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, ReplayedResponse):
+            return exc.build_response()
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            # Необработанное исключение станет 500, а finalize_response уже не вызовется - освобождаем ключ здесь
+            self.release_idempotency_key()
+            raise
+
+    def release_idempotency_key(self):
+        if getattr(self, "idempotency_key", None) is not None:
+            cache.delete(self.idempotency_key)
+            self.idempotency_key = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(self, "idempotency_key", None)
+        if key is None:
+            return response
+        if response.status_code >= 500:
+            self.release_idempotency_key()
+            return response
+
+        fingerprint, timeout = self.idempotency_fingerprint, self.idempotency_ttl
+
+        def store(rendered):
+            entry = {
+                "fingerprint": fingerprint,
+                "status": rendered.status_code,
+                "content": rendered.content,
+                "content_type": rendered.get("Content-Type"),
+            }
+            cache.set(key, entry, timeout)
+
+        if hasattr(response, "add_post_render_callback"):
+            response.add_post_render_callback(store)
+        else:
+            store(response)
+        return response
@@ -0,0 +1,69 @@
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Order, Product
+from api.renderers import FastJSONRenderer, orjson
+from api.serializers import OrderSerializer, ProductDetailSerializer, ProductListSerializer
+
+
+class Command(BaseCommand):
+    help = "Сравнивает время рендеринга JSON стандартным рендерером DRF и FastJSONRenderer на данных каталога"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Сколько раз рендерить каждый набор (по умолчанию: 20)",
+        )
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write(self.style.WARNING("orjson не установлен - FastJSONRenderer работает как JSONRenderer"))
+
+        products = Product.objects.select_related("category", "brand").prefetch_related("images")
+        datasets = [
+            ("price_list", list(Product.objects.values("id", "name", "price", "category__name"))),
+            ("products (список)", ProductListSerializer(products, many=True).data),
+            (
+                "products (детально)",
+                ProductDetailSerializer(
+                    products.prefetch_related("files", "producttagrelationship_set__tag"), many=True
+                ).data,
+            ),
+            ("orders", OrderSerializer(Order.objects.prefetch_related("items__product"), many=True).data),
+        ]
+
+        standard = JSONRenderer()
+        fast = FastJSONRenderer()
+        repeat = options["repeat"]
+        mismatches = 0
+        self.stdout.write(f"{'Набор':<22}{'Объектов':>10}{'Размер, КБ':>12}{'json, мс':>11}{'fast, мс':>11}{'Ускорение':>11}")
+        for name, data in datasets:
+            expected = standard.render(data)
+            if fast.render(data) != expected:
+                self.stdout.write(self.style.ERROR(f"{name}: вывод рендереров различается"))
+                mismatches += 1
+                continue
+            standard_time = self._measure(standard, data, repeat)
+            fast_time = self._measure(fast, data, repeat)
+            speedup = standard_time / fast_time if fast_time else 0
+            self.stdout.write(
+                f"{name:<22}{len(data):>10}{len(expected) / 1024:>12.1f}"
+                f"{standard_time * 1000:>11.2f}{fast_time * 1000:>11.2f}{speedup:>10.1f}x"
+            )
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("Вывод обоих рендереров совпадает побайтно"))
+
+    @staticmethod
+    def _measure(renderer, data, repeat):
+        """Лучшее время одного рендеринга из repeat попыток"""
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            renderer.render(data)
+            best = min(best, time.perf_counter() - started)
+        return best
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.feeds import build_feed, get_config
+
+
+class Command(BaseCommand):
+    help = "Обновляет товарный фид YML для маркетплейсов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Пересобрать фид целиком, не используя предыдущий файл",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        counts = build_feed(full=options["full"])
+        elapsed = time.perf_counter() - started
+        if counts is None:
+            self.stdout.write(self.style.WARNING("Фид уже обновляет другой процесс"))
+            return
+
+        mode = "пересобран целиком" if counts["full"] else "обновлен"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Фид {mode} за {elapsed:.1f} с: {counts['offers']} предложений, "
+                f"перерисовано {counts['rendered']}, удалено {counts['removed']} ({get_config()['PATH']})"
+            )
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import ProductDocument
+
+
+class Command(BaseCommand):
+    help = "Пересобирает готовые документы страниц продуктов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Размер пачки при сборке (по умолчанию: 200)",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            built = ProductDocument.objects.rebuild(batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(f"Собрано {built} документов продуктов"))
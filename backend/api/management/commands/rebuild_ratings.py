@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает хранимые агрегаты рейтинга продуктов по таблице отзывов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Размер пачки для bulk_update (по умолчанию: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = Product.objects.rebuild_ratings(batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(f"Пересчитаны рейтинги {updated} продуктов"))
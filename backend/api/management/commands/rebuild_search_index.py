@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api import search
+
+
+class Command(BaseCommand):
+    help = "Полностью перестраивает полнотекстовый индекс продуктов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Размер пачки при индексации (по умолчанию: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        if not search.is_enabled():
+            self.stdout.write(self.style.WARNING("Полнотекстовый индекс поддерживается только на SQLite"))
+            return
+
+        with transaction.atomic():
+            indexed = search.index_products(batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(f"Проиндексировано {indexed} продуктов"))
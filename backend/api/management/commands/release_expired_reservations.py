@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.models import StockReservation
+
+
+class Command(BaseCommand):
+    help = "Удаляет истекшие резервы товаров в корзинах"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Сколько резервов удалять за один запрос (по умолчанию: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        released = StockReservation.objects.release_expired(batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS(f"Снято {released} истекших резервов"))
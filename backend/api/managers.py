@@ -1,12 +1,49 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg, Q
+from django.db.models import Avg, Case, Count, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
 from django.utils import timezone
 from uuid import uuid4
 from django.core.exceptions import ValidationError
 
 
+class InsufficientStock(ValidationError):
+    """Не хватает остатков; lines - строки, которые не удалось зарезервировать"""
+
+    def __init__(self, lines):
+        super().__init__("Недостаточно товара на складе", code="insufficient_stock")
+        self.lines = lines
+
+
+def _stock_changed(product_ids):
+    """UPDATE остатков минует сигналы - поднимаем теги кеша и пересобираем документы сами"""
+    from . import documents
+    from .cache_utils import invalidate
+
+    product_ids = list(product_ids)
+    transaction.on_commit(lambda: invalidate("product", *(f"product:{pk}" for pk in product_ids)))
+    documents.schedule(product_ids)
+
+
+def _per_product(quantities):
+    return Case(
+        *(When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()),
+        output_field=IntegerField(),
+    )
+
+
+def _held_elsewhere(cart_id=None):
+    """Выражение: сколько единиц продукта держат активные резервы корзин, кроме cart_id"""
+    from .models import StockReservation
+
+    holds = StockReservation.objects.active().filter(product=OuterRef("pk"))
+    if cart_id is not None:
+        holds = holds.exclude(cart_item__cart_id=cart_id)
+    total = holds.order_by().values("product").annotate(total=Sum("quantity")).values("total")
+    return Coalesce(Subquery(total, output_field=IntegerField()), 0)
+
+
 class ProductManager(models.Manager):
     def available(self):
         """Только доступные продукты"""
@@ -22,24 +59,317 @@ class ProductManager(models.Manager):
 
     def with_high_rating(self, min_rating=4.0):
         """Продукты с высоким рейтингом"""
-        return (
-            self.filter(is_available=True)
-            .annotate(avg_rating=Avg("reviews__rating"))
-            .filter(avg_rating__gte=min_rating)
+        return self.filter(is_available=True, average_rating__gte=min_rating)
+
+    def apply_rating_change(self, product_id, added=None, removed=None):
+        """Инкрементально обновляет агрегаты рейтинга одним UPDATE.
+
+        added - оценка нового отзыва, removed - оценка удаленного (или старая оценка измененного отзыва).
+        """
+        delta_sum = (added or 0) - (removed or 0)
+        delta_count = (added is not None) - (removed is not None)
+
+        updates = {}
+        for rating, delta in ((added, 1), (removed, -1)):
+            if rating is not None:
+                field = f"rating_{rating}_count"
+                updates[field] = updates.get(field, F(field)) + delta
+
+        new_count = F("review_count") + delta_count
+        updates["rating_sum"] = F("rating_sum") + delta_sum
+        updates["review_count"] = new_count
+        updates["average_rating"] = Case(
+            When(Q(review_count__gt=-delta_count), then=Cast(F("rating_sum") + delta_sum, FloatField()) / new_count),
+            default=Value(0.0),
+            output_field=FloatField(),
         )
+        return self.filter(pk=product_id).update(**updates)
+
+    def reserve_stock(self, quantities, cart_id=None):
+        """Списывает остатки одним условным UPDATE ... SET stock = stock - n WHERE stock - h >= n.
+
+        quantities - {id продукта: количество}, h - активные резервы других корзин (резервы корзины
+        cart_id принадлежат самому покупателю и не мешают). Списание происходит, только если хватает
+        всех строк; иначе изменения откатываются до точки сохранения и возвращается список
+        нехватающих строк [(id продукта, запрошено, доступно)]. Пустой список - все списано.
+        """
+        quantities = {pk: quantity for pk, quantity in quantities.items() if quantity}
+        if not quantities:
+            return []
+        needed = _per_product(quantities)
+        with transaction.atomic():
+            updated = (
+                self.filter(pk__in=quantities, stock__gte=needed + _held_elsewhere(cart_id))
+                .update(stock=F("stock") - needed, updated_at=timezone.now())
+            )
+            if updated == len(quantities):
+                _stock_changed(quantities)
+                return []
+            transaction.set_rollback(True)
+
+        available = self.available_to_sell(quantities, cart_id)
+        return [
+            (pk, quantity, available.get(pk, 0))
+            for pk, quantity in quantities.items()
+            if available.get(pk, 0) < quantity
+        ]
+
+    def available_to_sell(self, product_ids, cart_id=None):
+        """{id продукта: остаток за вычетом активных резервов других корзин}"""
+        queryset = self.filter(pk__in=product_ids).annotate(free=F("stock") - _held_elsewhere(cart_id))
+        return {pk: max(free, 0) for pk, free in queryset.values_list("pk", "free")}
+
+    def restock(self, quantities):
+        """Возвращает товары на склад одним UPDATE; quantities - {id продукта: количество}"""
+        quantities = {pk: quantity for pk, quantity in quantities.items() if quantity}
+        if quantities:
+            increment = _per_product(quantities)
+            self.filter(pk__in=quantities).update(stock=F("stock") + increment, updated_at=timezone.now())
+            _stock_changed(quantities)
+
+    def rebuild_ratings(self, queryset=None, batch_size=1000):
+        """Полностью пересчитывает агрегаты рейтинга по таблице отзывов"""
+        queryset = self.all() if queryset is None else queryset
+        fields = ["rating_sum", "review_count", "average_rating"] + [f"rating_{r}_count" for r in range(1, 6)]
+        stats = queryset.order_by("pk").annotate(
+            calc_sum=models.Sum("reviews__rating", default=0),
+            calc_count=Count("reviews"),
+            **{f"calc_{r}": Count("reviews", filter=Q(reviews__rating=r)) for r in range(1, 6)},
+        )
+
+        batch = []
+        updated = 0
+        for product in stats.iterator(chunk_size=batch_size):
+            product.rating_sum = product.calc_sum
+            product.review_count = product.calc_count
+            product.average_rating = product.calc_sum / product.calc_count if product.calc_count else 0
+            for r in range(1, 6):
+                setattr(product, f"rating_{r}_count", getattr(product, f"calc_{r}"))
+            batch.append(product)
+            if len(batch) >= batch_size:
+                updated += self.bulk_update(batch, fields)
+                batch = []
+        if batch:
+            updated += self.bulk_update(batch, fields)
+        return updated
 
     def search(self, query):
-        """Поиск продуктов"""
-        return self.filter(
-            Q(name__icontains=query)
-            | Q(description__icontains=query)
-            | Q(brand__name__icontains=query)
-            | Q(category__name__icontains=query),
-            is_available=True,
+        """Поиск продуктов по полнотекстовому индексу"""
+        from .search import filter_queryset
+
+        return filter_queryset(self.filter(is_available=True), query)
+
+
+class ProductImageManager(models.Manager):
+    def primary_for(self, product_ids):
+        """Основные изображения для набора продуктов одним запросом.
+
+        Если основное изображение не отмечено, берется изображение с наименьшим order.
+        """
+        primary = {}
+        images = self.filter(product_id__in=set(product_ids)).order_by("product_id", "-is_primary", "order", "id")
+        for image in images:
+            primary.setdefault(image.product_id, image)
+        return primary
+
+    def attach_primary(self, products):
+        """Проставляет продуктам атрибут _primary_image, догружая недостающие одним запросом"""
+        missing = [
+            product
+            for product in products
+            if product is not None
+            and not hasattr(product, "_primary_image")
+            and "images" not in getattr(product, "_prefetched_objects_cache", {})
+        ]
+        if missing:
+            primary = self.primary_for(product.pk for product in missing)
+            for product in missing:
+                product._primary_image = primary.get(product.pk)
+        return products
+
+
+class ProductDocumentManager(models.Manager):
+    def rebuild(self, product_ids=None, batch_size=200):
+        """Пересобирает документы продуктов (или всего каталога, если product_ids=None).
+
+        Документ - это готовый ответ ProductDetailSerializer, поэтому retrieve отдает его без
+        запросов к связанным таблицам и без сериализации.
+        """
+        from .models import Product, ProductTagRelationship
+        from .serializers import ProductDetailSerializer
+
+        queryset = (
+            Product.objects.select_related("category", "brand")
+            .prefetch_related(
+                "images",
+                "files",
+                models.Prefetch(
+                    "producttagrelationship_set", queryset=ProductTagRelationship.objects.select_related("tag")
+                ),
+            )
+            .order_by("pk")
         )
+        if product_ids is not None:
+            queryset = queryset.filter(pk__in=list(product_ids))
+
+        built = 0
+        documents = []
+        for product in queryset.iterator(chunk_size=batch_size):
+            payload = ProductDetailSerializer(product).data
+            documents.append(
+                self.model(product=product, slug=product.slug, is_available=product.is_available, payload=payload)
+            )
+            if len(documents) >= batch_size:
+                built += self._save(documents)
+                documents = []
+        if documents:
+            built += self._save(documents)
+        return built
+
+    def _save(self, documents):
+        self.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=["product"],
+            update_fields=["slug", "is_available", "payload", "built_at"],
+        )
+        return len(documents)
+
+
+class CartManager(models.Manager):
+    def sync(self, cart, operations, reservation_ttl=0):
+        """Применяет к корзине пачку операций одной транзакцией.
+
+        operations - словари {"op": "add" | "set" | "remove", "product": id, "quantity": n}
+        в порядке применения; set с количеством 0 удаляет позицию. Остатки всех позиций, которые
+        увеличиваются, проверяются одним запросом (строки продуктов блокируются там, где это
+        поддерживается); при нехватке выбрасывается InsufficientStock и корзина не меняется.
+        Изменения записываются одним bulk_create, одним bulk_update и одним DELETE; при
+        reservation_ttl резервы всех позиций корзины ставятся или продлеваются одним запросом.
+        """
+        from .models import CartItem, Product, StockReservation
+
+        with transaction.atomic():
+            lines = CartItem.objects.filter(cart=cart).only("id", "product_id", "quantity")
+            items = {item.product_id: item for item in lines}
+            target = {product_id: item.quantity for product_id, item in items.items()}
+            for operation in operations:
+                product_id, quantity = operation["product"], operation.get("quantity", 0)
+                if operation["op"] == "add":
+                    target[product_id] = target.get(product_id, 0) + quantity
+                elif operation["op"] == "set" and quantity:
+                    target[product_id] = quantity
+                else:
+                    target.pop(product_id, None)
+
+            growing = {
+                product_id: quantity
+                for product_id, quantity in target.items()
+                if product_id not in items or quantity > items[product_id].quantity
+            }
+            if growing:
+                # Несуществующий продукт считается продуктом с нулевым остатком
+                free = dict.fromkeys(growing, (None, 0))
+                stocks = (
+                    Product.objects.select_for_update()
+                    .filter(pk__in=growing)
+                    .annotate(available=F("stock") - _held_elsewhere(cart.pk))
+                    .values_list("pk", "name", "available")
+                )
+                free.update((pk, (name, max(available, 0))) for pk, name, available in stocks)
+                shortages = [
+                    {"product": pk, "name": free[pk][0], "requested": quantity, "available": free[pk][1]}
+                    for pk, quantity in growing.items()
+                    if quantity > free[pk][1]
+                ]
+                if shortages:
+                    raise InsufficientStock(shortages)
+
+            created = [
+                CartItem(cart=cart, product_id=product_id, quantity=quantity)
+                for product_id, quantity in target.items()
+                if product_id not in items
+            ]
+            updated = []
+            for product_id, item in items.items():
+                if product_id in target and target[product_id] != item.quantity:
+                    item.quantity = target[product_id]
+                    updated.append(item)
+            removed = [item.pk for product_id, item in items.items() if product_id not in target]
+
+            if created:
+                CartItem.objects.bulk_create(created)
+            if updated:
+                CartItem.objects.bulk_update(updated, ["quantity"])
+            if removed:
+                CartItem.objects.filter(pk__in=removed).delete()
+
+            if reservation_ttl and target:
+                expires_at = timezone.now() + timezone.timedelta(seconds=reservation_ttl)
+                kept = [item for product_id, item in items.items() if product_id in target] + created
+                StockReservation.objects.bulk_create(
+                    [
+                        StockReservation(
+                            cart_item=item, product_id=item.product_id, quantity=item.quantity, expires_at=expires_at
+                        )
+                        for item in kept
+                    ],
+                    update_conflicts=True,
+                    unique_fields=["cart_item"],
+                    update_fields=["quantity", "expires_at"],
+                )
+
+
+class StockReservationManager(models.Manager):
+    def active(self):
+        """Не истекшие резервы"""
+        return self.filter(expires_at__gt=timezone.now())
+
+    def hold(self, cart_item, quantity, ttl):
+        """Резервирует quantity единиц под позицию корзины на ttl секунд.
+
+        Строка продукта блокируется на время проверки (на бэкендах с SELECT ... FOR UPDATE),
+        поэтому две корзины не займут одни и те же последние единицы. Резервы остальных позиций
+        той же корзины продлеваются. При нехватке выбрасывается InsufficientStock.
+        """
+        from .models import Product
+
+        product_id = cart_item.product_id
+        expires_at = timezone.now() + timezone.timedelta(seconds=ttl)
+        with transaction.atomic():
+            stock = Product.objects.select_for_update().values_list("stock", flat=True).get(pk=product_id)
+            held = (
+                self.active()
+                .filter(product_id=product_id)
+                .exclude(cart_item__cart_id=cart_item.cart_id)
+                .aggregate(total=Sum("quantity"))["total"]
+            )
+            available = max(stock - (held or 0), 0)
+            if quantity > available:
+                line = {"product": product_id, "requested": quantity, "available": available}
+                raise InsufficientStock([{**line, "name": cart_item.product.name}])
+
+            self.update_or_create(
+                cart_item=cart_item, defaults={"product_id": product_id, "quantity": quantity, "expires_at": expires_at}
+            )
+            self.filter(cart_item__cart_id=cart_item.cart_id).exclude(cart_item=cart_item).update(expires_at=expires_at)
+
+    def release_expired(self, batch_size=1000):
+        """Удаляет истекшие резервы пачками по индексу expires_at; возвращает количество удаленных"""
+        now = timezone.now()
+        released = 0
+        while True:
+            expired = self.filter(expires_at__lte=now).order_by("expires_at")
+            ids = list(expired.values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                return released
+            released += self.filter(pk__in=ids).delete()[0]
 
 
 class OrderManager(models.Manager):
+    # Статусы, в которых товары заказа уже вернулись на склад
+    RESTOCKED_STATUSES = ("cancelled", "refunded")
+
     def pending(self):
         """Ожидающие обработки заказы"""
         return self.filter(status="pending")
@@ -53,6 +383,128 @@ class OrderManager(models.Manager):
         cutoff_date = timezone.now() - timezone.timedelta(days=days)
         return self.filter(created_at__gte=cutoff_date)
 
+    def create_from_cart(self, cart_id, user, **fields):
+        """Оформляет заказ из корзины одной транзакцией.
+
+        Позиции корзины читаются вместе с продуктами одним запросом, остатки списываются одним
+        условным UPDATE, строки заказа создаются одним bulk_create, сумма считается в том же
+        проходе, и заказ записывается один раз. Позиции удаляются из корзины в той же транзакции;
+        если их уже забрал параллельный запрос, транзакция откатывается. Если товара не хватает,
+        выбрасывается InsufficientStock со списком нехватающих строк.
+        """
+        from .models import Cart, CartItem, OrderItem, Product
+
+        with transaction.atomic():
+            cart_items = list(
+                CartItem.objects.select_for_update()
+                .filter(cart_id=cart_id, cart__user=user)
+                .select_related("product")
+                .only("id", "quantity", "product__id", "product__name", "product__price")
+            )
+            if not cart_items:
+                if not Cart.objects.filter(id=cart_id, user=user).exists():
+                    raise ValidationError("Корзина не найдена")
+                raise ValidationError("Корзина пуста")
+
+            quantities = {item.product.id: item.quantity for item in cart_items}
+            shortages = Product.objects.reserve_stock(quantities, cart_id=cart_id)
+            if shortages:
+                names = {item.product.id: item.product.name for item in cart_items}
+                raise InsufficientStock(
+                    [
+                        {"product": pk, "name": names[pk], "requested": requested, "available": available}
+                        for pk, requested, available in shortages
+                    ]
+                )
+
+            order = self.model(user=user, stock_reserved=True, **fields)
+            order_items = [
+                OrderItem(order=order, product=item.product, quantity=item.quantity, price=item.product.price)
+                for item in cart_items
+            ]
+            order.total_amount = sum(item.total_price for item in order_items)
+            order.save(force_insert=True)
+            OrderItem.objects.bulk_create(order_items)
+
+            # Вместе с позициями каскадом снимаются и их резервы - считаем только позиции
+            _, deleted = CartItem.objects.filter(id__in=[item.id for item in cart_items]).delete()
+            if deleted.get(CartItem._meta.label, 0) != len(cart_items):
+                raise ValidationError("Корзина изменилась во время оформления заказа, повторите попытку")
+        return order
+
+    def transition(self, orders, status, changed_by=None, allowed_from=None):
+        """Переводит заказы в статус status по графу Order.TRANSITIONS.
+
+        orders - queryset заказов (или их id). Текущие статусы читаются одним запросом, затем на
+        каждый исходный статус выполняется один UPDATE ... WHERE status = <исходный>, поэтому
+        заказ, статус которого успел поменять параллельный запрос, не перескочит через граф.
+        Товары заказов, впервые переходящих в cancelled или refunded и списавших остаток при
+        оформлении (stock_reserved), возвращаются на склад одним UPDATE, а все переходы пишутся
+        в OrderStatusHistory одним bulk_create.
+
+        Возвращает {"changed": [id], "rejected": {id: текущий статус}}. Переданные списком id, которых
+        нет в базе, попадают в rejected со статусом None. allowed_from дополнительно сужает допустимые
+        исходные статусы.
+        """
+        from .models import OrderItem, OrderStatusHistory, Product
+
+        sources = {source for source, targets in self.model.TRANSITIONS.items() if status in targets}
+        if allowed_from is not None:
+            sources &= set(allowed_from)
+        if isinstance(orders, models.QuerySet):
+            requested = None
+            orders = self.filter(pk__in=orders.values("pk"))
+        else:
+            requested = set(orders)
+            orders = self.filter(pk__in=requested)
+
+        now = timezone.now()
+        changed, rejected, history = [], {}, []
+        with transaction.atomic():
+            by_source = {}
+            for pk, current in orders.select_for_update().values_list("pk", "status"):
+                if current in sources:
+                    by_source.setdefault(current, []).append(pk)
+                else:
+                    rejected[pk] = current
+            if requested is not None:
+                found = {pk for ids in by_source.values() for pk in ids} | set(rejected)
+                rejected.update((pk, None) for pk in requested - found)
+
+            for source, ids in by_source.items():
+                updated = self.filter(pk__in=ids, status=source).update(status=status, updated_at=now)
+                if updated != len(ids):
+                    # Часть заказов поменял параллельный запрос - узнаем, какие перевели мы, и статус остальных
+                    moved = set(self.filter(pk__in=ids, status=status, updated_at=now).values_list("pk", flat=True))
+                    current = dict(self.filter(pk__in=ids).exclude(pk__in=moved).values_list("pk", "status"))
+                    rejected.update((pk, current.get(pk)) for pk in ids if pk not in moved)
+                    ids = [pk for pk in ids if pk in moved]
+                changed += ids
+                history += [
+                    OrderStatusHistory(
+                        order_id=pk, from_status=source, to_status=status, changed_by=changed_by, created_at=now
+                    )
+                    for pk in ids
+                ]
+
+            if status in self.RESTOCKED_STATUSES:
+                restocked = [entry.order_id for entry in history if entry.from_status not in self.RESTOCKED_STATUSES]
+                if restocked:
+                    # Заказы, оформленные до списания остатков при оформлении, на склад ничего не возвращают
+                    items = OrderItem.objects.filter(order_id__in=restocked, order__stock_reserved=True)
+                    items = items.values_list("product_id")
+                    Product.objects.restock(dict(items.annotate(Sum("quantity"))))
+            OrderStatusHistory.objects.bulk_create(history)
+
+        return {"changed": changed, "rejected": rejected}
+
+    def set_status(self, order, status, changed_by=None, allowed_from=None):
+        """Переводит один заказ; False, если переход из его текущего статуса недопустим"""
+        if order.pk not in self.transition([order.pk], status, changed_by, allowed_from)["changed"]:
+            return False
+        order.refresh_from_db(fields=["status", "updated_at"])
+        return True
+
 
 class ReviewManager(models.Manager):
     def approved(self):
@@ -72,3 +524,41 @@ class CategoryManager(models.Manager):
     def main_categories(self):
         """Основные категории (без родительских)"""
         return self.filter(parent__isnull=True)
+
+    def subtree(self, category, include_self=True):
+        """Категория и все ее потомки - диапазонный запрос по индексу path"""
+        # "/" + 1 == "0", поэтому все пути поддерева лежат в [path, path[:-1] + "0")
+        queryset = self.filter(path__gte=category.path, path__lt=category.path[:-1] + "0")
+        if not include_self:
+            queryset = queryset.exclude(pk=category.pk)
+        return queryset
+
+    def ancestors(self, category, include_self=False):
+        """Предки категории от корня"""
+        ids = category.ancestor_ids + ([category.pk] if include_self else [])
+        return self.filter(pk__in=ids).order_by("depth")
+
+    def move_subtree(self, old_path, new_path, depth_delta, products_count):
+        """Переносит потомков вслед за категорией и перекладывает счетчик товаров между ветками"""
+        from django.db.models.functions import Concat, Substr
+
+        self.filter(path__startswith=old_path).exclude(path=old_path).update(
+            path=Concat(Value(new_path), Substr("path", len(old_path) + 1), output_field=models.CharField()),
+            depth=F("depth") + depth_delta,
+        )
+        if products_count:
+            segment = len(old_path.split("/")[-2]) + 1
+            old_ancestors = [int(part) for part in old_path.split("/")[:-2]]
+            new_ancestors = [int(part) for part in new_path[:-segment].split("/") if part]
+            self.adjust_products_count(old_ancestors, -products_count)
+            self.adjust_products_count(new_ancestors, products_count)
+
+    def adjust_products_count(self, category_ids, delta):
+        if category_ids and delta:
+            self.filter(pk__in=category_ids).update(products_count=F("products_count") + delta)
+
+    def adjust_products_count_for(self, category_id, delta):
+        """Меняет счетчик товаров у категории и всех ее предков одним UPDATE"""
+        path = self.filter(pk=category_id).values_list("path", flat=True).first()
+        if path:
+            self.adjust_products_count([int(part) for part in path.split("/") if part], delta)
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:06
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def fill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model("api", "Product")
+    fields = ["rating_sum", "review_count", "average_rating"] + [f"rating_{r}_count" for r in range(1, 6)]
+    products = Product.objects.annotate(
+        calc_sum=Sum("reviews__rating", default=0),
+        calc_count=Count("reviews"),
+        **{f"calc_{r}": Count("reviews", filter=Q(reviews__rating=r)) for r in range(1, 6)},
+    ).filter(calc_count__gt=0)
+
+    batch = []
+    for product in products.iterator(chunk_size=1000):
+        product.rating_sum = product.calc_sum
+        product.review_count = product.calc_count
+        product.average_rating = product.calc_sum / product.calc_count
+        for r in range(1, 6):
+            setattr(product, f"rating_{r}_count", getattr(product, f"calc_{r}"))
+        batch.append(product)
+    Product.objects.bulk_update(batch, fields, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_productfile_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='average_rating',
+            field=models.FloatField(default=0, editable=False, verbose_name='Средний рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Оценок 1'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Оценок 2'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Оценок 3'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Оценок 4'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Оценок 5'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Сумма оценок'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество отзывов'),
+        ),
+        migrations.RunPython(fill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,194 @@
+import re
+
+from django.db import migrations
+
+# Миграция не импортирует api.search: константы и построение документа зафиксированы здесь
+# в том виде, в каком индекс создавался, чтобы правки поиска не меняли историю миграций.
+FTS_TABLE = "api_product_fts"
+FTS_COLUMNS = ("name", "brand", "category", "tags", "description")
+FTS_WEIGHTS = (10.0, 4.0, 3.0, 2.0, 1.0)
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+# Стеммер Портера (Snowball) для русского языка
+_VOWELS = "аеиоуыэюя"
+_PERFECTIVE_GERUND = (("в", "вши", "вшись"), ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"))
+_REFLEXIVE = ((), ("ся", "сь"))
+_ADJECTIVE = (
+    (),
+    (
+        "ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+        "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    ),
+)
+_PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+_VERB = (
+    ("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно"),
+    (
+        "ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл", "им", "ым", "ен",
+        "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю",
+    ),
+)
+_NOUN = (
+    (),
+    (
+        "а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "ей", "ой", "ий",
+        "й", "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью",
+        "ю", "ия", "ья", "я",
+    ),
+)
+_SUPERLATIVE = ((), ("ейш", "ейше"))
+_DERIVATIONAL = ((), ("ост", "ость"))
+
+
+def _regions(word):
+    """Начала регионов RV, R1 и R2 по правилам Snowball"""
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in _VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r1, r2
+
+
+def _strip(word, start, groups):
+    """Удаляет самое длинное окончание из groups, лежащее в регионе word[start:].
+
+    Окончания первой группы допустимы только после "а" или "я". Возвращает None, если удалять нечего.
+    """
+    region = word[start:]
+    needs_vowel, plain = groups
+    best = None
+    for suffix in needs_vowel + plain:
+        if region.endswith(suffix) and (best is None or len(suffix) > len(best)):
+            best = suffix
+    if best is None:
+        return None
+    if best in needs_vowel and best not in plain:
+        if len(region) <= len(best) or region[-len(best) - 1] not in "ая":
+            return None
+    return word[: -len(best)]
+
+
+def stem(word):
+    """Возвращает основу русского слова; латиница и числа остаются без изменений"""
+    if not _CYRILLIC_RE.search(word):
+        return word
+    rv, _, r2 = _regions(word)
+
+    # Шаг 1
+    result = _strip(word, rv, _PERFECTIVE_GERUND)
+    if result is None:
+        word = _strip(word, rv, _REFLEXIVE) or word
+        result = _strip(word, rv, _ADJECTIVE)
+        if result is not None:
+            result = _strip(result, rv, _PARTICIPLE) or result
+        else:
+            result = _strip(word, rv, _VERB)
+            if result is None:
+                result = _strip(word, rv, _NOUN)
+    word = result if result is not None else word
+
+    # Шаг 2
+    if word[rv:].endswith("и"):
+        word = word[:-1]
+
+    # Шаг 3
+    word = _strip(word, r2, _DERIVATIONAL) or word
+
+    # Шаг 4
+    if word[rv:].endswith("нн"):
+        word = word[:-1]
+    else:
+        superlative = _strip(word, rv, _SUPERLATIVE)
+        if superlative is not None:
+            word = superlative
+            if word[rv:].endswith("нн"):
+                word = word[:-1]
+        elif word[rv:].endswith("ь"):
+            word = word[:-1]
+    return word
+
+
+def normalize(text):
+    """Разбивает текст на токены в нижнем регистре, ё приводится к е"""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def analyze(text):
+    """Нормализованные и застемленные токены текста, как они хранятся в индексе"""
+    return [stem(token) for token in normalize(text)]
+
+
+def build_document(name, description, brand_name, brand_slug, category_name, category_slug, tag_names):
+    """Значения колонок FTS-индекса для одного продукта в порядке FTS_COLUMNS"""
+    return (
+        " ".join(analyze(name)),
+        " ".join(analyze(f"{brand_name} {brand_slug}")),
+        " ".join(analyze(f"{category_name} {category_slug}")),
+        " ".join(analyze(" ".join(tag_names))),
+        " ".join(analyze(description)),
+    )
+
+
+def create_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    Product = apps.get_model("api", "Product")
+    ProductTagRelationship = apps.get_model("api", "ProductTagRelationship")
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"{', '.join(FTS_COLUMNS)}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', %s)",
+            [f"bm25({', '.join(str(weight) for weight in FTS_WEIGHTS)})"],
+        )
+
+        tags = {}
+        for product_id, tag_name in ProductTagRelationship.objects.values_list("product_id", "tag__name"):
+            tags.setdefault(product_id, []).append(tag_name)
+
+        rows = []
+        products = Product.objects.values_list(
+            "id", "name", "description", "brand__name", "brand__slug", "category__name", "category__slug"
+        )
+        for product_id, *fields in products.iterator(chunk_size=1000):
+            rows.append((product_id, *build_document(*fields, tags.get(product_id, []))))
+
+        placeholders = ", ".join(["%s"] * (len(FTS_COLUMNS) + 1))
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, {', '.join(FTS_COLUMNS)}) VALUES ({placeholders})",
+            rows,
+        )
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_product_rating_aggregates"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:14
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def fill_category_paths(apps, schema_editor):
+    Category = apps.get_model("api", "Category")
+    categories = {category.pk: category for category in Category.objects.all()}
+    direct_counts = dict(
+        Category.objects.annotate(n=Count("products", filter=Q(products__is_available=True))).values_list("pk", "n")
+    )
+
+    def resolve(category):
+        if category.path:
+            return category.path
+        parent = categories.get(category.parent_id)
+        prefix = resolve(parent) if parent else ""
+        category.depth = parent.depth + 1 if parent else 0
+        category.path = f"{prefix}{category.pk:06d}/"
+        return category.path
+
+    for category in categories.values():
+        resolve(category)
+    for category in categories.values():
+        category.products_count = 0
+    for category in categories.values():
+        for ancestor_id in (int(part) for part in category.path.split("/") if part):
+            categories[ancestor_id].products_count += direct_counts.get(category.pk, 0)
+    Category.objects.bulk_update(categories.values(), ["path", "depth", "products_count"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_product_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень вложенности'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255, verbose_name='Путь'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Доступных товаров с учетом подкатегорий'),
+        ),
+        migrations.RunPython(fill_category_paths, migrations.RunPython.noop),
+    ]
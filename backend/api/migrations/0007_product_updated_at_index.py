@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_category_materialized_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-updated_at'], name='api_product_updated_0ca2d1_idx'),
+        ),
+    ]
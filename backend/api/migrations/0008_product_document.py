@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:23
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_product_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='document', serialize=False, to='api.product', verbose_name='Продукт')),
+                ('slug', models.SlugField(max_length=255, verbose_name='URL')),
+                ('is_available', models.BooleanField(default=True, verbose_name='Доступен')),
+                ('payload', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Документ')),
+                ('built_at', models.DateTimeField(auto_now=True, verbose_name='Дата сборки')),
+            ],
+            options={
+                'verbose_name': 'Документ продукта',
+                'verbose_name_plural': 'Документы продуктов',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_product_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Действует до')),
+                ('cart_item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reservation', to='api.cartitem', verbose_name='Позиция корзины')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.product', verbose_name='Продукт')),
+            ],
+            options={
+                'verbose_name': 'Резерв товара',
+                'verbose_name_plural': 'Резервы товаров',
+                'indexes': [models.Index(fields=['product', 'expires_at'], name='api_stockre_product_8de197_idx')],
+            },
+        ),
+    ]
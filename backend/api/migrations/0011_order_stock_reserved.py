@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+def mark_existing_orders(apps, schema_editor):
+    """Заказы, оформленные до этой миграции, остаток не списывали - и возвращать его им нечего"""
+    Order = apps.get_model("api", "Order")
+    Order.objects.update(stock_reserved=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_order_status_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stock_reserved',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Товар списан со склада'),
+        ),
+        migrations.RunPython(mark_existing_orders, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,11 @@
-from django.db import models
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import ExpressionWrapper, F, Sum
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 from uuid import uuid4
 from django.urls import reverse
@@ -9,13 +13,73 @@ from .managers import *
 
 
 class Category(models.Model):
+    PATH_SEGMENT_LENGTH = 6
+
     name = models.CharField(max_length=80, unique=True, verbose_name="Категория")
     slug = models.SlugField(max_length=80, unique=True, verbose_name="URL")
     parent = models.ForeignKey(
         "self", on_delete=models.CASCADE, blank=True, null=True, related_name="children", verbose_name="Подкатегория"
     )
+    # Материализованный путь: id всех предков и самой категории, "000001/000007/"
+    path = models.CharField(max_length=255, blank=True, default="", editable=False, db_index=True, verbose_name="Путь")
+    depth = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name="Уровень вложенности")
+    products_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name="Доступных товаров с учетом подкатегорий"
+    )
     objects = CategoryManager()
 
+    @classmethod
+    def path_segment(cls, pk):
+        return f"{pk:0{cls.PATH_SEGMENT_LENGTH}d}/"
+
+    @property
+    def ancestor_ids(self):
+        """id предков от корня, без самой категории"""
+        return [int(segment) for segment in self.path.split("/")[:-2]]
+
+    def clean(self):
+        if self.pk and self.parent_id:
+            parent_path = Category.objects.filter(pk=self.parent_id).values_list("path", flat=True).first() or ""
+            if self.parent_id == self.pk or (self.path and parent_path.startswith(self.path)):
+                raise ValidationError({"parent": "Категорию нельзя вложить в саму себя или в свою подкатегорию"})
+
+    def save(self, *args, **kwargs):
+        """Сохраняем категорию и поддерживаем материализованный путь поддерева.
+
+        Путь, уровень и счетчик берутся из базы, а не из экземпляра: он мог быть загружен до переноса
+        предка или до изменения счетчика. Цикл проверяется до записи, все шаги - в одной транзакции.
+        """
+        with transaction.atomic():
+            stored = None
+            if self.pk:
+                stored = (
+                    Category.objects.select_for_update()
+                    .filter(pk=self.pk)
+                    .values("path", "depth", "products_count")
+                    .first()
+                )
+            if stored:
+                self.path, self.depth, self.products_count = stored["path"], stored["depth"], stored["products_count"]
+            old_path = self.path if stored else ""
+
+            parent = None
+            if self.parent_id:
+                parent = Category.objects.filter(pk=self.parent_id).values("path", "depth").first()
+            if (self.pk and self.parent_id == self.pk) or (parent and old_path and parent["path"].startswith(old_path)):
+                raise ValueError("Категорию нельзя вложить в саму себя или в свою подкатегорию")
+
+            super().save(*args, **kwargs)
+            new_path = (parent["path"] if parent else "") + self.path_segment(self.pk)
+            if new_path == old_path:
+                return
+
+            new_depth = parent["depth"] + 1 if parent else 0
+            Category.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+            if old_path:
+                Category.objects.move_subtree(old_path, new_path, new_depth - self.depth, self.products_count)
+            self.path = new_path
+            self.depth = new_depth
+
     def get_absolute_url(self):
         return reverse("products_by_category", kwargs={"category_slug": self.slug})
 
@@ -76,15 +140,33 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
+    # Агрегаты рейтинга, поддерживаются инкрементально сигналами Review (см. signals.py)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False, verbose_name="Сумма оценок")
+    review_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Количество отзывов")
+    average_rating = models.FloatField(default=0, editable=False, verbose_name="Средний рейтинг")
+    rating_1_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Оценок 1")
+    rating_2_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Оценок 2")
+    rating_3_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Оценок 3")
+    rating_4_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Оценок 4")
+    rating_5_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Оценок 5")
+
     objects = ProductManager()
 
     @property
-    def average_rating(self):
-        return self.reviews.aggregate(Avg("rating"))["rating__avg"] or 0
+    def primary_image(self):
+        """Основное изображение, а при его отсутствии - первое по порядку"""
+        prefetched = getattr(self, "_prefetched_objects_cache", {})
+        if "images" in prefetched:
+            images = list(prefetched["images"])
+            return next((image for image in images if image.is_primary), images[0] if images else None)
+        if not hasattr(self, "_primary_image"):
+            ProductImage.objects.attach_primary([self])
+        return self._primary_image
 
     @property
-    def review_count(self):
-        return self.reviews.count()
+    def rating_histogram(self):
+        """Количество отзывов по каждой оценке"""
+        return {rating: getattr(self, f"rating_{rating}_count") for rating in range(1, 6)}
 
     def get_absolute_url(self):
         return reverse("product_detail", kwargs={"product_slug": self.slug})
@@ -98,6 +180,7 @@ class Product(models.Model):
             models.Index(fields=["category", "brand", "is_available"]),  # Для поиска и сортировки
             models.Index(fields=["-created_at", "is_available"]),  # Для админки
             models.Index(fields=["is_available"]),  # Для тегов
+            models.Index(fields=["-updated_at"]),  # Для Last-Modified каталога
         ]
 
     def __str__(self):
@@ -110,6 +193,8 @@ class ProductImage(models.Model):
     is_primary = models.BooleanField(default=False, verbose_name="Основное")
     order = models.PositiveIntegerField(default=0, verbose_name="Порядковый номер")
 
+    objects = ProductImageManager()
+
     class Meta:
         verbose_name = "Изображение продукта"
         verbose_name_plural = "Изображения продуктов"
@@ -179,6 +264,27 @@ class ProductTagRelationship(models.Model):
         return f"{self.product.name} - {self.tag.name} ({self.weight})"
 
 
+class ProductDocument(models.Model):
+    """Готовый JSON страницы продукта, пересобирается после коммита изменений продукта (см. documents.py)"""
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name="document", verbose_name="Продукт"
+    )
+    slug = models.SlugField(max_length=255, db_index=True, verbose_name="URL")
+    is_available = models.BooleanField(default=True, verbose_name="Доступен")
+    payload = models.JSONField(encoder=DjangoJSONEncoder, verbose_name="Документ")
+    built_at = models.DateTimeField(auto_now=True, verbose_name="Дата сборки")
+
+    objects = ProductDocumentManager()
+
+    class Meta:
+        verbose_name = "Документ продукта"
+        verbose_name_plural = "Документы продуктов"
+
+    def __str__(self):
+        return f"Документ {self.slug}"
+
+
 class Review(models.Model):
     RATING_CHOICES = (
         (1, "1 - Ужасно"),
@@ -256,15 +362,33 @@ class WishlistItem(models.Model):
         return f"{self.product.name} в списке {self.wishlist.user.username}"
 
 
+def _sum_of_lines(price):
+    """SUM(quantity * price) по позициям корзины или заказа"""
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    return Sum(ExpressionWrapper(F("quantity") * F(price), output_field=money), output_field=money)
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="cart", verbose_name="Ползователь")
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
+    objects = CartManager()
+
     @property
     def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+        """Сумма корзины: по загруженным заранее позициям - в памяти, иначе одним агрегатным запросом"""
+        if "items" in getattr(self, "_prefetched_objects_cache", {}):
+            return sum((item.total_price for item in self.items.all()), Decimal("0.00"))
+        total = self.items.aggregate(total=_sum_of_lines("product__price"))["total"]
+        return total.quantize(Decimal("0.01")) if total is not None else Decimal("0.00")
+
+    @property
+    def items_count(self):
+        if "items" in getattr(self, "_prefetched_objects_cache", {}):
+            return len(self.items.all())
+        return self.items.count()
 
     class Meta:
         verbose_name = "Корзина"
@@ -298,6 +422,33 @@ class CartItem(models.Model):
         return f"{self.quantity} x {self.product.name}"
 
 
+class StockReservation(models.Model):
+    """Временное резервирование остатка под позицию корзины.
+
+    Доступный к продаже остаток - stock минус активные (не истекшие) резервы. Истекшие резервы
+    на остаток уже не влияют, команда release_expired_reservations лишь удаляет их из таблицы.
+    """
+
+    cart_item = models.OneToOneField(
+        CartItem, on_delete=models.CASCADE, related_name="reservation", verbose_name="Позиция корзины"
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations", verbose_name="Продукт")
+    quantity = models.PositiveIntegerField(verbose_name="Количество")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="Действует до")
+
+    objects = StockReservationManager()
+
+    class Meta:
+        verbose_name = "Резерв товара"
+        verbose_name_plural = "Резервы товаров"
+        indexes = [
+            models.Index(fields=["product", "expires_at"]),  # Для расчета доступного остатка
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} до {self.expires_at:%H:%M}"
+
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ("pending", "Ожидает обработки"),
@@ -307,6 +458,15 @@ class Order(models.Model):
         ("cancelled", "Отменен"),
         ("refunded", "Возврат"),
     )
+    # Допустимые переходы статусов; менять статус - только через Order.objects.transition()
+    TRANSITIONS = {
+        "pending": ("processing", "cancelled"),
+        "processing": ("shipped", "cancelled"),
+        "shipped": ("delivered", "refunded"),
+        "delivered": ("refunded",),
+        "cancelled": (),
+        "refunded": (),
+    }
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders", verbose_name="Пользователь")
     order_number = models.CharField(max_length=100, unique=True, verbose_name="Номер заказа")
@@ -315,6 +475,8 @@ class Order(models.Model):
     shipping_address = models.TextField(null=False, verbose_name="Адрес доставки")
     phone_number = models.CharField(max_length=20, verbose_name="Контактная информация")
     customer_notes = models.TextField(blank=True, null=True, verbose_name="Комментарий пользователя")
+    # Остаток списан при оформлении (create_from_cart); только такие заказы возвращают товар при отмене
+    stock_reserved = models.BooleanField(default=False, editable=False, verbose_name="Товар списан со склада")
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
@@ -322,9 +484,9 @@ class Order(models.Model):
     objects = OrderManager()
 
     def update_total_amount(self):
-        """Пересчитывает общую сумму заказа"""
-        self.total_amount = sum(item.total_price for item in self.items.all())
-        self.save()
+        """Пересчитывает общую сумму заказа одним агрегатным запросом"""
+        self.total_amount = self.items.aggregate(total=_sum_of_lines("price"))["total"] or 0
+        self.save(update_fields=["total_amount", "updated_at"])
 
     def save(self, *args, **kwargs):
         """Генерируем номер заказа"""
@@ -367,3 +529,23 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.order.order_number}: {self.quantity} x {self.product.name[:15]}..."
+
+
+class OrderStatusHistory(models.Model):
+    """Журнал смены статусов заказа; записи только добавляются"""
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="status_history", verbose_name="Заказ")
+    from_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, verbose_name="Из статуса")
+    to_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, verbose_name="В статус")
+    changed_by = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+", verbose_name="Изменил"
+    )
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="Дата изменения")
+
+    class Meta:
+        verbose_name = "Изменение статуса заказа"
+        verbose_name_plural = "История статусов заказов"
+        ordering = ["created_at", "id"]
+
+    def __str__(self):
+        return f"{self.order_id}: {self.from_status} -> {self.to_status}"
@@ -0,0 +1,169 @@
+import datetime
+import json
+from decimal import Decimal
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """Курсорная пагинация по составному ключу сортировки.
+
+    В отличие от стандартной CursorPagination позиция хранит значения всех полей сортировки,
+    поэтому следующая страница выбирается условием (f1, f2) > (v1, v2) без OFFSET -
+    глубокие страницы стоят столько же, сколько первая.
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("-created_at", "id")
+    tiebreaker = "id"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        self.model = queryset.model
+
+        reverse = bool(self.cursor and self.cursor.reverse)
+        ordering = self._invert(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+
+        position = self._decode_position(self.cursor.position) if self.cursor and self.cursor.position else None
+        if position is not None:
+            queryset = queryset.filter(self._keyset_filter(ordering, position))
+
+        results = list(queryset[: self.page_size + 1])
+        has_following = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        if reverse:
+            self.has_next = position is not None
+            self.has_previous = has_following
+        else:
+            self.has_next = has_following
+            self.has_previous = position is not None
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        if not any(field.lstrip("-") in (self.tiebreaker, "pk") for field in ordering):
+            ordering += (self.tiebreaker,)
+        return ordering
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            value = getattr(instance, field.lstrip("-"))
+            if isinstance(value, (datetime.date, datetime.time)):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = str(value)
+            values.append(value)
+        return json.dumps(values)
+
+    def _decode_position(self, position):
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        decoded = []
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip("-")
+            try:
+                model_field = self.model._meta.pk if name == "pk" else self.model._meta.get_field(name)
+                value = model_field.to_python(value)
+            except FieldDoesNotExist:
+                pass
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)
+            decoded.append(value)
+        return decoded
+
+    @staticmethod
+    def _invert(ordering):
+        return tuple(field[1:] if field.startswith("-") else f"-{field}" for field in ordering)
+
+    @staticmethod
+    def _keyset_filter(ordering, position):
+        """(f1 > v1) OR (f1 = v1 AND f2 > v2) OR ... с учетом направления каждого поля"""
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            condition |= Q(**equal, **{f"{name}__{lookup}": value})
+            equal[name] = value
+        return condition
+
+
+class ProductPagination(KeysetPagination):
+    page_size = 24
+
+
+class ReviewPagination(KeysetPagination):
+    page_size = 10
+
+
+class OrderPagination(KeysetPagination):
+    page_size = 20
+    max_page_size = 50
+
+
+class RankedPagination(KeysetPagination):
+    """Пагинация заранее ранжированного списка (например, результатов полнотекстового поиска).
+
+    Список уже ограничен сверху, поэтому курсор хранит смещение в нем.
+    """
+
+    page_size = 24
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        self.offset = self.cursor.offset if self.cursor else 0
+
+        self.page = list(queryset[self.offset : self.offset + self.page_size])
+        self.has_next = self.offset + self.page_size < len(queryset)
+        self.has_previous = self.offset > 0
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=self.offset + self.page_size, reverse=False, position=None))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=max(self.offset - self.page_size, 0), reverse=False, position=None))
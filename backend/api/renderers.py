@@ -0,0 +1,64 @@
+"""Быстрые JSON-рендерер и парсер на orjson.
+
+Вывод побайтно совпадает со стандартным JSONRenderer DRF: компактные разделители, UTF-8 без
+экранирования, Decimal - числом, datetime в UTC - с суффиксом Z, экранированные U+2028/U+2029.
+Типы, которые orjson не сериализует сам (datetime, Decimal, ленивые строки и т.п.), передаются
+кодировщику DRF. Если orjson не установлен или запрошен форматированный вывод (indent), работают
+стандартные реализации.
+"""
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def __init__(self):
+        super().__init__()
+        self._default = self.encoder_class().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if orjson is None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self._default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        except orjson.JSONEncodeError:
+            # Например, целые за пределами 64 бит - их сериализует только стандартный json
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if b"\xe2\x80\xa8" in ret or b"\xe2\x80\xa9" in ret:
+            ret = ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+        return ret
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+        try:
+            data = stream.read()
+            if encoding.lower().replace("-", "") != "utf8":
+                data = data.decode(encoding)
+            return orjson.loads(data)
+        except ValueError as exc:
+            raise ParseError("JSON parse error - %s" % str(exc))
@@ -0,0 +1,76 @@
+"""Кеш готовых ответов каталога.
+
+Хранятся отрендеренные байты JSON-ответа. Ключом служит ETag из ConditionalGetMixin: в него уже
+входят путь, нормализованные параметры запроса, признак staff и поколения тегов, от которых
+зависит ответ. Поэтому инвалидация точная и бесплатная - после изменения товара, категории или
+бренда (через вьюсеты, админку или что угодно еще, что вызывает сигналы) старые ключи просто
+перестают совпадать. К ETag добавляются схема и хост запроса: в ответах есть абсолютные ссылки
+(пагинация, медиафайлы), и ответ, собранный для одного хоста, не должен уходить другому.
+Ответ, собранный из значения get_or_set, устаревшего после инвалидации (отдается, пока идет
+фоновый пересчет), не сохраняется.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .cache_utils import CACHE_PREFIX, served_outdated, stats
+from .conditional import ConditionalGetMixin
+
+
+class CachedResponse(Exception):
+    """Прерывает обработку запроса, когда ответ найден в кеше"""
+
+    def __init__(self, entry):
+        super().__init__()
+        self.entry = entry
+
+    def build_response(self):
+        return HttpResponse(self.entry["content"], content_type=self.entry["content_type"])
+
+
+class ResponseCacheMixin(ConditionalGetMixin):
+    """Отдает ответы действий из cached_actions из кеша, минуя выборку и сериализацию"""
+
+    cached_actions = ()
+    response_cache_timeout = 5 * 60
+
+    def get_response_cache_key(self, request):
+        if request.method != "GET" or self.action not in self.cached_actions:
+            return None
+        if self.conditional_validators is None or request.accepted_renderer.format != "json":
+            return None
+        etag = self.conditional_validators[0].strip('"')
+        origin = hashlib.md5(f"{request.scheme}://{request.get_host()}".encode()).hexdigest()
+        return f"{CACHE_PREFIX}:response:{origin}:{etag}"
+
+    def initial(self, request, *args, **kwargs):
+        self.response_cache_key = None
+        super().initial(request, *args, **kwargs)
+        self.response_cache_key = self.get_response_cache_key(request)
+        if self.response_cache_key is not None:
+            entry = cache.get(self.response_cache_key)
+            if entry is not None:
+                stats.record("response", "hit")
+                raise CachedResponse(entry)
+            stats.record("response", "miss")
+
+    def handle_exception(self, exc):
+        if isinstance(exc, CachedResponse):
+            return exc.build_response()
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = getattr(self, "response_cache_key", None)
+        if served_outdated():
+            key = None
+        if key is not None and response.status_code == 200 and hasattr(response, "add_post_render_callback"):
+            timeout = self.response_cache_timeout
+
+            def store(rendered):
+                cache.set(key, {"content": rendered.content, "content_type": rendered["Content-Type"]}, timeout)
+
+            response.add_post_render_callback(store)
+        return response
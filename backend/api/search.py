@@ -0,0 +1,283 @@
+"""Полнотекстовый поиск по каталогу.
+
+На SQLite используется виртуальная таблица FTS5 (api_product_fts) с ранжированием BM25.
+Текст индексируется уже нормализованным и застемленным, поэтому "телефоны", "телефона"
+и "телефон" находят одни и те же товары. На других СУБД поиск деградирует до icontains.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "api_product_fts"
+FTS_COLUMNS = ("name", "brand", "category", "tags", "description")
+# Веса колонок для bm25 в порядке FTS_COLUMNS
+FTS_WEIGHTS = (10.0, 4.0, 3.0, 2.0, 1.0)
+MAX_RESULTS = 1000
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+
+# Стеммер Портера (Snowball) для русского языка
+_VOWELS = "аеиоуыэюя"
+_PERFECTIVE_GERUND = (("в", "вши", "вшись"), ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"))
+_REFLEXIVE = ((), ("ся", "сь"))
+_ADJECTIVE = (
+    (),
+    (
+        "ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+        "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    ),
+)
+_PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+_VERB = (
+    ("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно"),
+    (
+        "ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл", "им", "ым", "ен",
+        "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю",
+    ),
+)
+_NOUN = (
+    (),
+    (
+        "а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "ей", "ой", "ий",
+        "й", "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью",
+        "ю", "ия", "ья", "я",
+    ),
+)
+_SUPERLATIVE = ((), ("ейш", "ейше"))
+_DERIVATIONAL = ((), ("ост", "ость"))
+
+
+def _regions(word):
+    """Начала регионов RV, R1 и R2 по правилам Snowball"""
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in _VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r1, r2
+
+
+def _strip(word, start, groups):
+    """Удаляет самое длинное окончание из groups, лежащее в регионе word[start:].
+
+    Окончания первой группы допустимы только после "а" или "я". Возвращает None, если удалять нечего.
+    """
+    region = word[start:]
+    needs_vowel, plain = groups
+    best = None
+    for suffix in needs_vowel + plain:
+        if region.endswith(suffix) and (best is None or len(suffix) > len(best)):
+            best = suffix
+    if best is None:
+        return None
+    if best in needs_vowel and best not in plain:
+        if len(region) <= len(best) or region[-len(best) - 1] not in "ая":
+            return None
+    return word[: -len(best)]
+
+
+def stem(word):
+    """Возвращает основу русского слова; латиница и числа остаются без изменений"""
+    if not _CYRILLIC_RE.search(word):
+        return word
+    rv, _, r2 = _regions(word)
+
+    # Шаг 1
+    result = _strip(word, rv, _PERFECTIVE_GERUND)
+    if result is None:
+        word = _strip(word, rv, _REFLEXIVE) or word
+        result = _strip(word, rv, _ADJECTIVE)
+        if result is not None:
+            result = _strip(result, rv, _PARTICIPLE) or result
+        else:
+            result = _strip(word, rv, _VERB)
+            if result is None:
+                result = _strip(word, rv, _NOUN)
+    word = result if result is not None else word
+
+    # Шаг 2
+    if word[rv:].endswith("и"):
+        word = word[:-1]
+
+    # Шаг 3
+    word = _strip(word, r2, _DERIVATIONAL) or word
+
+    # Шаг 4
+    if word[rv:].endswith("нн"):
+        word = word[:-1]
+    else:
+        superlative = _strip(word, rv, _SUPERLATIVE)
+        if superlative is not None:
+            word = superlative
+            if word[rv:].endswith("нн"):
+                word = word[:-1]
+        elif word[rv:].endswith("ь"):
+            word = word[:-1]
+    return word
+
+
+def normalize(text):
+    """Разбивает текст на токены в нижнем регистре, ё приводится к е"""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def analyze(text):
+    """Нормализованные и застемленные токены текста, как они хранятся в индексе"""
+    return [stem(token) for token in normalize(text)]
+
+
+def build_match_expression(query):
+    """Преобразует пользовательский запрос в выражение MATCH: все слова обязательны, по префиксу основы"""
+    terms = []
+    for token in normalize(query):
+        base = stem(token) or token
+        terms.append('"{}"*'.format(base.replace('"', '""')))
+    return " ".join(terms)
+
+
+def is_enabled():
+    return connection.vendor == "sqlite"
+
+
+def build_document(name, description, brand_name, brand_slug, category_name, category_slug, tag_names):
+    """Значения колонок FTS-индекса для одного продукта в порядке FTS_COLUMNS"""
+    return (
+        " ".join(analyze(name)),
+        " ".join(analyze(f"{brand_name} {brand_slug}")),
+        " ".join(analyze(f"{category_name} {category_slug}")),
+        " ".join(analyze(" ".join(tag_names))),
+        " ".join(analyze(description)),
+    )
+
+
+def index_products(product_ids=None, batch_size=1000):
+    """Переиндексирует продукты (или весь каталог, если product_ids=None)"""
+    if not is_enabled():
+        return 0
+    from .models import Product
+
+    queryset = Product.objects.select_related("brand", "category").prefetch_related("tags").order_by("pk")
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return 0
+        queryset = queryset.filter(pk__in=product_ids)
+        remove_products(product_ids)
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    placeholders = ", ".join(["%s"] * (len(FTS_COLUMNS) + 1))
+    sql = f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, {', '.join(FTS_COLUMNS)}) VALUES ({placeholders})"
+    indexed = 0
+    rows = []
+    with connection.cursor() as cursor:
+        for product in queryset.iterator(chunk_size=batch_size):
+            document = build_document(
+                product.name,
+                product.description,
+                product.brand.name,
+                product.brand.slug,
+                product.category.name,
+                product.category.slug,
+                [tag.name for tag in product.tags.all()],
+            )
+            rows.append((product.pk, *document))
+            if len(rows) >= batch_size:
+                cursor.executemany(sql, rows)
+                indexed += len(rows)
+                rows = []
+        if rows:
+            cursor.executemany(sql, rows)
+            indexed += len(rows)
+    return indexed
+
+
+def index_products_in_batches(product_ids, batch_size=1000):
+    """Переиндексирует продукты пачками по batch_size id - для массовых правок вроде переименования бренда"""
+    indexed = 0
+    batch = []
+    for pk in product_ids:
+        batch.append(pk)
+        if len(batch) >= batch_size:
+            indexed += index_products(batch, batch_size=batch_size)
+            batch = []
+    if batch:
+        indexed += index_products(batch, batch_size=batch_size)
+    return indexed
+
+
+def remove_products(product_ids):
+    if not is_enabled():
+        return
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    with connection.cursor() as cursor:
+        placeholders = ", ".join(["%s"] * len(product_ids))
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", product_ids)
+
+
+def _fallback_filter(query):
+    condition = Q()
+    for token in normalize(query):
+        condition &= (
+            Q(name__icontains=token)
+            | Q(description__icontains=token)
+            | Q(brand__name__icontains=token)
+            | Q(brand__slug__icontains=token)
+            | Q(category__name__icontains=token)
+            | Q(category__slug__icontains=token)
+            | Q(tags__name__icontains=token)
+        )
+    return condition
+
+
+def filter_queryset(queryset, query):
+    """Оставляет в queryset только продукты, найденные по запросу (без ранжирования)"""
+    expression = build_match_expression(query)
+    if not expression:
+        return queryset
+    if not is_enabled():
+        return queryset.filter(pk__in=queryset.model.objects.filter(_fallback_filter(query)).values("pk"))
+    return queryset.filter(pk__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression]))
+
+
+def search_ids(query, available_only=True, limit=MAX_RESULTS):
+    """Идентификаторы найденных продуктов в порядке релевантности (BM25)"""
+    expression = build_match_expression(query)
+    if not expression:
+        return []
+    if not is_enabled():
+        from .models import Product
+
+        products = Product.objects.filter(pk__in=Product.objects.filter(_fallback_filter(query)).values("pk"))
+        if available_only:
+            products = products.filter(is_available=True)
+        return list(products.order_by("name", "pk").values_list("pk", flat=True)[:limit])
+
+    from .models import Product
+
+    availability = "AND p.is_available" if available_only else ""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT f.rowid FROM {FTS_TABLE} f JOIN {Product._meta.db_table} p ON p.id = f.rowid "
+            f"WHERE {FTS_TABLE} MATCH %s {availability} ORDER BY f.rank LIMIT %s",
+            [expression, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
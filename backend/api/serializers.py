@@ -2,49 +2,127 @@ from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
 from .models import *
 
 
-class UserSerializer(serializers.ModelSerializer):
+def _split_param(value):
+    return [name.strip() for name in value.split(",") if name.strip()] if value else None
+
+
+class DynamicFieldsMixin:
+    """Выбор полей в ответе: ?fields=id,name, ?omit=description и ?expand=images.
+
+    Параметры запроса применяются только к сериализатору верхнего уровня при GET; их же можно
+    передать аргументами fields, omit и expand. Вложенные данные, которые по умолчанию не
+    выводятся, описываются в Meta.expandable_fields. Meta.select_related_fields,
+    Meta.prefetch_related_fields и Meta.annotated_fields связывают поля с тем, что нужно добавить
+    в queryset, - optimize_queryset() добавляет только то, что нужно запрошенным полям.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        omit = kwargs.pop("omit", None)
+        expand = kwargs.pop("expand", None)
+        super().__init__(*args, **kwargs)
+
+        request = self._context.get("request")
+        if request is not None and request.method == "GET":
+            params = request.query_params
+            fields = fields if fields is not None else _split_param(params.get("fields"))
+            omit = omit if omit is not None else _split_param(params.get("omit"))
+            expand = expand if expand is not None else _split_param(params.get("expand"))
+
+        expandable = getattr(self.Meta, "expandable_fields", {})
+        for name in expand or ():
+            if name in expandable and name not in self.fields:
+                serializer_class, options = expandable[name]
+                self.fields[name] = serializer_class(**options)
+        if fields:
+            keep = set(fields) | set(expand or ())
+            for name in list(self.fields):
+                if name not in keep:
+                    self.fields.pop(name)
+        for name in omit or ():
+            self.fields.pop(name, None)
+
+    @classmethod
+    def optimize_queryset(cls, queryset, request):
+        """Добавляет в queryset связи и аннотации, нужные полям, которые будут выведены"""
+        names = set(cls(context={"request": request}).fields)
+        meta = cls.Meta
+        select = {path for name, path in getattr(meta, "select_related_fields", {}).items() if name in names}
+        if select:
+            queryset = queryset.select_related(*sorted(select))
+        prefetch = {path for name, path in getattr(meta, "prefetch_related_fields", {}).items() if name in names}
+        if prefetch:
+            queryset = queryset.prefetch_related(*sorted(prefetch))
+        annotations = {}
+        for name, expressions in getattr(meta, "annotated_fields", {}).items():
+            if name in names:
+                annotations.update(expressions)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return queryset
+
+
+class DynamicFieldsModelSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    pass
+
+
+class UserSerializer(DynamicFieldsModelSerializer):
     class Meta:
         model = User
         fields = ["id", "username", "email", "first_name", "last_name", "is_staff"]
         read_only_fields = ["id", "is_staff"]
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(DynamicFieldsModelSerializer):
     parent_name = serializers.CharField(source="parent.name", read_only=True)
     children_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
-        fields = ["id", "name", "slug", "parent", "parent_name", "children_count"]
-        read_only_fields = ["id"]
+        fields = ["id", "name", "slug", "parent", "parent_name", "children_count", "depth", "products_count"]
+        read_only_fields = ["id", "depth", "products_count"]
+        select_related_fields = {"parent_name": "parent"}
+        annotated_fields = {"children_count": {"children_total": models.Count("children")}}
 
     def get_children_count(self, obj):
+        if hasattr(obj, "children_total"):
+            return obj.children_total
         return obj.children.count()
 
+    def validate_parent(self, value):
+        if value and self.instance and self.instance.path and value.path.startswith(self.instance.path):
+            raise serializers.ValidationError("Категорию нельзя вложить в саму себя или в свою подкатегорию")
+        return value
+
 
-class BrandSerializer(serializers.ModelSerializer):
+class BrandSerializer(DynamicFieldsModelSerializer):
     products_count = serializers.SerializerMethodField()
 
     def get_products_count(self, obj):
+        if hasattr(obj, "products_total"):
+            return obj.products_total
         return obj.products.count()
 
     class Meta:
         model = Brand
         fields = ["id", "name", "slug", "official_website", "description", "products_count"]
         read_only_fields = ["id"]
+        annotated_fields = {"products_count": {"products_total": models.Count("products")}}
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(DynamicFieldsModelSerializer):
     class Meta:
         model = Tag
         fields = ["id", "name", "color", "description"]
         read_only_fields = ["id"]
 
 
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(DynamicFieldsModelSerializer):
     image_url = serializers.SerializerMethodField()
 
     class Meta:
@@ -58,7 +136,17 @@ class ProductImageSerializer(serializers.ModelSerializer):
         return None
 
 
-class ProductFileSerializer(serializers.ModelSerializer):
+class PrimaryImageListSerializer(serializers.ListSerializer):
+    """Загружает основные изображения всей страницы одним запросом перед сериализацией"""
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if self.child.primary_image_field in self.child.fields:
+            ProductImage.objects.attach_primary([self.child.get_image_product(item) for item in iterable])
+        return super().to_representation(iterable)
+
+
+class ProductFileSerializer(DynamicFieldsModelSerializer):
     file_url = serializers.SerializerMethodField()
     file_size_mb = serializers.SerializerMethodField()
 
@@ -90,7 +178,7 @@ class ProductFileSerializer(serializers.ModelSerializer):
         return 0
 
 
-class ProductTagRelationshipSerializer(serializers.ModelSerializer):
+class ProductTagRelationshipSerializer(DynamicFieldsModelSerializer):
     tag_name = serializers.CharField(source="tag.name", read_only=True)
     tag_color = serializers.CharField(source="tag.color", read_only=True)
 
@@ -110,7 +198,7 @@ class ProductTagRelationshipSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "added_at"]
 
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(DynamicFieldsModelSerializer):
     primary_image = serializers.SerializerMethodField()
     brand_name = serializers.CharField(source="brand.name", read_only=True)
     brand_slug = serializers.CharField(source="brand.slug", read_only=True)
@@ -141,9 +229,34 @@ class ProductListSerializer(serializers.ModelSerializer):
             "created_at",
         ]
         read_only_fields = ["id", "created_at"]
+        list_serializer_class = PrimaryImageListSerializer
+        expandable_fields = {
+            "images": (ProductImageSerializer, {"many": True, "read_only": True}),
+            "files": (ProductFileSerializer, {"many": True, "read_only": True}),
+            "tags": (
+                ProductTagRelationshipSerializer,
+                {"many": True, "read_only": True, "source": "producttagrelationship_set"},
+            ),
+        }
+        select_related_fields = {
+            "brand_name": "brand",
+            "brand_slug": "brand",
+            "category_name": "category",
+            "category_slug": "category",
+        }
+        prefetch_related_fields = {
+            "images": "images",
+            "files": "files",
+            "tags": "producttagrelationship_set__tag",
+        }
+
+    primary_image_field = "primary_image"
+
+    def get_image_product(self, obj):
+        return obj
 
     def get_primary_image(self, obj):
-        primary_image = obj.images.filter(is_primary=True).first()
+        primary_image = obj.primary_image
         if primary_image:
             return ProductImageSerializer(primary_image).data
         return None
@@ -153,12 +266,20 @@ class ProductDetailSerializer(ProductListSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     files = ProductFileSerializer(many=True, read_only=True)
     tags = ProductTagRelationshipSerializer(many=True, read_only=True, source="producttagrelationship_set")
+    rating_histogram = serializers.ReadOnlyField()
 
     class Meta(ProductListSerializer.Meta):
-        fields = ProductListSerializer.Meta.fields + ["description", "warranty_months", "images", "files", "tags"]
+        fields = ProductListSerializer.Meta.fields + [
+            "description",
+            "warranty_months",
+            "rating_histogram",
+            "images",
+            "files",
+            "tags",
+        ]
 
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(DynamicFieldsModelSerializer):
     user_email = serializers.CharField(source="user.email", read_only=True)
     user_name = serializers.SerializerMethodField()
     product_name = serializers.CharField(source="product.name", read_only=True)
@@ -179,6 +300,7 @@ class ReviewSerializer(serializers.ModelSerializer):
             "updated_at",
         ]
         read_only_fields = ["id", "created_at", "updated_at"]
+        select_related_fields = {"user_email": "user", "user_name": "user", "product_name": "product"}
 
     def get_user_name(self, obj):
         return f"{obj.user.first_name} {obj.user.last_name}".strip() or obj.user.username
@@ -193,7 +315,7 @@ class ReviewSerializer(serializers.ModelSerializer):
         return data
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(DynamicFieldsModelSerializer):
     user_email = serializers.CharField(source="user.email", read_only=True)
     user_name = serializers.SerializerMethodField()
 
@@ -206,7 +328,7 @@ class ProfileSerializer(serializers.ModelSerializer):
         return f"{obj.user.first_name} {obj.user.last_name}".strip() or obj.user.username
 
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(DynamicFieldsModelSerializer):
     user_email = serializers.CharField(source="user.email", read_only=True)
     items_count = serializers.SerializerMethodField()
 
@@ -219,7 +341,7 @@ class WishlistSerializer(serializers.ModelSerializer):
         return obj.wishlistitem_set.count()
 
 
-class WishlistItemSerializer(serializers.ModelSerializer):
+class WishlistItemSerializer(DynamicFieldsModelSerializer):
     product_name = serializers.CharField(source="product.name", read_only=True)
     product_price = serializers.DecimalField(source="product.price", read_only=True, max_digits=10, decimal_places=2)
     product_image = serializers.SerializerMethodField()
@@ -228,15 +350,26 @@ class WishlistItemSerializer(serializers.ModelSerializer):
         model = WishlistItem
         fields = ["id", "wishlist", "product", "product_name", "product_price", "product_image", "added_at"]
         read_only_fields = ["id", "added_at"]
+        list_serializer_class = PrimaryImageListSerializer
+        select_related_fields = {
+            "product_name": "product",
+            "product_price": "product",
+            "product_image": "product",
+        }
+
+    primary_image_field = "product_image"
+
+    def get_image_product(self, obj):
+        return obj.product
 
     def get_product_image(self, obj):
-        primary_image = obj.product.images.filter(is_primary=True).first()
+        primary_image = obj.product.primary_image
         if primary_image:
             return primary_image.image.url
         return None
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(DynamicFieldsModelSerializer):
     product_image = serializers.SerializerMethodField()
     product_name = serializers.CharField(source="product.name", read_only=True)
     product_price = serializers.DecimalField(source="product.price", read_only=True, max_digits=10, decimal_places=2)
@@ -246,9 +379,20 @@ class CartItemSerializer(serializers.ModelSerializer):
         model = CartItem
         fields = ["id", "cart", "product", "product_name", "product_price", "product_image", "quantity", "total_price"]
         read_only_fields = ["id", "total_price"]
+        list_serializer_class = PrimaryImageListSerializer
+        select_related_fields = {
+            "product_name": "product",
+            "product_price": "product",
+            "product_image": "product",
+        }
+
+    primary_image_field = "product_image"
+
+    def get_image_product(self, obj):
+        return obj.product
 
     def get_product_image(self, obj):
-        primary_image = obj.product.images.filter(is_primary=True).first()
+        primary_image = obj.product.primary_image
         if primary_image:
             return primary_image.image.url
         return None
@@ -259,7 +403,24 @@ class CartItemSerializer(serializers.ModelSerializer):
         return value
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=["add", "set", "remove"])
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        if attrs["op"] != "remove" and "quantity" not in attrs:
+            raise serializers.ValidationError({"quantity": "Обязательное поле."})
+        if attrs["op"] == "add" and attrs["quantity"] < 1:
+            raise serializers.ValidationError({"quantity": "Количество должно быть не менее 1"})
+        return attrs
+
+
+class CartSyncSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=200)
+
+
+class CartSerializer(DynamicFieldsModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.ReadOnlyField()
     items_count = serializers.SerializerMethodField()
@@ -269,12 +430,19 @@ class CartSerializer(serializers.ModelSerializer):
         model = Cart
         fields = ["id", "user", "user_email", "items", "total_price", "items_count", "created_at", "updated_at"]
         read_only_fields = ["id", "created_at", "updated_at"]
+        select_related_fields = {"user_email": "user"}
+        # Позиции с продуктами загружаются один раз: из них же считаются сумма и количество
+        prefetch_related_fields = {
+            "items": "items__product",
+            "total_price": "items__product",
+            "items_count": "items__product",
+        }
 
     def get_items_count(self, obj):
-        return obj.items.count()
+        return obj.items_count
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(DynamicFieldsModelSerializer):
     product_name = serializers.CharField(source="product.name", read_only=True)
     product_slug = serializers.CharField(source="product.slug", read_only=True)
     total_price = serializers.ReadOnlyField()
@@ -283,9 +451,10 @@ class OrderItemSerializer(serializers.ModelSerializer):
         model = OrderItem
         fields = ["id", "order", "product", "product_name", "product_slug", "quantity", "price", "total_price"]
         read_only_fields = ["id", "price", "total_price"]
+        select_related_fields = {"product_name": "product", "product_slug": "product"}
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(DynamicFieldsModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     user_email = serializers.CharField(source="user.email", read_only=True)
     user_name = serializers.SerializerMethodField()
@@ -308,6 +477,8 @@ class OrderSerializer(serializers.ModelSerializer):
             "updated_at",
         ]
         read_only_fields = ["id", "order_number", "total_amount", "created_at", "updated_at"]
+        select_related_fields = {"user_email": "user", "user_name": "user"}
+        prefetch_related_fields = {"items": "items__product"}
 
     def get_user_name(self, obj):
         return f"{obj.user.first_name} {obj.user.last_name}".strip() or obj.user.username
@@ -318,7 +489,7 @@ class OrderSerializer(serializers.ModelSerializer):
         return order
 
 
-class OrderCreateSerializer(serializers.ModelSerializer):
+class OrderCreateSerializer(DynamicFieldsModelSerializer):
     cart_id = serializers.IntegerField(write_only=True)
 
     class Meta:
@@ -329,32 +500,34 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         cart_id = validated_data.pop("cart_id")
         user = self.context["request"].user
 
+        # Переносим товары из корзины в заказ и очищаем корзину одной транзакцией
         try:
-            cart = Cart.objects.get(id=cart_id, user=user)
-        except Cart.DoesNotExist:
-            raise serializers.ValidationError("Корзина не найдена")
-
-        # Создаем заказ
-        order = Order.objects.create(
-            user=user,
-            shipping_address=validated_data["shipping_address"],
-            phone_number=validated_data["phone_number"],
-            customer_notes=validated_data.get("customer_notes", ""),
-        )
-
-        # Переносим товары из корзины в заказ
-        for cart_item in cart.items.all():
-            OrderItem.objects.create(
-                order=order, product=cart_item.product, quantity=cart_item.quantity, price=cart_item.product.price
+            return Order.objects.create_from_cart(
+                cart_id,
+                user,
+                shipping_address=validated_data["shipping_address"],
+                phone_number=validated_data["phone_number"],
+                customer_notes=validated_data.get("customer_notes", ""),
             )
+        except InsufficientStock as exc:
+            raise serializers.ValidationError({"items": exc.lines})
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(exc.messages)
 
-        # Очищаем корзину
-        cart.items.all().delete()
 
-        # Пересчитываем общую сумму
-        order.update_total_amount()
+class OrderStatusHistorySerializer(DynamicFieldsModelSerializer):
+    changed_by_name = serializers.CharField(source="changed_by.username", read_only=True, default=None)
 
-        return order
+    class Meta:
+        model = OrderStatusHistory
+        fields = ["id", "from_status", "to_status", "changed_by", "changed_by_name", "created_at"]
+        read_only_fields = fields
+        select_related_fields = {"changed_by_name": "changed_by"}
+
+
+class OrderBulkStatusSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=10000)
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
 
 
 class LoginSerializer(serializers.Serializer):
@@ -379,7 +552,7 @@ class LoginSerializer(serializers.Serializer):
             raise serializers.ValidationError("Необходимо указать имя пользователя и пароль")
 
 
-class RegisterSerializer(serializers.ModelSerializer):
+class RegisterSerializer(DynamicFieldsModelSerializer):
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     password2 = serializers.CharField(write_only=True, required=True)
 
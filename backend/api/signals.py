@@ -0,0 +1,242 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from . import bitmaps, documents, search
+from .cache_utils import invalidate
+from .models import Brand, Category, Product, ProductFile, ProductImage, ProductTagRelationship, Review, Tag
+
+
+@receiver(post_init, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    """Запоминаем продукт и оценку отзыва, чтобы при изменении знать, что вычесть"""
+    if instance.pk is not None:
+        instance._rating_snapshot = (instance.__dict__.get("product_id"), instance.__dict__.get("rating"))
+    else:
+        instance._rating_snapshot = None
+
+
+@receiver(post_save, sender=Review)
+def update_rating_on_review_save(sender, instance, created, raw=False, **kwargs):
+    """Обновляем агрегаты рейтинга продукта при создании и изменении отзыва"""
+    if raw:
+        return
+
+    snapshot = None if created else instance._rating_snapshot
+    current = (instance.product_id, instance.rating)
+
+    if snapshot is None:
+        Product.objects.apply_rating_change(instance.product_id, added=instance.rating)
+    elif snapshot != current:
+        old_product_id, old_rating = snapshot
+        if old_product_id == instance.product_id:
+            Product.objects.apply_rating_change(instance.product_id, added=instance.rating, removed=old_rating)
+        else:
+            Product.objects.apply_rating_change(old_product_id, removed=old_rating)
+            Product.objects.apply_rating_change(instance.product_id, added=instance.rating)
+
+    instance._rating_snapshot = current
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_on_review_delete(sender, instance, **kwargs):
+    """Вычитаем оценку удаленного отзыва из агрегатов продукта"""
+    product_id, rating = instance._rating_snapshot or (instance.product_id, instance.rating)
+    Product.objects.apply_rating_change(product_id, removed=rating)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    """Обновляем поисковый индекс при сохранении продукта"""
+    if not raw:
+        search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_save, sender=ProductTagRelationship)
+@receiver(post_delete, sender=ProductTagRelationship)
+def reindex_tagged_product(sender, instance, raw=False, **kwargs):
+    """Теги входят в индекс, поэтому переиндексируем продукт при привязке и отвязке тега"""
+    if not raw:
+        search.index_products([instance.product_id])
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+def reindex_products_by_owner(sender, instance, created, raw=False, **kwargs):
+    """Название бренда и категории входят в индекс продуктов"""
+    if not raw and not created:
+        reindex_on_commit(instance.products.all())
+
+
+@receiver(post_save, sender=Tag)
+def reindex_products_by_tag(sender, instance, created, raw=False, **kwargs):
+    if not raw and not created:
+        reindex_on_commit(instance.products.all())
+
+
+def reindex_on_commit(products):
+    """Переиндексация всех продуктов бренда или тега - после коммита и пачками, а не внутри транзакции запроса"""
+    product_ids = products.order_by("pk").values_list("pk", flat=True)
+    transaction.on_commit(partial(search.index_products_in_batches, product_ids.iterator(chunk_size=1000)))
+
+
+@receiver(post_init, sender=ProductTagRelationship)
+def remember_tag_link(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._link_snapshot = (instance.__dict__.get("tag_id"), instance.__dict__.get("product_id"))
+    else:
+        instance._link_snapshot = None
+
+
+@receiver(post_save, sender=ProductTagRelationship)
+def update_tag_bitmap_on_save(sender, instance, raw=False, **kwargs):
+    """Битовый индекс тегов обновляется после коммита - в том числе при правке из инлайна админки"""
+    if raw:
+        return
+    current = (instance.tag_id, instance.product_id)
+    previous, instance._link_snapshot = instance._link_snapshot, current
+    if previous != current:
+        if previous is not None:
+            transaction.on_commit(partial(bitmaps.update, lambda index: index.remove_tag(*previous)))
+        transaction.on_commit(partial(bitmaps.update, lambda index: index.add_tag(*current)))
+
+
+@receiver(post_delete, sender=ProductTagRelationship)
+def update_tag_bitmap_on_delete(sender, instance, **kwargs):
+    link = instance._link_snapshot or (instance.tag_id, instance.product_id)
+    transaction.on_commit(partial(bitmaps.update, lambda index: index.remove_tag(*link)))
+
+
+@receiver(post_save, sender=Product)
+def update_product_bitmaps(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    state = (instance.pk, instance.category_id, instance.brand_id, instance.is_available)
+    transaction.on_commit(partial(bitmaps.update, lambda index: index.update_product(*state)))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_bitmaps(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(partial(bitmaps.update, lambda index: index.remove_product(product_id)))
+
+
+@receiver(post_init, sender=Product)
+def remember_product_category(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._category_snapshot = (instance.__dict__.get("category_id"), instance.__dict__.get("is_available"))
+    else:
+        instance._category_snapshot = None
+
+
+@receiver(post_save, sender=Product)
+def update_category_counts_on_save(sender, instance, created, raw=False, **kwargs):
+    """Поддерживаем счетчики доступных товаров в дереве категорий"""
+    if raw:
+        return
+    previous = None if created else instance._category_snapshot
+    current = (instance.category_id, instance.is_available)
+    instance._category_snapshot = current
+    if previous == current:
+        return
+    if previous is not None and previous[1]:
+        Category.objects.adjust_products_count_for(previous[0], -1)
+    if current[1]:
+        Category.objects.adjust_products_count_for(current[0], 1)
+
+
+@receiver(post_delete, sender=Product)
+def update_category_counts_on_delete(sender, instance, **kwargs):
+    category_id, is_available = instance._category_snapshot or (instance.category_id, instance.is_available)
+    if is_available:
+        Category.objects.adjust_products_count_for(category_id, -1)
+
+
+def invalidate_on_commit(*tags):
+    """Поколения поднимаются после коммита, иначе параллельный запрос закеширует старые данные под новым ключом"""
+    transaction.on_commit(partial(invalidate, *tags))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    invalidate_on_commit("product", f"product:{instance.pk}")
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductFile)
+@receiver(post_delete, sender=ProductFile)
+def invalidate_product_media_cache(sender, instance, **kwargs):
+    invalidate_on_commit("product", f"product:{instance.product_id}")
+
+
+@receiver(post_save, sender=ProductTagRelationship)
+@receiver(post_delete, sender=ProductTagRelationship)
+def invalidate_tag_link_cache(sender, instance, **kwargs):
+    invalidate_on_commit("product", "tag", f"product:{instance.product_id}", f"tag:{instance.tag_id}")
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_cache(sender, instance, **kwargs):
+    """Отзыв меняет агрегаты рейтинга продукта, поэтому задевает и его"""
+    invalidate_on_commit("review", "product", f"product:{instance.product_id}")
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    invalidate_on_commit("category", "product", f"category:{instance.pk}")
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def invalidate_brand_cache(sender, instance, **kwargs):
+    invalidate_on_commit("brand", "product", f"brand:{instance.pk}")
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tag_cache(sender, instance, **kwargs):
+    invalidate_on_commit("tag", "product", f"tag:{instance.pk}")
+
+
+def rebuild_documents_on_commit(product_ids):
+    documents.schedule(product_ids)
+
+
+@receiver(post_save, sender=Product)
+def rebuild_product_document(sender, instance, raw=False, **kwargs):
+    if not raw:
+        rebuild_documents_on_commit([instance.pk])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductFile)
+@receiver(post_delete, sender=ProductFile)
+@receiver(post_save, sender=ProductTagRelationship)
+@receiver(post_delete, sender=ProductTagRelationship)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def rebuild_document_of_related(sender, instance, raw=False, **kwargs):
+    """Изображения, файлы, теги и рейтинг входят в документ продукта"""
+    if not raw:
+        rebuild_documents_on_commit([instance.product_id])
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Tag)
+def rebuild_documents_by_owner(sender, instance, created, raw=False, **kwargs):
+    """Названия бренда, категории и тегов входят в документы их продуктов"""
+    if not raw and not created:
+        rebuild_documents_on_commit(instance.products.values_list("pk", flat=True))
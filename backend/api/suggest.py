@@ -0,0 +1,159 @@
+"""Подсказки для строки поиска.
+
+Индекс хранится в памяти процесса: отсортированный список ключей и bisect по префиксу.
+Ключом служит название, начиная с каждого его слова, поэтому "iph" находит "Apple iPhone 15".
+Индекс перестраивается лениво - при первом запросе после изменения каталога. Изменения
+отслеживаются по поколениям тегов кеша, поэтому видны и правки, сделанные другими процессами.
+"""
+
+import heapq
+import threading
+from bisect import bisect_left
+
+from django.db import connection
+from django.db.models import Count, Q, Sum
+
+from .cache_utils import get_generations
+from .search import normalize
+
+MAX_SUGGESTIONS = 20
+# Теги кеша, от которых зависит индекс
+INDEX_TAGS = ("product", "brand", "category")
+
+
+class SuggestIndex:
+    """Отсортированные ключи + дерево отрезков по популярности.
+
+    Диапазон ключей с нужным префиксом находится через bisect, а лучшие N элементов диапазона
+    достаются из дерева отрезков за O(N log n) - независимо от того, насколько широк диапазон.
+    """
+
+    def __init__(self, entries):
+        """entries - итерируемое из (название, популярность, тип, slug)"""
+        self.items = []
+        keyed = []
+        for name, popularity, kind, slug in entries:
+            item_id = len(self.items)
+            self.items.append({"type": kind, "name": name, "slug": slug, "popularity": popularity})
+            words = normalize(name)
+            for i in range(len(words)):
+                keyed.append((" ".join(words[i:]), item_id))
+        keyed.sort()
+        self.keys = [key for key, _ in keyed]
+        self.item_ids = [item_id for _, item_id in keyed]
+        self.popularity = [self.items[item_id]["popularity"] for item_id in self.item_ids]
+
+        # Листья дерева - позиции ключей, внутренние узлы - позиция с максимальной популярностью
+        size = self.size = len(self.keys)
+        self.tree = [0] * size + list(range(size))
+        for node in range(size - 1, 0, -1):
+            self.tree[node] = self._better(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def _better(self, a, b):
+        if a < 0:
+            return b
+        if b < 0:
+            return a
+        return a if (self.popularity[a], -a) >= (self.popularity[b], -b) else b
+
+    def _argmax(self, left, right):
+        """Позиция самого популярного ключа в [left, right) или -1"""
+        best = -1
+        left += self.size
+        right += self.size
+        while left < right:
+            if left & 1:
+                best = self._better(best, self.tree[left])
+                left += 1
+            if right & 1:
+                right -= 1
+                best = self._better(best, self.tree[right])
+            left >>= 1
+            right >>= 1
+        return best
+
+    def _push(self, heap, left, right):
+        if left < right:
+            position = self._argmax(left, right)
+            heapq.heappush(heap, (-self.popularity[position], position, left, right))
+
+    def lookup(self, query, limit=10):
+        prefix = " ".join(normalize(query))
+        if not prefix:
+            return []
+        limit = min(limit, MAX_SUGGESTIONS)
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + "\uffff", lo=start)
+
+        heap = []
+        self._push(heap, start, end)
+        found = []
+        seen = set()
+        while heap and len(found) < limit:
+            _, position, left, right = heapq.heappop(heap)
+            item_id = self.item_ids[position]
+            if item_id not in seen:
+                seen.add(item_id)
+                found.append(self.items[item_id])
+            self._push(heap, left, position)
+            self._push(heap, position + 1, right)
+        return found
+
+
+def build_index():
+    from .models import Brand, Category, OrderItem, Product
+
+    sales = dict(
+        OrderItem.objects.filter(product__is_available=True)
+        .values("product")
+        .annotate(sold=Sum("quantity"))
+        .values_list("product", "sold")
+    )
+
+    def entries():
+        products = Product.objects.filter(is_available=True).values_list("id", "name", "slug", "review_count")
+        for product_id, name, slug, review_count in products.iterator(chunk_size=2000):
+            yield name, sales.get(product_id, 0) + review_count, "product", slug
+
+        available = Count("products", filter=Q(products__is_available=True))
+        for model, kind in ((Brand, "brand"), (Category, "category")):
+            for name, slug, products_count in model.objects.annotate(n=available).values_list("name", "slug", "n"):
+                yield name, products_count, kind, slug
+
+    return SuggestIndex(entries())
+
+
+_index = None
+_generations = None
+_lock = threading.Lock()
+
+
+def _rebuild(generations, close_connection=False):
+    """Строит новый индекс; вызывается с захваченным _lock и отпускает его"""
+    global _index, _generations
+    try:
+        _index = build_index()
+        _generations = generations
+    finally:
+        _lock.release()
+        if close_connection:
+            connection.close()
+
+
+def get_index():
+    """Текущий индекс. Пока новый строится в фоне, запросы обслуживает предыдущий"""
+    # Поколения читаются до построения: правка во время построения вызовет еще одно
+    generations = get_generations(INDEX_TAGS)
+    if _index is None:
+        _lock.acquire()
+        if _index is None:
+            _rebuild(generations)
+        else:
+            _lock.release()
+    elif generations != _generations and _lock.acquire(blocking=False):
+        threading.Thread(target=_rebuild, args=(generations,), kwargs={"close_connection": True}, daemon=True).start()
+    return _index
+
+
+def suggest(query, limit=10):
+    return get_index().lookup(query, limit)
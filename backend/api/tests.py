@@ -1,3 +1,1115 @@
-from django.test import TestCase
+import copy
+import csv
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from unittest import mock
+from pathlib import Path
+from uuid import uuid4
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import QuerySet
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from . import bitmaps, feeds
+from .renderers import FastJSONRenderer
+from .cache_utils import get_generations, get_or_set, invalidate
+from .models import (
+    Brand,
+    Cart,
+    CartItem,
+    Category,
+    InsufficientStock,
+    Order,
+    OrderItem,
+    Product,
+    ProductDocument,
+    ProductFile,
+    ProductImage,
+    ProductTagRelationship,
+    Review,
+    StockReservation,
+    Tag,
+)
+from .serializers import OrderCreateSerializer
+
+
+# Однопиксельный GIF для полей изображений
+GIF = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,"
+    b"\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+
+
+class IsolatedCacheMixin:
+    """Свой файл общего кеша и свой L1 на класс тестов.
+
+    Ключи идемпотентности, кешированные ответы и поколения тегов не переходят ни из других классов
+    и прошлых запусков, ни из dev-сервера, с каким бы раннером ни запускались тесты.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp(prefix="fashionstore-cache-")
+        cls.addClassCleanup(shutil.rmtree, directory, ignore_errors=True)
+        caches = copy.deepcopy(settings.CACHES)
+        caches["shared"]["LOCATION"] = Path(directory) / "cache.sqlite3"
+        caches["default"]["LOCATION"] = directory
+        settings_override = override_settings(CACHES=caches)
+        settings_override.enable()
+        cls.addClassCleanup(settings_override.disable)
+        super().setUpClass()
+
+
+def use_temporary_media(test):
+    """Файлы теста пишутся во временный MEDIA_ROOT, который удаляется после теста"""
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    settings_override = override_settings(MEDIA_ROOT=media_root)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+
+
+class ConcurrentCheckoutTests(IsolatedCacheMixin, TransactionTestCase):
+    """Параллельные оформления заказов не уводят остаток в минус"""
+
+    STOCK = 5
+    BUYERS = 20
+
+    def setUp(self):
+        # Пересборка документов после каждого коммита писала бы в ту же базу и мешала бы потокам теста.
+        # Патч ставится здесь, а не декоратором класса: тот не действует на setUp
+        patcher = mock.patch("api.documents.schedule")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), stock=self.STOCK
+        )
+        self.carts = []
+        for number in range(self.BUYERS):
+            user = User.objects.create(username=f"buyer{number}")
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+            self.carts.append(cart)
+
+    def checkout(self, cart, results, barrier):
+        barrier.wait()
+        try:
+            # SQLite в тестах отвечает "database table is locked" вместо ожидания - повторяем
+            for _ in range(200):
+                try:
+                    Order.objects.create_from_cart(cart.id, cart.user, shipping_address="Адрес", phone_number="1")
+                    results.append("ordered")
+                    return
+                except InsufficientStock:
+                    results.append("rejected")
+                    return
+                except OperationalError:
+                    time.sleep(0.01)
+            results.append("locked")
+        finally:
+            close_old_connections()
+            connection.close()
+
+    def test_one_sku_is_never_oversold(self):
+        results = []
+        barrier = threading.Barrier(self.BUYERS)
+        threads = [threading.Thread(target=self.checkout, args=(cart, results, barrier)) for cart in self.carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.product.refresh_from_db()
+        self.assertEqual(results.count("ordered"), self.STOCK)
+        self.assertEqual(results.count("rejected"), self.BUYERS - self.STOCK)
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+
+    def test_cancel_restocks_once(self):
+        cart = self.carts[0]
+        order = Order.objects.create_from_cart(cart.id, cart.user, shipping_address="Адрес", phone_number="1")
+
+        self.assertTrue(Order.objects.set_status(order, "cancelled"))
+        self.assertFalse(Order.objects.set_status(order, "cancelled"))
+        # Отмененный заказ - конечное состояние
+        self.assertFalse(Order.objects.set_status(order, "refunded"))
+        self.assertEqual(list(order.status_history.values_list("from_status", "to_status")), [("pending", "cancelled")])
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.STOCK)
+
+
+class StockReservationTests(IsolatedCacheMixin, APITestCase):
+    """Резервы позиций корзины: занятый остаток не достается другим корзинам до истечения резерва"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), stock=2
+        )
+        self.first = User.objects.create(username="first")
+        self.second = User.objects.create(username="second")
+
+    def add(self, user, quantity):
+        cart, created = Cart.objects.get_or_create(user=user)
+        self.client.force_authenticate(user)
+        return self.client.post(
+            "/api/cart-items/", {"cart": cart.id, "product": self.product.pk, "quantity": quantity}, format="json"
+        )
+
+    def test_hold_refuses_other_cart(self):
+        self.assertEqual(self.add(self.first, 2).status_code, 201)
+        self.assertEqual(list(StockReservation.objects.values_list("quantity", flat=True)), [2])
+
+        response = self.add(self.second, 1)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Not enough stock", "available": "0"})
+        self.assertFalse(CartItem.objects.filter(cart__user=self.second).exists())
+
+    def test_expired_hold_is_released(self):
+        self.add(self.first, 2)
+        StockReservation.objects.update(expires_at=timezone.now() - timezone.timedelta(seconds=1))
+
+        self.assertEqual(self.add(self.second, 1).status_code, 201)
+        self.assertEqual(StockReservation.objects.release_expired(), 1)
+        self.assertEqual(
+            list(StockReservation.objects.active().values_list("cart_item__cart__user__username", flat=True)),
+            ["second"],
+        )
+
+    def test_checkout_consumes_holds(self):
+        self.add(self.first, 2)
+        cart = Cart.objects.get(user=self.first)
+
+        response = self.client.post(
+            "/api/orders/", {"cart_id": cart.id, "shipping_address": "Адрес", "phone_number": "1"}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(StockReservation.objects.exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+
+
+class CartSyncTests(IsolatedCacheMixin, APITestCase):
+    """Пакетная синхронизация корзины резервирует позиции и не трогает корзину при нехватке"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.sneakers = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), stock=2
+        )
+        self.boots = Product.objects.create(
+            name="Ботинки", slug="boots", category=category, brand=brand, price=Decimal("200.00"), stock=5
+        )
+        self.first = User.objects.create(username="first")
+        self.second = User.objects.create(username="second")
+
+    def sync(self, user, *operations):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/carts/my_cart/sync/", {"operations": list(operations)}, format="json")
+
+    def test_sync_holds_every_line(self):
+        response = self.sync(
+            self.first,
+            {"op": "add", "product": self.sneakers.pk, "quantity": 1},
+            {"op": "add", "product": self.sneakers.pk, "quantity": 1},
+            {"op": "set", "product": self.boots.pk, "quantity": 3},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        lines = {item["product"]: item["quantity"] for item in response.json()["items"]}
+        self.assertEqual(lines, {self.sneakers.pk: 2, self.boots.pk: 3})
+        holds = dict(StockReservation.objects.active().values_list("product_id", "quantity"))
+        self.assertEqual(holds, {self.sneakers.pk: 2, self.boots.pk: 3})
+
+    def test_other_cart_is_refused(self):
+        self.sync(self.first, {"op": "set", "product": self.sneakers.pk, "quantity": 2})
+
+        response = self.sync(
+            self.second,
+            {"op": "add", "product": self.boots.pk, "quantity": 1},
+            {"op": "add", "product": self.sneakers.pk, "quantity": 1},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(),
+            {
+                "error": "Not enough stock",
+                "items": [{"product": self.sneakers.pk, "name": "Кеды", "requested": 1, "available": 0}],
+            },
+        )
+        # Операции применяются все или ни одной
+        self.assertFalse(CartItem.objects.filter(cart__user=self.second).exists())
+        self.assertFalse(StockReservation.objects.filter(cart_item__cart__user=self.second).exists())
+
+
+class CategoryTreeTests(IsolatedCacheMixin, TestCase):
+    """Перенос поддерева поддерживает пути, уровни и счетчики доступных товаров"""
+
+    def setUp(self):
+        self.clothes = Category.objects.create(name="Одежда", slug="clothes")
+        self.sale = Category.objects.create(name="Распродажа", slug="sale")
+        self.outerwear = Category.objects.create(name="Верхняя одежда", slug="outerwear", parent=self.clothes)
+        self.coats = Category.objects.create(name="Пальто", slug="coats", parent=self.outerwear)
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        Product.objects.create(name="Пальто", slug="coat", category=self.coats, brand=brand, price=Decimal("1.00"))
+
+    def counts(self):
+        return dict(Category.objects.values_list("slug", "products_count"))
+
+    def test_move_subtree(self):
+        self.outerwear.parent = self.sale
+        self.outerwear.save()
+
+        coats = Category.objects.get(pk=self.coats.pk)
+        self.assertEqual(coats.ancestor_ids, [self.sale.pk, self.outerwear.pk])
+        self.assertEqual(coats.depth, 2)
+        self.assertEqual(self.counts(), {"clothes": 0, "sale": 1, "outerwear": 1, "coats": 1})
+
+    def test_stale_instance_uses_current_path(self):
+        stale = Category.objects.get(pk=self.coats.pk)
+        self.outerwear.parent = self.sale
+        self.outerwear.save()
+
+        stale.parent = self.clothes
+        stale.save()
+
+        self.assertEqual(Category.objects.get(pk=self.coats.pk).ancestor_ids, [self.clothes.pk])
+        self.assertEqual(self.counts(), {"clothes": 1, "sale": 0, "outerwear": 0, "coats": 1})
+
+    def test_cycle_is_rejected_before_write(self):
+        self.clothes.parent = self.coats
+        with self.assertRaises(ValueError):
+            self.clothes.save()
+
+        self.assertIsNone(Category.objects.get(pk=self.clothes.pk).parent_id)
+        self.assertEqual(Category.objects.get(pk=self.coats.pk).depth, 2)
+
+
+class IdempotencyTests(IsolatedCacheMixin, TestCase):
+    """Повтор POST с тем же Idempotency-Key не выполняет действие второй раз"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="buyer")
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), stock=10
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=1)
+        self.client.force_login(self.user)
+        # Общий кеш живет весь класс тестов, а id пользователей повторяются - ключи берем уникальные
+        self.key = str(uuid4())
+
+    def post_order(self, client=None, **data):
+        return (client or self.client).post(
+            "/api/orders/",
+            {"cart_id": self.cart.id, "shipping_address": "Адрес", "phone_number": "1", **data},
+            content_type="application/json",
+            headers={"Idempotency-Key": self.key},
+        )
+
+    def test_replay_returns_stored_response(self):
+        first = self.post_order()
+        second = self.post_order()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_reused_key_with_other_body(self):
+        self.post_order()
+        response = self.post_order(customer_notes="Другой заказ")
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_conflict_while_in_progress(self):
+        retries = []
+        create = OrderCreateSerializer.create
+
+        def create_with_retry(serializer, validated_data):
+            retries.append(self.post_order())
+            return create(serializer, validated_data)
+
+        with mock.patch.object(OrderCreateSerializer, "create", create_with_retry):
+            response = self.post_order()
+
+        self.assertEqual(retries[0].status_code, 409)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_server_error_is_not_stored(self):
+        client = Client(raise_request_exception=False)
+        client.force_login(self.user)
+        with mock.patch.object(Order.objects, "create_from_cart", side_effect=RuntimeError):
+            self.assertEqual(self.post_order(client).status_code, 500)
+
+        response = self.post_order(client)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class AnonymousIdempotencyTests(IsolatedCacheMixin, TestCase):
+    """Анонимные ключи разделяются по сессиям"""
+
+    def setUp(self):
+        use_temporary_media(self)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        product = Product.objects.create(name="Кеды", slug="sneakers", category=category, brand=brand, price=1)
+        self.file = ProductFile.objects.create(product=product, name="Инструкция", file=ContentFile(b"pdf", "a.pdf"))
+        self.key = str(uuid4())
+
+    def download(self, client):
+        return client.post(f"/api/product-files/{self.file.pk}/download/", headers={"Idempotency-Key": self.key})
+
+    def test_sessions_do_not_share_keys(self):
+        first, second = Client(), Client()
+        first.session.save()
+        second.session.save()
+
+        self.assertEqual(self.download(first).json()["downloads_count"], 1)
+        self.assertEqual(self.download(second).json()["downloads_count"], 2)
+        replay = self.download(first)
+        self.assertEqual(replay["Idempotent-Replayed"], "true")
+        self.assertEqual(replay.json()["downloads_count"], 1)
+
+    def test_key_without_session_is_refused(self):
+        self.assertEqual(self.download(Client()).status_code, 400)
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.downloads_count, 0)
+
+
+class OrderTransitionTests(IsolatedCacheMixin, TestCase):
+    """Массовая смена статусов заказов по графу Order.TRANSITIONS"""
+
+    STOCK = 10
+
+    def setUp(self):
+        self.user = User.objects.create(username="buyer")
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), stock=self.STOCK
+        )
+
+    def order(self, status, quantity=1, stock_reserved=True):
+        order = Order.objects.create(
+            user=self.user, status=status, shipping_address="Адрес", phone_number="1", stock_reserved=stock_reserved
+        )
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity, price=self.product.price)
+        return order
+
+    def stock(self):
+        self.product.refresh_from_db()
+        return self.product.stock
+
+    def test_one_update_per_source_status(self):
+        pending = [self.order("pending"), self.order("pending")]
+        processing = [self.order("processing"), self.order("processing")]
+        delivered = self.order("delivered")
+        ids = [order.pk for order in [*pending, *processing, delivered]]
+
+        with CaptureQueriesContext(connection) as queries:
+            result = Order.objects.transition(ids, "cancelled")
+
+        updates = [query["sql"] for query in queries if query["sql"].startswith('UPDATE "api_order"')]
+        self.assertEqual(len(updates), 2)
+        self.assertCountEqual(result["changed"], [order.pk for order in [*pending, *processing]])
+        self.assertEqual(result["rejected"], {delivered.pk: "delivered"})
+
+    def test_restocks_once_in_one_update(self):
+        orders = [self.order("pending", quantity=2), self.order("processing", quantity=3)]
+        ids = [order.pk for order in orders]
+
+        with CaptureQueriesContext(connection) as queries:
+            Order.objects.transition(ids, "cancelled")
+        restocks = [query["sql"] for query in queries if query["sql"].startswith('UPDATE "api_product"')]
+        self.assertEqual(len(restocks), 1)
+        self.assertEqual(self.stock(), self.STOCK + 5)
+
+        # Повторная отмена и переход из отмененного в возврат не возвращают товар второй раз
+        self.assertEqual(Order.objects.transition(ids, "cancelled")["changed"], [])
+        self.assertEqual(Order.objects.transition(ids, "refunded")["changed"], [])
+        self.assertEqual(self.stock(), self.STOCK + 5)
+
+    def test_legacy_order_is_not_restocked(self):
+        legacy, reserved = self.order("pending", quantity=4, stock_reserved=False), self.order("pending", quantity=1)
+
+        result = Order.objects.transition([legacy.pk, reserved.pk], "cancelled")
+
+        self.assertCountEqual(result["changed"], [legacy.pk, reserved.pk])
+        self.assertEqual(self.stock(), self.STOCK + 1)
+
+    def test_history_rows(self):
+        order = self.order("pending")
+        Order.objects.transition([order.pk], "processing", changed_by=self.admin)
+        Order.objects.transition([order.pk], "shipped")
+        Order.objects.transition([order.pk], "pending")
+
+        self.assertEqual(
+            list(order.status_history.values_list("from_status", "to_status", "changed_by")),
+            [("pending", "processing", self.admin.pk), ("processing", "shipped", None)],
+        )
+
+    def test_concurrent_change_is_rejected(self):
+        first, second = self.order("pending", quantity=2), self.order("pending", quantity=3)
+        update = QuerySet.update
+        raced = []
+
+        def racing_update(queryset, **kwargs):
+            # Параллельный запрос успевает перевести второй заказ между чтением статусов и UPDATE
+            if queryset.model is Order and not raced:
+                raced.append(second.pk)
+                update(Order.objects.filter(pk=second.pk), status="processing")
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, "update", racing_update):
+            result = Order.objects.transition([first.pk, second.pk], "cancelled")
+
+        self.assertEqual(result, {"changed": [first.pk], "rejected": {second.pk: "processing"}})
+        self.assertEqual(Order.objects.get(pk=second.pk).status, "processing")
+        self.assertEqual(list(second.status_history.all()), [])
+        self.assertEqual(self.stock(), self.STOCK + 2)
+
+    def test_missing_ids_are_rejected(self):
+        order = self.order("pending")
+        missing = order.pk + 1000
+        self.client.force_login(self.admin)
+
+        response = self.client.post(
+            "/api/orders/bulk_status/",
+            {"ids": [order.pk, missing], "status": "cancelled"},
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"changed": [order.pk], "rejected": {str(missing): None}})
+
+
+class FeaturedResponseCacheTests(IsolatedCacheMixin, APITestCase):
+    """Ответ из устаревшего значения stale-while-revalidate не попадает в кеш ответов"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"), is_featured=True
+        )
+
+    def featured_names(self, response):
+        return [product["name"] for product in response.json()]
+
+    def test_renamed_product_is_not_served_stale(self):
+        with mock.patch("api.cache_utils.threading.Thread") as thread:
+            self.assertEqual(self.featured_names(self.client.get("/api/products/featured/")), ["Кеды"])
+            with self.captureOnCommitCallbacks(execute=True):
+                self.product.name = "Кроссовки"
+                self.product.save()
+
+            # Пока идет фоновый пересчет, отдается прежнее значение, но без ETag и мимо кеша ответов
+            stale = self.client.get("/api/products/featured/")
+            self.assertEqual(self.featured_names(stale), ["Кеды"])
+            self.assertNotIn("ETag", stale)
+
+            recompute = thread.call_args.kwargs
+            recompute["target"](*recompute["args"][:-1], False)
+
+        for _ in range(3):
+            self.assertEqual(self.featured_names(self.client.get("/api/products/featured/")), ["Кроссовки"])
+
+
+class ProductDocumentTests(IsolatedCacheMixin, APITestCase):
+    """Страница товара из документа совпадает с ответом сериализатора"""
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = Product.objects.create(
+                name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+            )
+            ProductImage.objects.create(product=self.product, image=ContentFile(GIF, "0.gif"), is_primary=True)
+            ProductImage.objects.create(product=self.product, image=ContentFile(GIF, "1.gif"), order=1)
+            ProductFile.objects.create(product=self.product, name="Инструкция", file=ContentFile(b"pdf", "a.pdf"))
+
+    def test_document_matches_serializer(self):
+        self.assertTrue(ProductDocument.objects.filter(pk=self.product.pk).exists())
+        from_document = self.client.get("/api/products/sneakers/").json()
+
+        cache.clear()
+        ProductDocument.objects.all().delete()
+        from_serializer = self.client.get("/api/products/sneakers/").json()
+
+        self.assertEqual(from_document, from_serializer)
+        self.assertTrue(from_document["images"][0]["image"].startswith("http://testserver/media/"))
+
+
+class CatalogBitmapTests(IsolatedCacheMixin, APITestCase):
+    """Битовый индекс видит изменения других процессов по поколениям тегов"""
+
+    def setUp(self):
+        cache.clear()
+        bitmaps.reset()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+        )
+        self.tag = Tag.objects.create(name="Лето")
+
+    def tagged(self):
+        response = self.client.get("/api/products/", {"tags": self.tag.pk})
+        return [product["id"] for product in response.json()["results"]]
+
+    def test_change_from_other_process(self):
+        self.assertEqual(self.tagged(), [])
+
+        # Другой воркер привязал тег: сигналы этого процесса не сработали, поднялись только поколения
+        ProductTagRelationship.objects.bulk_create([ProductTagRelationship(product=self.product, tag=self.tag)])
+        invalidate("product", "tag")
+
+        self.assertEqual(self.tagged(), [self.product.pk])
+
+
+class ProductReviewsTests(IsolatedCacheMixin, APITestCase):
+    """Отзывы товара"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+        )
+        for number in range(3):
+            user = User.objects.create(username=f"reviewer{number}")
+            Review.objects.create(product=self.product, user=user, rating=number + 3, comment="Отзыв")
+
+    def test_reviews_do_not_load_product_details(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/products/sneakers/reviews/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 3)
+        for table in ("api_productimage", "api_productfile", "api_producttagrelationship"):
+            self.assertFalse([query for query in queries if table in query["sql"]], table)
+
+
+class ReviewRatingTests(IsolatedCacheMixin, APITestCase):
+    """Агрегаты рейтинга продукта поддерживаются инкрементально при изменении отзывов"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.sneakers = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+        )
+        self.boots = Product.objects.create(
+            name="Ботинки", slug="boots", category=category, brand=brand, price=Decimal("200.00")
+        )
+        self.users = [User.objects.create(username=f"reviewer{number}") for number in range(2)]
+
+    def review(self, user, product, rating):
+        self.client.force_authenticate(user)
+        data = {"user": user.pk, "product": product.pk, "rating": rating}
+        response = self.client.post("/api/reviews/", data, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["id"]
+
+    def aggregates(self, product):
+        product.refresh_from_db()
+        return product.review_count, product.rating_sum, product.average_rating, product.rating_histogram
+
+    def test_create_update_delete(self):
+        first = self.review(self.users[0], self.sneakers, 5)
+        self.review(self.users[1], self.sneakers, 2)
+        self.assertEqual(self.aggregates(self.sneakers), (2, 7, 3.5, {1: 0, 2: 1, 3: 0, 4: 0, 5: 1}))
+
+        self.client.force_authenticate(self.users[0])
+        self.client.patch(f"/api/reviews/{first}/", {"rating": 4}, format="json")
+        self.assertEqual(self.aggregates(self.sneakers), (2, 6, 3.0, {1: 0, 2: 1, 3: 0, 4: 1, 5: 0}))
+
+        # API не дает сменить продукт отзыва, но админка может: оценка переходит к другому продукту
+        review = Review.objects.get(pk=first)
+        review.product = self.boots
+        review.save()
+        self.assertEqual(self.aggregates(self.sneakers), (1, 2, 2.0, {1: 0, 2: 1, 3: 0, 4: 0, 5: 0}))
+        self.assertEqual(self.aggregates(self.boots), (1, 4, 4.0, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0}))
+
+        self.client.delete(f"/api/reviews/{first}/")
+        self.assertEqual(self.aggregates(self.boots), (0, 0, 0.0, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}))
+
+        # Полный пересчет по таблице отзывов ничего не меняет
+        expected = [self.aggregates(product) for product in (self.sneakers, self.boots)]
+        Product.objects.rebuild_ratings()
+        self.assertEqual([self.aggregates(product) for product in (self.sneakers, self.boots)], expected)
+
+
+class ProductKeysetPaginationTests(IsolatedCacheMixin, APITestCase):
+    """Курсор следующей страницы не дает дублей и пропусков, если между страницами добавлены товары"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name="Обувь", slug="shoes")
+        self.brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.originals = [self.create(number) for number in range(5)]
+
+    def create(self, number):
+        # Одна цена на все товары: порядок внутри нее держит только id
+        return Product.objects.create(
+            name=f"Товар {number}", slug=f"product-{number}", category=self.category, brand=self.brand, price="100.00"
+        ).pk
+
+    def walk(self, params):
+        seen = []
+        response = self.client.get("/api/products/", {**params, "page_size": 2})
+        while True:
+            seen.extend(product["id"] for product in response.json()["results"])
+            if len(seen) == 2:
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.create(10)
+                    self.create(11)
+            next_url = response.json()["next"]
+            if next_url is None:
+                return seen
+            response = self.client.get(next_url)
+
+    def test_newest_first(self):
+        seen = self.walk({})
+
+        self.assertEqual(seen, self.originals[::-1])
+
+    def test_ties_on_sort_field(self):
+        seen = self.walk({"ordering": "price"})
+
+        # Новые товары с той же ценой идут после старых по id и попадают в хвост обхода
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(seen[:5], self.originals)
+        self.assertEqual(len(seen), 7)
+
+
+class ProductSearchTests(IsolatedCacheMixin, APITestCase):
+    """Полнотекстовый поиск находит товары по другим формам слова"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        products = {
+            "running": ("Беговые кроссовки", ""),
+            "sneakers": ("Кеды", "Легче, чем кроссовки"),
+            "boots": ("Зимние сапоги", "Чёрная кожа"),
+        }
+        self.ids = {}
+        for slug, (name, description) in products.items():
+            product = Product.objects.create(
+                name=name, slug=slug, description=description, category=category, brand=brand, price="100.00"
+            )
+            self.ids[slug] = product.pk
+
+    def found(self, query):
+        response = self.client.get("/api/products/search/", {"q": query})
+        return [product["id"] for product in response.json()["results"]]
+
+    def test_word_forms(self):
+        self.assertEqual(self.found("сапогами"), [self.ids["boots"]])
+        self.assertEqual(self.found("черной"), [self.ids["boots"]])
+        self.assertEqual(self.found("зимний сапог"), [self.ids["boots"]])
+
+    def test_name_outranks_description(self):
+        self.assertEqual(self.found("кроссовками"), [self.ids["running"], self.ids["sneakers"]])
+
+
+class SuggestTests(IsolatedCacheMixin, APITestCase):
+    """Подсказки по префиксу любого слова названия, популярные - первыми"""
+
+    def setUp(self):
+        cache.clear()
+        # Индекс живет в памяти процесса - каждый тест строит свой
+        patcher = mock.patch("api.suggest._index", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Nike", slug="nike")
+        for name, slug, popularity in (
+            ("Кроссовки Nike Air", "air", 5),
+            ("Кроссовки Nike Pegasus", "pegasus", 30),
+            ("Кеды Converse", "converse", 10),
+            ("Кроссовки Puma", "puma", 0),
+        ):
+            Product.objects.create(name=name, slug=slug, category=category, brand=brand, price="100.00")
+            Product.objects.filter(slug=slug).update(review_count=popularity)
+
+    def suggest(self, query, limit=10):
+        response = self.client.get("/api/products/suggest/", {"q": query, "limit": limit})
+        return [item["slug"] for item in response.json()]
+
+    def test_prefix_of_any_word(self):
+        self.assertEqual(self.suggest("nike"), ["pegasus", "air", "nike"])
+        self.assertEqual(self.suggest("pega"), ["pegasus"])
+        self.assertEqual(self.suggest("nike a"), ["air"])
+
+    def test_ranked_by_popularity(self):
+        self.assertEqual(self.suggest("кр"), ["pegasus", "air", "puma"])
+        self.assertEqual(self.suggest("к", limit=2), ["pegasus", "converse"])
+
+
+class ProductFacetTests(IsolatedCacheMixin, APITestCase):
+    """Счетчик фасета учитывает все активные фильтры, кроме фильтра самого фасета"""
+
+    def setUp(self):
+        cache.clear()
+        bitmaps.reset()
+        shoes = Category.objects.create(name="Обувь", slug="shoes")
+        bags = Category.objects.create(name="Сумки", slug="bags")
+        adidas = Brand.objects.create(name="Adidas", slug="adidas")
+        nike = Brand.objects.create(name="Nike", slug="nike")
+        summer = Tag.objects.create(name="Лето")
+        hit = Tag.objects.create(name="Хит")
+        self.params = {"category": shoes.pk, "tags": summer.pk}
+        for slug, category, brand, price, tags in (
+            ("sneakers", shoes, adidas, "500.00", [summer]),
+            ("boots", shoes, nike, "2000.00", [hit]),
+            ("backpack", bags, adidas, "7000.00", [summer, hit]),
+            ("purse", bags, nike, "700.00", []),
+        ):
+            product = Product.objects.create(name=slug, slug=slug, category=category, brand=brand, price=price)
+            for tag in tags:
+                ProductTagRelationship.objects.create(product=product, tag=tag)
+
+    def facets(self, **params):
+        response = self.client.get("/api/products/", params)
+        facets = response.json()["facets"]
+        return {
+            **{name: [(row["name"], row["count"]) for row in facets[name]] for name in ("category", "brand", "tags")},
+            "price": [row["count"] for row in facets["price"]],
+        }
+
+    def test_counts_with_filters(self):
+        facets = self.facets(**self.params)
+
+        # Категория считается по товарам с тегом "Лето", теги - по товарам категории "Обувь"
+        self.assertEqual(facets["category"], [("Обувь", 1), ("Сумки", 1)])
+        self.assertEqual(facets["tags"], [("Лето", 1), ("Хит", 1)])
+        self.assertEqual(facets["brand"], [("Adidas", 1)])
+        self.assertEqual(facets["price"], [1, 0, 0, 0, 0, 0])
+
+    def test_multiple_values(self):
+        brands = ",".join(str(pk) for pk in Brand.objects.values_list("pk", flat=True))
+        facets = self.facets(brand=brands, price_max="1000")
+
+        self.assertEqual(facets["category"], [("Обувь", 1), ("Сумки", 1)])
+        self.assertEqual(facets["brand"], [("Adidas", 1), ("Nike", 1)])
+        self.assertEqual(facets["price"], [2, 1, 1, 0, 0, 0])
+
+
+class CacheGenerationTests(IsolatedCacheMixin, APITestCase):
+    """Сохранение модели поднимает поколения ее тегов после коммита"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+        )
+        self.other = Product.objects.create(
+            name="Ботинки", slug="boots", category=category, brand=brand, price=Decimal("200.00")
+        )
+        self.tags = ("product", f"product:{self.product.pk}", f"product:{self.other.pk}", "category")
+
+    def test_save_bumps_after_commit(self):
+        before = get_generations(self.tags)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Кроссовки"
+            self.product.save()
+            self.assertEqual(get_generations(self.tags), before)
+        after = get_generations(self.tags)
+
+        changed = {tag for tag in self.tags if after[tag] != before[tag]}
+        self.assertEqual(changed, {"product", f"product:{self.product.pk}"})
+
+    def test_rollback_keeps_generations(self):
+        before = get_generations(self.tags)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                self.product.save()
+                raise ValueError
+
+        self.assertEqual(get_generations(self.tags), before)
+
+    def test_cached_value_is_recomputed(self):
+        def name():
+            return Product.objects.get(pk=self.product.pk).name
+
+        tags = ("product", f"product:{self.product.pk}")
+        self.assertEqual(get_or_set("test", self.product.pk, tags, name), "Кеды")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Кроссовки"
+            self.product.save()
+
+        self.assertEqual(get_or_set("test", self.product.pk, tags, name), "Кроссовки")
+
+
+class ConditionalGetTests(IsolatedCacheMixin, APITestCase):
+    """Совпадающий If-None-Match получает 304 без выборки и сериализации"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.product = Product.objects.create(
+            name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00")
+        )
+
+    def test_not_modified(self):
+        etag = self.client.get("/api/products/sneakers/")["ETag"]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/products/sneakers/", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        for table in ("api_productdocument", "api_productimage", "api_review"):
+            self.assertFalse([query for query in queries if table in query["sql"]], table)
+
+    def test_changed_product(self):
+        etag = self.client.get("/api/products/sneakers/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Кроссовки"
+            self.product.save()
+
+        response = self.client.get("/api/products/sneakers/", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["name"], "Кроссовки")
+
+    def test_etag_depends_on_query(self):
+        etag = self.client.get("/api/products/")["ETag"]
+
+        self.assertEqual(self.client.get("/api/products/", headers={"If-None-Match": etag}).status_code, 304)
+        response = self.client.get("/api/products/", {"ordering": "price"}, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+
+class FastJSONRendererTests(IsolatedCacheMixin, APITestCase):
+    """Рендерер на orjson выдает те же байты, что и стандартный JSONRenderer"""
+
+    def assertSameBytes(self, data, renderer_context=None):
+        expected = JSONRenderer().render(data, "application/json", renderer_context)
+        self.assertEqual(FastJSONRenderer().render(data, "application/json", renderer_context), expected)
+
+    def test_value_types(self):
+        moscow = datetime.timezone(datetime.timedelta(hours=3))
+        self.assertSameBytes(
+            {
+                "text": "Кеды \u2028 \u2029 \"x\" </script>",
+                "decimal": Decimal("100.50"),
+                "utc": datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+                "local": datetime.datetime(2024, 5, 1, 12, 30, tzinfo=moscow),
+                "naive": datetime.datetime(2024, 5, 1, 12, 30, 15, 5),
+                "date": datetime.date(2024, 5, 1),
+                "time": datetime.time(12, 30, 15, 250000),
+                "uuid": uuid4(),
+                "lazy": gettext_lazy("Обувь"),
+                "keys": {1: "один", 2: None},
+                "numbers": [0, -1, 1.5, 2**70, True, False],
+                "tuple": ("a", "b"),
+            }
+        )
+
+    def test_api_payloads(self):
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        Product.objects.create(name="Кеды", slug="sneakers", category=category, brand=brand, price=Decimal("100.00"))
+
+        for url in ("/api/products/", "/api/products/sneakers/", "/api/categories/tree/"):
+            response = self.client.get(url)
+            self.assertSameBytes(response.data)
+
+    def test_indent_falls_back(self):
+        self.assertSameBytes({"name": "Кеды", "price": Decimal("1.00")}, {"indent": 2})
+
+
+class ProductExportTests(IsolatedCacheMixin, APITestCase):
+    """Выгрузка каталога в NDJSON и CSV: строка на товар, значения как в API, фильтры списка работают"""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        nike = Brand.objects.create(name="Nike", slug="nike")
+        self.brand = Brand.objects.create(name="Бренд", slug="brand")
+        Product.objects.create(name="Ботинки", slug="boots", category=category, brand=nike, price="300.00")
+        self.products = [
+            Product.objects.create(name=name, slug=slug, category=category, brand=self.brand, price=price, stock=stock)
+            for name, slug, price, stock in (
+                ("Кеды", "sneakers", Decimal("100.50"), 3),
+                ('Сапоги "Зима", 40', "winter", Decimal("2000.00"), 0),
+            )
+        ]
+
+    def export(self, export_format):
+        response = self.client.get(f"/api/products/export/{export_format}/", {"brand": self.brand.pk})
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content).decode()
+
+    def expected(self):
+        expected = []
+        for product in self.products:
+            product.refresh_from_db()
+            expected.append(
+                {
+                    "id": product.pk,
+                    "name": product.name,
+                    "slug": product.slug,
+                    "brand": "Бренд",
+                    "category": "Обувь",
+                    "price": str(product.price),
+                    "stock": product.stock,
+                    "is_available": True,
+                    "average_rating": 0.0,
+                    "review_count": 0,
+                    "updated_at": serializers.DateTimeField().to_representation(product.updated_at),
+                }
+            )
+        return expected
+
+    def test_ndjson(self):
+        response, content = self.export("ndjson")
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertTrue(content.endswith("\n"))
+        self.assertEqual([json.loads(line) for line in content.splitlines()], self.expected())
+
+    def test_csv(self):
+        # Строк больше, чем в одном куске ответа: проверяем и склейку кусков
+        with mock.patch("api.exports.LINES_PER_WRITE", 1):
+            response, content = self.export("csv")
+
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(csv.DictReader(content.splitlines()))
+        expected = [{name: str(value) for name, value in row.items()} for row in self.expected()]
+        self.assertEqual(rows, expected)
+
+
+class ProductFeedTests(IsolatedCacheMixin, APITestCase):
+    """Инкрементальное обновление фида дает тот же файл, что и полная пересборка"""
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.directory = Path(directory)
+        category = Category.objects.create(name="Обувь", slug="shoes")
+        brand = Brand.objects.create(name="Бренд", slug="brand")
+        self.products = {
+            slug: Product.objects.create(
+                name=name, slug=slug, category=category, brand=brand, price=Decimal("100.00"), stock=5
+            )
+            for slug, name in (("sneakers", "Кеды"), ("boots", "Ботинки"), ("slippers", "Тапочки"))
+        }
+        # Товары изменены давно: в следующее обновление попадут только правки теста
+        Product.objects.update(updated_at=timezone.now() - timezone.timedelta(days=1))
+
+    def build(self, name, full=False):
+        config = {**feeds.get_config(), "PATH": self.directory / name}
+        return feeds.FeedBuilder(config).build(full=full)
+
+    def offers(self, name):
+        lines = (self.directory / name).read_text(encoding="utf-8").splitlines()
+        return [line for line in lines if line.startswith("<offer ")]
+
+    def test_merge_after_update_and_delete(self):
+        self.assertEqual(self.build("products.yml"), {"offers": 3, "rendered": 3, "removed": 0, "full": True})
+
+        self.products["sneakers"].name = "Кеды белые"
+        self.products["sneakers"].save()
+        self.products["boots"].delete()
+        Product.objects.create(
+            name="Сапоги",
+            slug="winter",
+            category=self.products["sneakers"].category,
+            brand=self.products["sneakers"].brand,
+            price=Decimal("300.00"),
+        )
+
+        counts = self.build("products.yml")
+        self.build("rebuilt.yml", full=True)
+
+        # Перерисованы только измененный и новый товары, удаленный убран из файла
+        self.assertEqual(counts, {"offers": 3, "rendered": 2, "removed": 1, "full": False})
+        self.assertEqual(self.offers("products.yml"), self.offers("rebuilt.yml"))
+        self.assertIn("<name>Кеды белые</name>", self.offers("products.yml")[0])
+
+
+class MyCartQueryTests(IsolatedCacheMixin, APITestCase):
+    """Число запросов корзины не зависит от количества позиций"""
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.category = Category.objects.create(name="Обувь", slug="shoes")
+        self.brand = Brand.objects.create(name="Бренд", slug="brand")
+
+    def my_cart(self, size):
+        user = User.objects.create(username=f"buyer{size}")
+        cart = Cart.objects.create(user=user)
+        for number in range(size):
+            product = Product.objects.create(
+                name=f"Товар {number}",
+                slug=f"product-{size}-{number}",
+                category=self.category,
+                brand=self.brand,
+                price=Decimal("100.00"),
+            )
+            ProductImage.objects.create(product=product, image=ContentFile(GIF, f"{number}.gif"), is_primary=True)
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/carts/my_cart/")
+        self.assertEqual(len(response.json()["items"]), size)
+        self.assertTrue(all(item["product_image"] for item in response.json()["items"]))
+        self.assertEqual(response.json()["total_price"], 200 * size)
+        return len(queries)
+
+    def test_constant_query_count(self):
+        # Сессия, пользователь, корзина, позиции, их продукты и основные изображения
+        self.assertEqual([self.my_cart(2), self.my_cart(8)], [6, 6])
@@ -23,5 +23,7 @@ urlpatterns = [
     path("", include(router.urls)),
     path("auth/login/", views.login, name="login"),
     path("auth/register/", views.register, name="register"),
+    path("cache/stats/", views.cache_statistics, name="cache-stats"),
+    path("feeds/products.yml", views.product_feed, name="product-feed"),
     # path("auth/logout/", views.logout, name="logout"),
 ]
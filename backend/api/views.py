@@ -1,4 +1,4 @@
-from rest_framework import viewsets, status, filters
+from rest_framework import viewsets, status, filters, serializers
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
@@ -6,13 +6,30 @@ from rest_framework.authtoken.models import Token  # Если используе
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login as auth_login
-from django.db.models import Q, F, Count, Avg
+from django.db.models import Q, F, Count, Avg, Max
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from django.http import Http404
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from .models import *
 from .serializers import *
 from .utils import generate_order_pdf
-from .cache_utils import get_featured_products, get_categories_with_counts, clear_product_cache
+from .conditional import ConditionalGetMixin
+from .response_cache import ResponseCacheMixin
+from .idempotency import IdempotencyMixin
+from .cache_utils import get_featured_products, get_categories_with_counts, get_category_tree, stats as cache_stats
+from .pagination import ProductPagination, ReviewPagination, OrderPagination, RankedPagination
+from .filters import ProductFilter, ProductSearchFilter
+from .facets import compute_facets
+from .search import filter_queryset as filter_by_search, search_ids
+from .suggest import suggest as get_suggestions
+from .documents import render as render_document, schedule as schedule_documents
+from .exports import export_products, stream_json_array
+from .feeds import get_feed_path
+
+PRODUCT_ORDERING_FIELDS = ["name", "price", "created_at", "average_rating"]
 
 
 def generate_order_pdf_view(request, order_id):
@@ -24,12 +41,14 @@ def generate_order_pdf_view(request, order_id):
         raise Http404("Заказ с указанным ID не существует")
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(ResponseCacheMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    conditional_tags = ("category", "product")
+    cached_actions = ("products",)
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     search_fields = ["name", "slug"]
-    ordering_fields = ["name", "id"]
+    ordering_fields = ["name", "id", "path"]
     lookup_field = "slug"
 
     def get_permissions(self):
@@ -37,10 +56,25 @@ class CategoryViewSet(viewsets.ModelViewSet):
             return [IsAdminUser()]
         return [AllowAny()]
 
+    def get_queryset(self):
+        return self.get_serializer_class().optimize_queryset(super().get_queryset(), self.request)
+
+    @action(detail=False, methods=["get"])
+    def tree(self, request):
+        """Полное дерево категорий (кешируется)"""
+        return Response(get_category_tree())
+
+    @action(detail=True, methods=["get"])
+    def breadcrumbs(self, request, slug=None):
+        """Цепочка категорий от корня до текущей"""
+        category = get_object_or_404(Category, slug=slug)
+        ancestors = Category.objects.ancestors(category, include_self=True).values("id", "name", "slug", "depth")
+        return Response(list(ancestors))
+
     @action(detail=False, methods=["get"])
     def main(self, request):
         """Получение основных категорий (без родительских)"""
-        main_categories = Category.objects.main_categories()
+        main_categories = self.get_queryset().filter(parent__isnull=True)
         page = self.paginate_queryset(main_categories)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
@@ -48,21 +82,31 @@ class CategoryViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(main_categories, many=True)
         return Response(serializer.data)
 
-    @action(detail=True, methods=["get"])
+    @action(
+        detail=True,
+        methods=["get"],
+        pagination_class=ProductPagination,
+        ordering_fields=PRODUCT_ORDERING_FIELDS,
+    )
     def products(self, request, slug=None):
-        category = self.get_object()
-        products = Product.objects.filter(category=category, is_available=True)
+        category = get_object_or_404(Category, slug=slug)
+        # Товары всего поддерева одним запросом: подзапрос по диапазону материализованного пути
+        subtree = Category.objects.subtree(category).values("pk")
+        products = Product.objects.filter(category__in=subtree, is_available=True)
+        products = ProductListSerializer.optimize_queryset(products, request)
         page = self.paginate_queryset(products)
         if page is not None:
-            serializer = ProductListSerializer(page, many=True)
+            serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
             return self.get_paginated_response(serializer.data)
-        serializer = ProductListSerializer(products, many=True)
+        serializer = ProductListSerializer(products, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
 
-class BrandViewSet(viewsets.ModelViewSet):
+class BrandViewSet(ResponseCacheMixin, viewsets.ModelViewSet):
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
+    conditional_tags = ("brand", "product")
+    cached_actions = ("products",)
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     search_fields = ["name", "slug"]
     ordering_fields = ["name", "id"]
@@ -73,21 +117,31 @@ class BrandViewSet(viewsets.ModelViewSet):
             return [IsAdminUser()]
         return [AllowAny()]
 
-    @action(detail=True, methods=["get"])
+    def get_queryset(self):
+        return self.get_serializer_class().optimize_queryset(super().get_queryset(), self.request)
+
+    @action(
+        detail=True,
+        methods=["get"],
+        pagination_class=ProductPagination,
+        ordering_fields=PRODUCT_ORDERING_FIELDS,
+    )
     def products(self, request, slug=None):
-        brand = self.get_object()
+        brand = get_object_or_404(Brand, slug=slug)
         products = Product.objects.filter(brand=brand, is_available=True)
+        products = ProductListSerializer.optimize_queryset(products, request)
         page = self.paginate_queryset(products)
         if page is not None:
-            serializer = ProductListSerializer(page, many=True)
+            serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
             return self.get_paginated_response(serializer.data)
-        serializer = ProductListSerializer(products, many=True)
+        serializer = ProductListSerializer(products, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    conditional_tags = ("tag",)
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     search_fields = ["name"]
     ordering_fields = ["name", "id"]
@@ -98,13 +152,16 @@ class TagViewSet(viewsets.ModelViewSet):
         return [AllowAny()]
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ResponseCacheMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, filters.OrderingFilter]
     search_fields = ["name", "description", "brand__name", "brand__slug", "category__name", "category__slug"]
-    ordering_fields = ["name", "price", "created_at", "average_rating"]
-    filterset_fields = ["category", "brand", "is_available", "is_featured"]
+    ordering_fields = PRODUCT_ORDERING_FIELDS
+    filterset_class = ProductFilter
     lookup_field = "slug"
+    pagination_class = ProductPagination
+    conditional_tags = ("product", "category", "brand", "tag", "review")
+    cached_actions = ("list", "retrieve", "featured")
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -116,32 +173,64 @@ class ProductViewSet(viewsets.ModelViewSet):
     #     return [IsAdminUser()]
         return [AllowAny()]
 
-    def get_queryset(self):
+    def get_base_queryset(self):
+        """Продукты, видимые пользователю, без фильтров запроса"""
         queryset = super().get_queryset()
-
         if not self.request.user.is_staff:
             queryset = queryset.filter(is_available=True)
-
-        price_min = self.request.query_params.get("price_min")
-        price_max = self.request.query_params.get("price_max")
-
-        if price_min:
-            queryset = queryset.filter(price__gte=price_min)
-        if price_max:
-            queryset = queryset.filter(price__lte=price_max)
-
-        tags = self.request.query_params.get("tags")
-        if tags:
-            tag_ids = [int(tag_id) for tag_id in tags.split(",")]
-            queryset = queryset.filter(tags__id__in=tag_ids).distinct()
-
-        queryset = queryset.select_related("category", "brand").prefetch_related("images", "tags")
         return queryset
 
+    def get_queryset(self):
+        return self.get_serializer_class().optimize_queryset(self.get_base_queryset(), self.request)
+
+    def get_conditional_state(self):
+        """Для страницы товара - теги этого товара и его updated_at, для списков - весь каталог"""
+        if self.detail:
+            row = self.get_base_queryset().filter(slug=self.kwargs["slug"]).values_list("pk", "updated_at").first()
+            if row is None:
+                return None
+            product_id, updated_at = row
+            return ("category", "brand", "tag", f"product:{product_id}", f"document:{product_id}"), updated_at
+        updated_at = self.get_base_queryset().aggregate(updated_at=Max("updated_at"))["updated_at"]
+        return self.conditional_tags, updated_at
+
+    def retrieve(self, request, *args, **kwargs):
+        """Страница товара отдается из готового документа, если он собран не раньше последнего изменения товара.
+
+        Доступность проверяется по самому продукту: документ мог еще не догнать его.
+        """
+        row = (
+            self.get_base_queryset()
+            .filter(slug=kwargs["slug"])
+            .values_list("updated_at", "document__payload", "document__built_at")
+            .first()
+        )
+        if row is not None:
+            updated_at, payload, built_at = row
+            if payload is not None and built_at >= updated_at:
+                if "fields" in request.query_params or "omit" in request.query_params:
+                    fields = self.get_serializer().fields
+                    payload = {name: value for name, value in payload.items() if name in fields}
+                return Response(render_document(payload, request))
+        instance = self.get_object()
+        schedule_documents([instance.pk])
+        return Response(self.get_serializer(instance).data)
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        facet_queryset = ProductSearchFilter().filter_queryset(request, self.get_base_queryset(), self)
+        return self.add_facets(response, facet_queryset)
+
+    def add_facets(self, response, queryset):
+        """Добавляет блок facets к постраничному ответу"""
+        if isinstance(response.data, dict):
+            response.data["facets"] = compute_facets(queryset, self.request.query_params, self.filterset_class)
+        return response
+
     @action(detail=False, methods=["get"])
     def main_categories(self, request):
         """Основные категории (без родительских)"""
-        categories = Category.objects.filter(parent__isnull=True)
+        categories = Category.objects.main_categories().annotate(children_total=Count("children"))
         serializer = CategorySerializer(categories, many=True)
         return Response(serializer.data)
 
@@ -149,18 +238,39 @@ class ProductViewSet(viewsets.ModelViewSet):
     def price_list(self, request):
         """Возвращает список цен продуктов"""
         products = Product.objects.filter(is_available=True).values("id", "name", "price", "category__name")
-        return Response(list(products))
+        return stream_json_array(products)
+
+    @action(detail=False, methods=["get"], url_path=r"export/(?P<export_format>ndjson|csv)")
+    def export(self, request, export_format=None):
+        """Потоковая выгрузка каталога; принимает те же фильтры, что и список товаров"""
+        return export_products(self.filter_queryset(self.get_base_queryset()), export_format)
 
     @action(detail=False, methods=["get"])
     def product_names(self, request):
         """Возвращает список названий продуктов"""
         names = Product.objects.filter(is_available=True).values_list("name", flat=True)
-        return Response(list(names))
+        return stream_json_array(names)
 
-    @action(detail=True, methods=["get"])
+    @action(detail=False, methods=["get"])
+    def suggest(self, request):
+        """Подсказки по префиксу среди названий продуктов, брендов и категорий"""
+        query = request.query_params.get("q", "")
+        try:
+            limit = int(request.query_params.get("limit", 10))
+        except ValueError:
+            return Response({"error": "Invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_suggestions(query, max(limit, 1)))
+
+    @action(
+        detail=True,
+        methods=["get"],
+        pagination_class=ReviewPagination,
+        ordering_fields=["created_at", "rating", "updated_at"],
+    )
     def reviews(self, request, slug=None):
-        product = self.get_object()
-        reviews = product.reviews.all()
+        # Для списка отзывов нужен только id: get_queryset подгрузил бы изображения, файлы и теги для детальной карточки
+        product = get_object_or_404(self.get_base_queryset().only("id"), slug=slug)
+        reviews = product.reviews.select_related("user", "product")
         page = self.paginate_queryset(reviews)
         if page is not None:
             serializer = ReviewSerializer(page, many=True)
@@ -176,42 +286,34 @@ class ProductViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=["get"])
     def search(self, request):
-        query = request.query_params.get("q", "")
-        if query:
-            products = Product.objects.filter(
-                Q(name__icontains=query)
-                | Q(description__icontains=query)
-                | Q(brand__name__icontains=query)
-                | Q(brand__slug__icontains=query)
-                | Q(category__name__icontains=query)
-                | Q(category__slug__icontains=query),
-                is_available=True,
-            )
-        else:
-            products = Product.objects.filter(is_available=True)
+        query = request.query_params.get("q", "").strip()
+        available = Product.objects.filter(is_available=True)
+        found = filter_by_search(available, query) if query else available
+
+        if query and not request.query_params.get("ordering"):
+            # Без явной сортировки отдаем результаты в порядке релевантности
+            ranked_ids = search_ids(query)
+            matching = DjangoFilterBackend().filter_queryset(request, available.filter(pk__in=ranked_ids), self)
+            matching_ids = set(matching.values_list("pk", flat=True))
+            ranked_ids = [product_id for product_id in ranked_ids if product_id in matching_ids]
+
+            paginator = RankedPagination()
+            product_ids = paginator.paginate_queryset(ranked_ids, request, view=self)
+            products = ProductListSerializer.optimize_queryset(Product.objects.all(), request).in_bulk(product_ids)
+            page = [products[product_id] for product_id in product_ids if product_id in products]
+            serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
+            return self.add_facets(paginator.get_paginated_response(serializer.data), found)
+
+        products = DjangoFilterBackend().filter_queryset(request, found, self)
+        products = ProductListSerializer.optimize_queryset(products, request)
 
         page = self.paginate_queryset(products)
         if page is not None:
-            serializer = ProductListSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = ProductListSerializer(products, many=True)
+            serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
+            return self.add_facets(self.get_paginated_response(serializer.data), found)
+        serializer = ProductListSerializer(products, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
-    def perform_create(self, serializer):
-        """При создании товара очищаем кеш"""
-        product = serializer.save()
-        clear_product_cache()
-
-    def perform_update(self, serializer):
-        """При обновлении товара очищаем кеш"""
-        product = serializer.save()
-        clear_product_cache()
-
-    def perform_destroy(self, instance):
-        """При удалении товара очищаем кеш"""
-        instance.delete()
-        clear_product_cache()
-
 
 class ProductImageViewSet(viewsets.ModelViewSet):
     queryset = ProductImage.objects.all()
@@ -226,12 +328,13 @@ class ProductImageViewSet(viewsets.ModelViewSet):
         return [AllowAny()]
 
 
-class ProductFileViewSet(viewsets.ModelViewSet):
+class ProductFileViewSet(IdempotencyMixin, viewsets.ModelViewSet):
     queryset = ProductFile.objects.all()
     serializer_class = ProductFileSerializer
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ["product", "file_type"]
     ordering_fields = ["file_type", "name"]
+    idempotent_actions = ("download",)
 
     def get_permissions(self):
         if self.action in ["create", "update", "partial_update", "destroy"]:
@@ -253,6 +356,7 @@ class ReviewViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ["product", "user", "rating"]
     ordering_fields = ["created_at", "rating", "updated_at"]
+    pagination_class = ReviewPagination
 
     def get_permissions(self):
         # if self.action in ["create"]:
@@ -265,7 +369,7 @@ class ReviewViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = ReviewSerializer.optimize_queryset(super().get_queryset(), self.request)
         # Пользователи видят только свои отзывы или все, если они админы
         if not self.request.user.is_staff:
             if self.request.user.is_authenticated:
@@ -349,19 +453,20 @@ class WishlistItemViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return WishlistItem.objects.filter(wishlist__user=self.request.user)
+        return WishlistItem.objects.filter(wishlist__user=self.request.user).select_related("product")
 
     def perform_create(self, serializer):
         wishlist, created = Wishlist.objects.get_or_create(user=self.request.user)
         serializer.save(wishlist=wishlist)
 
 
-class CartViewSet(viewsets.ModelViewSet):
+class CartViewSet(IdempotencyMixin, viewsets.ModelViewSet):
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]  # Добавляем проверку авторизации
+    idempotent_actions = ("sync",)
 
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        return CartSerializer.optimize_queryset(Cart.objects.filter(user=self.request.user), self.request)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -372,21 +477,42 @@ class CartViewSet(viewsets.ModelViewSet):
         if not request.user.is_authenticated:
             return Response({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-        cart, created = Cart.objects.get_or_create(user=request.user)
+        cart, created = self.get_queryset().get_or_create(user=request.user)
         serializer = self.get_serializer(cart)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["post"], url_path="my_cart/sync")
+    def sync(self, request):
+        """Применяет пачку изменений корзины (add / set / remove) и возвращает итоговую корзину"""
+        serializer = CartSyncSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        try:
+            Cart.objects.sync(cart, serializer.validated_data["operations"], settings.STOCK_RESERVATION_TTL)
+        except InsufficientStock as exc:
+            return Response({"error": "Not enough stock", "items": exc.lines}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_serializer(self.get_queryset().get(pk=cart.pk)).data)
+
 
 class CartItemViewSet(viewsets.ModelViewSet):
     serializer_class = CartItemSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return CartItem.objects.filter(cart__user=self.request.user)
+        return CartItem.objects.filter(cart__user=self.request.user).select_related("product")
 
     def perform_create(self, serializer):
         cart, created = Cart.objects.get_or_create(user=self.request.user)
-        serializer.save(cart=cart)
+        with transaction.atomic():
+            cart_item = serializer.save(cart=cart)
+            if settings.STOCK_RESERVATION_TTL:
+                try:
+                    StockReservation.objects.hold(cart_item, cart_item.quantity, settings.STOCK_RESERVATION_TTL)
+                except InsufficientStock as exc:
+                    available = exc.lines[0]["available"]
+                    raise serializers.ValidationError({"error": "Not enough stock", "available": available})
 
     @action(detail=True, methods=["post"])
     def update_quantity(self, request, pk=None):
@@ -398,30 +524,38 @@ class CartItemViewSet(viewsets.ModelViewSet):
 
         try:
             quantity = int(quantity)
-            if quantity > cart_item.product.stock:
+            if not settings.STOCK_RESERVATION_TTL and quantity > cart_item.product.stock:
                 return Response({"error": "Not enough stock"}, status=status.HTTP_400_BAD_REQUEST)
 
-            cart_item.quantity = quantity
-            cart_item.save()
+            with transaction.atomic():
+                if settings.STOCK_RESERVATION_TTL:
+                    StockReservation.objects.hold(cart_item, quantity, settings.STOCK_RESERVATION_TTL)
+                cart_item.quantity = quantity
+                cart_item.save()
 
             serializer = self.get_serializer(cart_item)
             return Response(serializer.data)
 
+        except InsufficientStock as exc:
+            available = exc.lines[0]["available"]
+            return Response({"error": "Not enough stock", "available": available}, status=status.HTTP_400_BAD_REQUEST)
         except ValueError:
             return Response({"error": "Invalid quantity"}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(IdempotencyMixin, viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ["status"]
     ordering_fields = ["created_at", "total_amount", "updated_at"]
+    pagination_class = OrderPagination
+    # Повтор запроса с тем же Idempotency-Key получает сохраненный ответ
+    idempotent_actions = ("create", "cancel", "update_status", "bulk_status")
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Order.objects.all().select_related("user").prefetch_related("items")
-        return Order.objects.filter(user=self.request.user).select_related("user").prefetch_related("items")
+        queryset = Order.objects.all() if self.request.user.is_staff else Order.objects.filter(user=self.request.user)
+        return OrderSerializer.optimize_queryset(queryset, self.request)
 
     def get_serializer_class(self):
         if self.action == "create":
@@ -443,12 +577,10 @@ class OrderViewSet(viewsets.ModelViewSet):
         if order.user != request.user and not request.user.is_staff:
             return Response({"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN)
 
-        if order.status not in ["pending", "processing"]:
+        # Товары возвращаются на склад в той же транзакции, что и смена статуса
+        if not Order.objects.set_status(order, "cancelled", changed_by=request.user):
             return Response({"error": "Order cannot be cancelled"}, status=status.HTTP_400_BAD_REQUEST)
 
-        order.status = "cancelled"
-        order.save()
-
         serializer = self.get_serializer(order)
         return Response(serializer.data)
 
@@ -463,12 +595,32 @@ class OrderViewSet(viewsets.ModelViewSet):
         if new_status not in dict(Order.STATUS_CHOICES).keys():
             return Response({"error": "Invalid status"}, status=status.HTTP_400_BAD_REQUEST)
 
-        order.status = new_status
-        order.save()
+        previous = order.status
+        if not Order.objects.set_status(order, new_status, changed_by=request.user):
+            return Response(
+                {"error": f"Invalid transition: {previous} -> {new_status}", "allowed": Order.TRANSITIONS[previous]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
         serializer = self.get_serializer(order)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["post"], permission_classes=[IsAdminUser])
+    def bulk_status(self, request):
+        """Переводит пачку заказов в один статус; недопустимые переходы и ненайденные id (null) - в rejected"""
+        serializer = OrderBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result = Order.objects.transition(
+            serializer.validated_data["ids"], serializer.validated_data["status"], changed_by=request.user
+        )
+        return Response(result)
+
+    @action(detail=True, methods=["get"])
+    def history(self, request, pk=None):
+        order = self.get_object()
+        serializer = OrderStatusHistorySerializer(order.status_history.select_related("changed_by"), many=True)
+        return Response(serializer.data)
+
 
 class OrderItemViewSet(viewsets.ModelViewSet):
     queryset = OrderItem.objects.all()
@@ -540,3 +692,29 @@ def register(request):
         )
 
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET", "DELETE"])
+@permission_classes([IsAdminUser])
+def cache_statistics(request):
+    """Счетчики попаданий и пересчетов кеша текущего процесса; DELETE обнуляет их"""
+    if request.method == "DELETE":
+        cache_stats.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(cache_stats.snapshot())
+
+
+def product_feed(request):
+    """Товарный фид YML. Отдается готовый файл; обновляет его команда build_product_feed"""
+    path = get_feed_path()
+    if path is None:
+        response = HttpResponse("Фид еще не сформирован, повторите запрос позже", status=503)
+        response["Retry-After"] = "60"
+        return response
+
+    last_modified = int(path.stat().st_mtime)
+    response = get_conditional_response(request, last_modified=last_modified)
+    if response is None:
+        response = FileResponse(open(path, "rb"), content_type="application/xml; charset=utf-8")
+    response["Last-Modified"] = http_date(last_modified)
+    return response